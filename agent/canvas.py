@@ -17,6 +17,7 @@ import importlib
 import json
 import traceback
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from functools import partial
 
@@ -24,7 +25,7 @@ import pandas as pd
 
 from agent.component import component_class
 from agent.component.base import ComponentBase
-from agent.settings import flow_logger, DEBUG
+from agent.settings import flow_logger, DEBUG, CANVAS_MAX_WORKERS
 
 
 class Canvas(ABC):
@@ -72,6 +73,11 @@ class Canvas(ABC):
     }
     """
 
+    max_workers = CANVAS_MAX_WORKERS
+    # Components changing the canvas state other components read (RewriteQuestion rewrites the
+    # question in the history) never run concurrently with others.
+    exclusive_components = {"RewriteQuestion"}
+
     def __init__(self, dsl: str, tenant_id=None):
         self.path = []
         self.history = []
@@ -186,50 +192,66 @@ class Canvas(ABC):
         ran = -1
 
         def prepare2run(cpns):
-            nonlocal ran, ans
+            nonlocal ans
+            # Consecutive components none of which reads the output of another run concurrently,
+            # and are added to the path in their order. A component listed twice runs twice, one after the other.
+            batch = []
+
+            def flush():
+                nonlocal ans
+                for c, (res, err) in zip(batch, self._run_batch(batch, **kwargs)):
+                    if err is not None:
+                        raise err
+                    ans = res
+                    self.path[-1].append(c)
+                batch.clear()
+
             for c in cpns:
-                if self.path[-1] and c == self.path[-1][-1]: continue
+                last = batch[-1] if batch else (self.path[-1][-1] if self.path[-1] else None)
+                if c == last: continue
                 cpn = self.components[c]["obj"]
                 if cpn.component_name == "Answer":
                     self.answer.append(c)
-                else:
-                    if DEBUG: print("RUN: ", c)
-                    if cpn.component_name == "Generate":
-                        cpids = cpn.get_dependent_components()
-                        if any([c not in self.path[-1] for c in cpids]):
-                            continue
-                    ans = cpn.run(self.history, **kwargs)
-                    self.path[-1].append(c)
-            ran += 1
+                    continue
+                if batch and (c in batch or cpn.component_name in self.exclusive_components
+                              or self._depends_on(c, batch)):
+                    flush()
+                if cpn.component_name == "Generate":
+                    cpids = cpn.get_dependent_components()
+                    if any([c not in self.path[-1] for c in cpids]):
+                        continue
+                batch.append(c)
+                if cpn.component_name in self.exclusive_components:
+                    flush()
+            flush()
 
         prepare2run(self.components[self.path[-2][-1]]["downstream"])
+        ran = 0
         while 0 <= ran < len(self.path[-1]):
             if DEBUG: print(ran, self.path)
-            cpn_id = self.path[-1][ran]
-            cpn = self.get_component(cpn_id)
-            if not cpn["downstream"]: break
+            # The downstreams of all the components that ran are expanded in one go, so that independent
+            # branches run concurrently, in the order expanding them one by one would have run them.
+            cpns, parents, end = [], 0, False
+            for cpn_id in self.path[-1][ran:]:
+                cpn = self.get_component(cpn_id)
+                if not cpn["downstream"]:
+                    end = True
+                    break
+                if cpn["obj"].component_name.lower() in ["switch", "categorize", "relevant"]:
+                    switch_out = cpn["obj"].output()[1].iloc[0, 0]
+                    assert switch_out in self.components, \
+                        "{}'s output: {} not valid.".format(cpn_id, switch_out)
+                    cpns.append(switch_out)
+                else:
+                    cpns.extend(cpn["downstream"])
+                parents += 1
+            if not parents: break
 
             loop = self._find_loop()
             if loop: raise OverflowError(f"Too much loops: {loop}")
 
-            if cpn["obj"].component_name.lower() in ["switch", "categorize", "relevant"]:
-                switch_out = cpn["obj"].output()[1].iloc[0, 0]
-                assert switch_out in self.components, \
-                    "{}'s output: {} not valid.".format(cpn_id, switch_out)
-                try:
-                    prepare2run([switch_out])
-                except Exception as e:
-                    for p in [c for p in self.path for c in p][::-1]:
-                        if p.lower().find("answer") >= 0:
-                            self.get_component(p)["obj"].set_exception(e)
-                            prepare2run([p])
-                            break
-                    traceback.print_exc()
-                    break
-                continue
-
             try:
-                prepare2run(cpn["downstream"])
+                prepare2run(cpns)
             except Exception as e:
                 for p in [c for p in self.path for c in p][::-1]:
                     if p.lower().find("answer") >= 0:
@@ -238,6 +260,8 @@ class Canvas(ABC):
                         break
                 traceback.print_exc()
                 break
+            ran += parents
+            if end: break
 
         if self.answer:
             cpn_id = self.answer[0]
@@ -252,6 +276,36 @@ class Canvas(ABC):
 
         return ans
 
+    def _depends_on(self, cpn_id, cpns):
+        """Whether the component reads the output of any of `cpns` (see `ComponentBase.get_input`)."""
+        cpn = self.components[cpn_id]["obj"]
+        deps = set(self.components[cpn_id]["upstream"])
+        if cpn.component_name == "Generate":
+            if any(self.components[c]["obj"].component_name == "Retrieval" for c in cpns):
+                return True
+            deps.update(cpn.get_dependent_components())
+        elif cpn.component_name == "Switch":
+            deps.update(item["cpn_id"] for cond in cpn._param.conditions for item in cond["items"])
+        return bool(deps.intersection(cpns))
+
+    def _run_batch(self, cpns, **kwargs):
+        """Runs the components on up to `max_workers` threads; [(result, exception)] in the order of `cpns`."""
+        def run(c):
+            if DEBUG: print("RUN: ", c)
+            try:
+                return self.components[c]["obj"].run(self.history, **kwargs), None
+            except Exception as e:
+                return None, e
+
+        if len(cpns) < 2 or self.max_workers < 2:
+            res = []
+            for c in cpns:
+                res.append(run(c))
+                if res[-1][1] is not None: break
+            return res
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(cpns))) as exe:
+            return list(exe.map(run, cpns))
+
     def get_component(self, cpn_id):
         return self.components[cpn_id]
 
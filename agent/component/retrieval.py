@@ -81,6 +81,8 @@ class Retrieval(ComponentBase, ABC):
             return df
 
         df = pd.DataFrame(kbinfos["chunks"])
+        # Component outputs are saved with the canvas as JSON.
+        df["vector"] = [v.tolist() for v in df["vector"]]
         df["content"] = df["content_with_weight"]
         del df["content_with_weight"]
         print(">>>>>>>>>>>>>>>>>>>>>>>>>>\n", query, df)
@@ -31,4 +31,6 @@ LoggerFactory.LEVEL = 30
 flow_logger = getLogger("flow")
 database_logger = getLogger("database")
 FLOAT_ZERO = 1e-8
+# Independent canvas components run concurrently on up to this many threads per run.
+CANVAS_MAX_WORKERS = int(os.environ.get("CANVAS_MAX_WORKERS", 8))
 PARAM_MAXDEPTH = 5
@@ -0,0 +1,108 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Wall-clock time of a canvas run with its independent components run one by
+one and concurrently. The canvas retrieves from several knowledge bases and
+generates with the chunks of all of them; retrieval and generation are stubs
+sleeping for the given latencies, so no knowledge base or model is needed.
+
+    python agent/test/benchmark.py -r 4 --retrieval_latency 0.5 --llm_latency 1
+"""
+import argparse
+import json
+import time
+
+import agent.component
+from agent.canvas import Canvas
+from agent.component import Generate, GenerateParam, Retrieval, RetrievalParam
+
+
+class StubRetrievalParam(RetrievalParam):
+    def __init__(self):
+        super().__init__()
+        self.kb_ids = ["stub"]
+        self.latency = 0.5
+
+
+class StubRetrieval(Retrieval):
+    def _run(self, history, **kwargs):
+        time.sleep(self._param.latency)
+        return Retrieval.be_output("chunks of {}".format(self._id))
+
+
+class StubGenerateParam(GenerateParam):
+    def __init__(self):
+        super().__init__()
+        self.llm_id = "stub"
+        self.latency = 1
+
+
+class StubGenerate(Generate):
+    def _run(self, history, **kwargs):
+        time.sleep(self._param.latency)
+        return Generate.be_output("answer from " + ", ".join(self.get_input()["content"]))
+
+
+for c in [StubRetrieval, StubRetrievalParam, StubGenerate, StubGenerateParam]:
+    setattr(agent.component, c.__name__, c)
+
+
+def benchmark_dsl(retrievals, retrieval_latency, llm_latency):
+    rids = ["retrieval:{}".format(i) for i in range(retrievals)]
+    components = {
+        "begin": {"obj": {"component_name": "Begin", "params": {}},
+                  "downstream": ["answer:0"], "upstream": []},
+        "answer:0": {"obj": {"component_name": "Answer", "params": {}},
+                     "downstream": rids, "upstream": ["begin", "generate:0"]},
+        "generate:0": {"obj": {"component_name": "StubGenerate",
+                               "params": {"latency": llm_latency,
+                                          "parameters": [{"key": r, "component_id": r} for r in rids]}},
+                       "downstream": ["answer:0"], "upstream": rids},
+    }
+    for r in rids:
+        components[r] = {"obj": {"component_name": "StubRetrieval", "params": {"latency": retrieval_latency}},
+                         "downstream": ["generate:0"], "upstream": ["answer:0"]}
+    return json.dumps({"components": components, "history": [], "messages": [], "reference": [],
+                       "path": [], "answer": []})
+
+
+def timed_run(dsl, max_workers, rounds):
+    canvas = Canvas(dsl)
+    canvas.max_workers = max_workers
+    canvas.run()
+    st = time.time()
+    for i in range(rounds):
+        canvas.add_user_input("question {}".format(i))
+        ans = canvas.run()
+    return (time.time() - st) / rounds, canvas.path, ans
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--retrievals', default=4, type=int, help="retrieval components")
+    parser.add_argument('--retrieval_latency', default=0.5, type=float, help="seconds per retrieval")
+    parser.add_argument('--llm_latency', default=1., type=float, help="seconds per generation")
+    parser.add_argument('-n', '--rounds', default=3, type=int, help="questions asked")
+    parser.add_argument('-w', '--max_workers', default=Canvas.max_workers, type=int, help="concurrent components")
+    args = parser.parse_args()
+
+    dsl = benchmark_dsl(args.retrievals, args.retrieval_latency, args.llm_latency)
+    seq, seq_path, seq_ans = timed_run(dsl, 1, args.rounds)
+    par, par_path, par_ans = timed_run(dsl, args.max_workers, args.rounds)
+    assert seq_path == par_path, "paths differ:\n{}\n{}".format(seq_path, par_path)
+    assert seq_ans.to_dict("records") == par_ans.to_dict("records")
+    print("one by one: {:.2f}s/turn, concurrent ({} workers): {:.2f}s/turn, {:.1f}x".format(
+        seq, args.max_workers, par, seq / par))
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+from collections import defaultdict
+
+import agent.component
+from agent.canvas import Canvas
+from agent.test.benchmark import StubRetrieval, StubRetrievalParam
+
+
+class CountingRetrievalParam(StubRetrievalParam):
+    def __init__(self):
+        super().__init__()
+        self.latency = 0.2
+
+
+class CountingRetrieval(StubRetrieval):
+    """Records how many threads run each component at the same time."""
+    lock = threading.Lock()
+    running = defaultdict(int)
+    most = defaultdict(int)
+
+    def _run(self, history, **kwargs):
+        with self.lock:
+            self.running[self._id] += 1
+            self.most[self._id] = max(self.most[self._id], self.running[self._id])
+        try:
+            return super()._run(history, **kwargs)
+        finally:
+            with self.lock:
+                self.running[self._id] -= 1
+
+
+for c in [CountingRetrieval, CountingRetrievalParam]:
+    setattr(agent.component, c.__name__, c)
+
+
+def shared_downstream_dsl():
+    """Two parents expanded together list `shared` twice, with `other` in between."""
+    def retrieval(downstream, upstream):
+        return {"obj": {"component_name": "CountingRetrieval", "params": {}},
+                "downstream": downstream, "upstream": upstream}
+
+    components = {
+        "begin": {"obj": {"component_name": "Begin", "params": {}},
+                  "downstream": ["answer:0"], "upstream": []},
+        "answer:0": {"obj": {"component_name": "Answer", "params": {}},
+                     "downstream": ["parent:0", "parent:1"], "upstream": ["begin", "generate:0"]},
+        "parent:0": retrieval(["shared", "other"], ["answer:0"]),
+        "parent:1": retrieval(["shared"], ["answer:0"]),
+        "shared": retrieval(["generate:0"], ["parent:0", "parent:1"]),
+        "other": retrieval(["generate:0"], ["parent:0"]),
+        "generate:0": {"obj": {"component_name": "StubGenerate",
+                               "params": {"latency": 0,
+                                          "parameters": [{"key": c, "component_id": c} for c in ["shared", "other"]]}},
+                       "downstream": ["answer:0"], "upstream": ["shared", "other"]},
+    }
+    return json.dumps({"components": components, "history": [], "messages": [], "reference": [],
+                       "path": [], "answer": []})
+
+
+def run_turn(max_workers):
+    canvas = Canvas(shared_downstream_dsl())
+    canvas.max_workers = max_workers
+    canvas.run()
+    canvas.add_user_input("question")
+    canvas.run()
+    return canvas.path
+
+
+def test_component_listed_twice_runs_one_at_a_time():
+    CountingRetrieval.most.clear()
+    path = run_turn(Canvas.max_workers)
+    assert max(CountingRetrieval.most.values()) == 1
+    assert path[-1].count("shared") == 2
+    assert path == run_turn(1)
@@ -34,7 +34,8 @@ from api.db.services.task_service import queue_tasks, TaskService
 from api.db.services.user_service import UserTenantService
 from api.settings import RetCode, retrievaler
 from api.utils import get_uuid, current_timestamp, datetime_format
-from api.utils.api_utils import server_error_response, get_data_error_result, get_json_result, validate_request
+from api.utils.api_utils import server_error_response, get_data_error_result, get_json_result, validate_request, \
+    stream_data
 from itsdangerous import URLSafeTimedSerializer
 
 from api.utils.file_utils import filename_type, thumbnail
@@ -195,6 +196,7 @@ def completion():
     if not e:
         return get_data_error_result(retmsg="Conversation not found!")
     if "quote" not in req: req["quote"] = False
+    stream_mode = req.pop("stream_mode", "full")
 
     msg = []
     for m in req["messages"]:
@@ -256,6 +258,7 @@ def completion():
 
                 def sse():
                     nonlocal answer, cvs, conv
+                    to_data = stream_data(stream_mode)
                     try:
                         for ans in answer():
                             for k in ans.keys():
@@ -263,7 +266,7 @@ def completion():
                             ans = {"answer": ans["content"], "reference": ans.get("reference", [])}
                             fillin_conv(ans)
                             rename_field(ans)
-                            yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": ans},
+                            yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": to_data(ans)},
                                                        ensure_ascii=False) + "\n\n"
 
                         canvas.messages.append({"role": "assistant", "content": final_ans["content"], "id": message_id})
@@ -311,11 +314,12 @@ def completion():
 
         def stream():
             nonlocal dia, msg, req, conv
+            to_data = stream_data(stream_mode)
             try:
                 for ans in chat(dia, msg, True, **req):
                     fillin_conv(ans)
                     rename_field(ans)
-                    yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": ans},
+                    yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": to_data(ans)},
                                                ensure_ascii=False) + "\n\n"
                 API4ConversationService.append_message(conv.id, conv.to_dict())
             except Exception as e:
@@ -468,7 +472,6 @@ def upload():
                 info["chunk_num"] = 0
                 info["token_num"] = 0
                 DocumentService.update_by_id(doc["id"], info)
-                # if str(req["run"]) == TaskStatus.CANCEL.value:
                 tenant_id = DocumentService.get_tenant_id(doc["id"])
                 if not tenant_id:
                     return get_data_error_result(retmsg="Tenant not found!")
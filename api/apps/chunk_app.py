@@ -24,6 +24,7 @@ from elasticsearch_dsl import Q
 from rag.app.qa import rmPrefix, beAdoc
 from rag.nlp import search, rag_tokenizer, keyword_extraction
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
 from rag.utils import rmSpace
 from api.db import LLMType, ParserType
 from api.db.services.knowledgebase_service import KnowledgebaseService
@@ -35,6 +36,8 @@ from api.settings import RetCode, retrievaler, kg_retrievaler
 from api.utils.api_utils import get_json_result
 import hashlib
 import re
+import networkx as nx
+from graphrag.graph_store import stored_doc_graph
 
 
 @manager.route('/list', methods=['POST'])
@@ -163,6 +166,7 @@ def set():
         v = 0.1 * v[0] + 0.9 * v[1] if doc.parser_id != ParserType.QA else v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        RETRIEVAL_CACHE.bump(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -177,9 +181,13 @@ def switch():
         tenant_id = DocumentService.get_tenant_id(req["doc_id"])
         if not tenant_id:
             return get_data_error_result(retmsg="Tenant not found!")
+        e, doc = DocumentService.get_by_id(req["doc_id"])
+        if not e:
+            return get_data_error_result(retmsg="Document not found!")
         if not ELASTICSEARCH.upsert([{"id": i, "available_int": int(req["available_int"])} for i in req["chunk_ids"]],
                                     search.index_name(tenant_id)):
             return get_data_error_result(retmsg="Index updating failure")
+        RETRIEVAL_CACHE.bump(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -197,6 +205,7 @@ def rm():
         e, doc = DocumentService.get_by_id(req["doc_id"])
         if not e:
             return get_data_error_result(retmsg="Document not found!")
+        RETRIEVAL_CACHE.bump(doc.kb_id)
         deleted_chunk_ids = req["chunk_ids"]
         chunk_number = len(deleted_chunk_ids)
         DocumentService.decrement_chunk_num(doc.id, doc.kb_id, 1, chunk_number, 0)
@@ -240,6 +249,7 @@ def create():
         v = 0.1 * v[0] + 0.9 * v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        RETRIEVAL_CACHE.bump(doc.kb_id)
 
         DocumentService.increment_chunk_num(
             doc.id, doc.kb_id, c, 1, 0)
@@ -322,6 +332,11 @@ def knowledge_graph():
             obj[ty] = json.loads(sres.field[id]["content_with_weight"])
         except Exception as e:
             print(traceback.format_exc(), flush=True)
+    if obj["graph"]:
+        e, doc = DocumentService.get_by_id(doc_id)
+        graph = stored_doc_graph(tenant_id, doc.kb_id, doc_id) if e else None
+        if graph is not None:
+            obj["graph"] = nx.node_link_data(graph)
 
     return get_json_result(data=obj)
 
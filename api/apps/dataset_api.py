@@ -42,6 +42,7 @@ from api.utils.file_utils import filename_type, thumbnail
 from rag.app import book, laws, manual, naive, one, paper, presentation, qa, resume, table, picture, audio, email
 from rag.nlp import search
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
 from rag.utils.storage_factory import STORAGE_IMPL
 
 MAXIMUM_OF_UPLOADING_FILES = 256
@@ -736,6 +737,7 @@ def parsing_document_internal(id):
         ELASTICSEARCH.deleteByQuery(Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
 
         _, doc_attributes = DocumentService.get_by_id(id)
+        RETRIEVAL_CACHE.bump(doc_attributes.kb_id)
         doc_attributes = doc_attributes.to_dict()
         doc_id = doc_attributes["id"]
 
@@ -36,10 +36,13 @@ from api.db.services.file_service import FileService
 from api.db.services.llm_service import LLMBundle
 from api.db.services.task_service import TaskService, queue_tasks
 from api.db.services.user_service import TenantService, UserTenantService
+from graphrag.kb_graph import retract_doc
 from graphrag.mind_map_extractor import MindMapExtractor
 from rag.app import naive
 from rag.nlp import search
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.task_events import TASK_EVENTS
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
 from api.db.services import duplicate_name
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.utils.api_utils import server_error_response, get_data_error_result, validate_request
@@ -272,6 +275,7 @@ def change_status():
                                               idxnm=search.index_name(
                                                   kb.tenant_id)
                                               )
+        RETRIEVAL_CACHE.bump(kb.id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -323,6 +327,9 @@ def rm():
 def run():
     req = request.json
     try:
+        # Incremental re-parse keeps the indexed chunks; the task executor
+        # only adds new chunks and removes the ones that disappeared.
+        incremental = str(req["run"]) == TaskStatus.RUNNING.value and req.get("incremental", False)
         for id in req["doc_ids"]:
             info = {"run": str(req["run"]), "progress": 0}
             if str(req["run"]) == TaskStatus.RUNNING.value:
@@ -330,12 +337,17 @@ def run():
                 info["chunk_num"] = 0
                 info["token_num"] = 0
             DocumentService.update_by_id(id, info)
-            # if str(req["run"]) == TaskStatus.CANCEL.value:
+            if str(req["run"]) == TaskStatus.CANCEL.value:
+                TASK_EVENTS.cancel(id)
             tenant_id = DocumentService.get_tenant_id(id)
             if not tenant_id:
                 return get_data_error_result(retmsg="Tenant not found!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+            if not incremental:
+                ELASTICSEARCH.deleteByQuery(
+                    Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+                e, doc = DocumentService.get_by_id(id)
+                if e:
+                    RETRIEVAL_CACHE.bump(doc.kb_id)
 
             if str(req["run"]) == TaskStatus.RUNNING.value:
                 TaskService.filter_delete([Task.doc_id == id])
@@ -343,7 +355,7 @@ def run():
                 doc = doc.to_dict()
                 doc["tenant_id"] = tenant_id
                 bucket, name = File2DocumentService.get_storage_address(doc_id=doc["id"])
-                queue_tasks(doc, bucket, name)
+                queue_tasks(doc, bucket, name, incremental)
 
         return get_json_result(data=True)
     except Exception as e:
@@ -447,6 +459,9 @@ def change_parser():
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+            RETRIEVAL_CACHE.bump(doc.kb_id)
+        if doc.parser_id == ParserType.KG.value and doc.parser_config.get("graph_incremental"):
+            retract_doc(DocumentService.get_tenant_id(doc.id), doc.kb_id, doc.id)
 
         return get_json_result(data=True)
     except Exception as e:
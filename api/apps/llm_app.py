@@ -123,6 +123,7 @@ def set_api_key():
                 api_key=llm_config["api_key"],
                 api_base=llm_config["api_base"]
             )
+    TenantLLMService.invalidate(tenant_id)
 
     return get_json_result(data=True)
 
@@ -276,6 +277,7 @@ def add_llm():
     if not TenantLLMService.filter_update(
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == factory, TenantLLM.llm_name == llm["llm_name"]], llm):
         TenantLLMService.save(**llm)
+    TenantLLMService.invalidate(current_user.id)
 
     return get_json_result(data=True)
 
@@ -287,6 +289,7 @@ def delete_llm():
     req = request.json
     TenantLLMService.filter_delete(
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"], TenantLLM.llm_name == req["llm_name"]])
+    TenantLLMService.invalidate(current_user.id)
     return get_json_result(data=True)
 
 
@@ -297,6 +300,7 @@ def delete_factory():
     req = request.json
     TenantLLMService.filter_delete(
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"]])
+    TenantLLMService.invalidate(current_user.id)
     return get_json_result(data=True)
 
 
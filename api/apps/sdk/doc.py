@@ -11,6 +11,7 @@ from elasticsearch_dsl import Q
 from rag.app.qa import rmPrefix, beAdoc
 from rag.nlp import search, rag_tokenizer, keyword_extraction
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.task_events import TASK_EVENTS
 from rag.utils import rmSpace
 from api.db import LLMType, ParserType
 from api.db.services.knowledgebase_service import KnowledgebaseService
@@ -52,6 +53,7 @@ from rag.app import book, laws, manual, naive, one, paper, presentation, qa, res
 from rag.nlp import search
 from rag.utils import rmSpace
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
 from rag.utils.storage_factory import STORAGE_IMPL
 
 MAXIMUM_OF_UPLOADING_FILES = 256
@@ -193,6 +195,7 @@ def save_doc(tenant_id):
                     return get_data_error_result(retmsg="Tenant not found!")
                 ELASTICSEARCH.deleteByQuery(
                     Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+                RETRIEVAL_CACHE.bump(doc.kb_id)
         except Exception as e:
             return server_error_response(e)
     return get_json_result(data=True)
@@ -235,6 +238,7 @@ def change_parser(tenant_id):
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+            RETRIEVAL_CACHE.bump(doc.kb_id)
 
         return get_json_result(data=True)
     except Exception as e:
@@ -426,12 +430,16 @@ def run(tenant_id):
                 info["chunk_num"] = 0
                 info["token_num"] = 0
             DocumentService.update_by_id(id, info)
-            # if str(req["run"]) == TaskStatus.CANCEL.value:
+            if str(req["run"]) == TaskStatus.CANCEL.value:
+                TASK_EVENTS.cancel(id)
             tenant_id = DocumentService.get_tenant_id(id)
             if not tenant_id:
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+            e, doc = DocumentService.get_by_id(id)
+            if e:
+                RETRIEVAL_CACHE.bump(doc.kb_id)
 
             if str(req["run"]) == TaskStatus.RUNNING.value:
                 TaskService.filter_delete([Task.doc_id == id])
@@ -551,6 +559,7 @@ def create(tenant_id):
         v = 0.1 * v[0] + 0.9 * v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        RETRIEVAL_CACHE.bump(doc.kb_id)
 
         DocumentService.increment_chunk_num(
             doc.id, doc.kb_id, c, 1, 0)
@@ -589,6 +598,7 @@ def rm_chunk(tenant_id):
         e, doc = DocumentService.get_by_id(req["document_id"])
         if not e:
             return get_data_error_result(retmsg="Document not found!")
+        RETRIEVAL_CACHE.bump(doc.kb_id)
         deleted_chunk_ids = req["chunk_ids"]
         chunk_number = len(deleted_chunk_ids)
         DocumentService.decrement_chunk_num(doc.id, doc.kb_id, 1, chunk_number, 0)
@@ -641,6 +651,7 @@ def set(tenant_id):
         v = 0.1 * v[0] + 0.9 * v[1] if doc.parser_id != ParserType.QA else v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        RETRIEVAL_CACHE.bump(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -23,7 +23,7 @@ from api.db.services.dialog_service import DialogService, ConversationService, c
 from api.settings import RetCode
 from api.utils import get_uuid
 from api.utils.api_utils import get_data_error_result
-from api.utils.api_utils import get_json_result, token_required
+from api.utils.api_utils import get_json_result, token_required, stream_data
 
 
 @manager.route('/save', methods=['POST'])
@@ -109,6 +109,7 @@ def completion(tenant_id):
     message_id = msg[-1].get("id")
     e, dia = DialogService.get_by_id(conv.dialog_id)
     del req["id"]
+    stream_mode = req.pop("stream_mode", "full")
 
     if not conv.reference:
         conv.reference = []
@@ -127,10 +128,11 @@ def completion(tenant_id):
 
     def stream():
         nonlocal dia, msg, req, conv
+        to_data = stream_data(stream_mode)
         try:
             for ans in chat(dia, msg, **req):
                 fillin_conv(ans)
-                yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": ans}, ensure_ascii=False) + "\n\n"
+                yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": to_data(ans)}, ensure_ascii=False) + "\n\n"
             ConversationService.update_by_id(conv.id, conv.to_dict())
         except Exception as e:
             yield "data:" + json.dumps({"retcode": 500, "retmsg": str(e),
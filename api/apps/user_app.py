@@ -417,6 +417,7 @@ def set_tenant_info():
         tid = req["tenant_id"]
         del req["tenant_id"]
         TenantService.update_by_id(tid, req)
+        TenantLLMService.invalidate(tid)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -215,7 +215,7 @@ def chat(dialog, messages, stream=True, **kwargs):
 
             refs = deepcopy(kbinfos)
             for c in refs["chunks"]:
-                if c.get("vector"):
+                if "vector" in c:
                     del c["vector"]
 
         if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api") >= 0:
@@ -531,7 +531,7 @@ def ask(question, kb_ids, tenant_id):
         kbinfos["doc_aggs"] = recall_docs
         refs = deepcopy(kbinfos)
         for c in refs["chunks"]:
-            if c.get("vector"):
+            if "vector" in c:
                 del c["vector"]
 
         if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api") >= 0:
@@ -31,6 +31,7 @@ from api.db.db_utils import bulk_insert_into_db
 from api.settings import stat_logger
 from api.utils import current_timestamp, get_format_time, get_uuid
 from api.utils.file_utils import get_project_base_directory
+from graphrag.kb_graph import retract_doc
 from graphrag.mind_map_extractor import MindMapExtractor
 from rag.settings import SVR_QUEUE_NAME
 from rag.utils.es_conn import ELASTICSEARCH
@@ -44,6 +45,8 @@ from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db import StatusEnum
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
+from rag.utils.task_events import TASK_EVENTS
 
 
 class DocumentService(CommonService):
@@ -118,6 +121,9 @@ class DocumentService(CommonService):
     def remove_document(cls, doc, tenant_id):
         ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+        RETRIEVAL_CACHE.bump(doc.kb_id)
+        if doc.parser_id == ParserType.KG.value and doc.parser_config.get("graph_incremental"):
+            retract_doc(tenant_id, doc.kb_id, doc.id)
         cls.clear_chunk_num(doc.id)
         return cls.delete_by_id(doc.id)
 
@@ -152,7 +158,7 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_unfinished_docs(cls):
+    def get_unfinished_docs(cls, doc_ids=None):
         fields = [cls.model.id, cls.model.process_begin_at, cls.model.parser_config, cls.model.progress_msg, cls.model.run]
         docs = cls.model.select(*fields) \
             .where(
@@ -160,6 +166,8 @@ class DocumentService(CommonService):
                 ~(cls.model.type == FileType.VIRTUAL.value),
                 cls.model.progress < 1,
                 cls.model.progress > 0)
+        if doc_ids is not None:
+            docs = docs.where(cls.model.id.in_(list(doc_ids)))
         return list(docs.dicts())
 
     @classmethod
@@ -311,8 +319,9 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def update_progress(cls):
-        docs = cls.get_unfinished_docs()
+    def update_progress(cls, doc_ids=None):
+        """Aggregates the task progress of the unfinished documents, or of those in `doc_ids`."""
+        docs = cls.get_unfinished_docs(doc_ids)
         for d in docs:
             try:
                 tsks = Task.query(doc_id=d["id"], order_by=Task.create_time)
@@ -355,6 +364,9 @@ class DocumentService(CommonService):
                 if msg:
                     info["progress_msg"] = msg
                 cls.update_by_id(d["id"], info)
+                if prg == -1:
+                    # A failed document stops its remaining tasks, as do_cancel did on `progress < 0`.
+                    TASK_EVENTS.cancel(d["id"])
             except Exception as e:
                 stat_logger.error("fetch task exception:" + str(e))
 
@@ -482,7 +494,6 @@ def doc_upload_and_parse(conversation_id, file_objs, user_id):
     docids = [d["id"] for d, _ in files]
     chunk_counts = {id: 0 for id in docids}
     token_counts = {id: 0 for id in docids}
-    es_bulk_size = 64
 
     def embedding(doc_id, cnts, batch_size=16):
         nonlocal embd_mdl, chunk_counts, token_counts
@@ -523,8 +534,8 @@ def doc_upload_and_parse(conversation_id, file_objs, user_id):
         for i, d in enumerate(cks):
             v = vects[i]
             d["q_%d_vec" % len(v)] = v
-        for b in range(0, len(cks), es_bulk_size):
-            ELASTICSEARCH.bulk(cks[b:b + es_bulk_size], idxnm)
+        ELASTICSEARCH.bulk_index(cks, idxnm)
+        RETRIEVAL_CACHE.bump(kb.id)
 
         DocumentService.increment_chunk_num(
             doc_id, kb.id, token_counts[doc_id], chunk_counts[doc_id], 0)
@@ -13,6 +13,11 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import hashlib
+import threading
+
+from cachetools import TTLCache
+
 from api.db.services.user_service import TenantService
 from api.settings import database_logger
 from rag.llm import EmbeddingModel, CvModel, ChatModel, RerankModel, Seq2txtModel, TTSModel
@@ -20,6 +25,15 @@ from api.db import LLMType
 from api.db.db_models import DB
 from api.db.db_models import LLMFactories, LLM, TenantLLM
 from api.db.services.common_service import CommonService
+from rag import settings
+from rag.settings import EMBEDDING_CACHE
+from rag.utils.embedding_cache import EMBEDDING_CACHE as EMBD_CACHE
+from rag.utils.token_usage import UsageAccumulator
+
+_MODEL_CONFIGS = TTLCache(maxsize=settings.MODEL_INSTANCE_CACHE_SIZE, ttl=settings.MODEL_CONFIG_TTL)
+_MODEL_INSTANCES = TTLCache(maxsize=settings.MODEL_INSTANCE_CACHE_SIZE, ttl=settings.MODEL_INSTANCE_TTL)
+_MAX_TOKENS = TTLCache(maxsize=settings.MODEL_INSTANCE_CACHE_SIZE, ttl=settings.MODEL_INSTANCE_TTL)
+_MODEL_CACHE_LOCK = threading.Lock()
 
 
 class LLMFactoriesService(CommonService):
@@ -29,6 +43,19 @@ class LLMFactoriesService(CommonService):
 class LLMService(CommonService):
     model = LLM
 
+    @classmethod
+    def max_tokens(cls, llm_name):
+        with _MODEL_CACHE_LOCK:
+            if llm_name in _MAX_TOKENS:
+                return _MAX_TOKENS[llm_name]
+        max_length = 8192
+        for lm in cls.query(llm_name=llm_name):
+            max_length = lm.max_tokens
+            break
+        with _MODEL_CACHE_LOCK:
+            _MAX_TOKENS[llm_name] = max_length
+        return max_length
+
 
 class TenantLLMService(CommonService):
     model = TenantLLM
@@ -63,8 +90,7 @@ class TenantLLMService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def model_instance(cls, tenant_id, llm_type,
-                       llm_name=None, lang="Chinese"):
+    def model_config(cls, tenant_id, llm_type, llm_name=None):
         e, tenant = TenantService.get_by_id(tenant_id)
         if not e:
             raise LookupError("Tenant not found")
@@ -102,7 +128,51 @@ class TenantLLMService(CommonService):
                     if not mdlnm:
                         raise LookupError(f"Type of {llm_type} model is not set.")
                     raise LookupError("Model({}) not authorized".format(mdlnm))
+        return model_config
 
+    @classmethod
+    def model_instance(cls, tenant_id, llm_type,
+                       llm_name=None, lang="Chinese"):
+        """
+        Model instances are reused, keyed by tenant, model and a hash of the
+        API key, so a changed key gets a new instance. The tenant's model
+        settings are read from the DB at most every MODEL_CONFIG_TTL seconds,
+        or right after `invalidate`.
+        """
+        model_config = cls.cached_model_config(tenant_id, llm_type, llm_name)
+        api_key = hashlib.sha256(str(model_config["api_key"]).encode("utf-8")).hexdigest()
+        instance_key = (tenant_id, llm_type, model_config["llm_factory"], model_config["llm_name"],
+                        model_config["api_base"], api_key, lang)
+        with _MODEL_CACHE_LOCK:
+            mdl = _MODEL_INSTANCES.get(instance_key)
+        if mdl is None:
+            mdl = cls.new_model_instance(llm_type, model_config, lang)
+            if mdl is not None and getattr(mdl, "reusable", True):
+                with _MODEL_CACHE_LOCK:
+                    _MODEL_INSTANCES[instance_key] = mdl
+        return mdl
+
+    @classmethod
+    def cached_model_config(cls, tenant_id, llm_type, llm_name=None):
+        config_key = (tenant_id, llm_type, llm_name)
+        with _MODEL_CACHE_LOCK:
+            model_config = _MODEL_CONFIGS.get(config_key)
+        if model_config is None:
+            model_config = cls.model_config(tenant_id, llm_type, llm_name)
+            with _MODEL_CACHE_LOCK:
+                _MODEL_CONFIGS[config_key] = model_config
+        return model_config
+
+    @classmethod
+    def invalidate(cls, tenant_id):
+        """Drops the cached model settings and instances of the tenant in this process."""
+        with _MODEL_CACHE_LOCK:
+            for cache in [_MODEL_CONFIGS, _MODEL_INSTANCES]:
+                for k in [k for k in cache.keys() if k[0] == tenant_id]:
+                    cache.pop(k, None)
+
+    @staticmethod
+    def new_model_instance(llm_type, model_config, lang="Chinese"):
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
                 return
@@ -145,37 +215,47 @@ class TenantLLMService(CommonService):
                 base_url=model_config["api_base"],
             )
 
-    @classmethod
-    @DB.connection_context()
-    def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
-        e, tenant = TenantService.get_by_id(tenant_id)
-        if not e:
-            raise LookupError("Tenant not found")
-
+    @staticmethod
+    def usage_llm_name(tenant, llm_type, llm_name=None):
         if llm_type == LLMType.EMBEDDING.value:
-            mdlnm = tenant.embd_id
+            return tenant.embd_id
         elif llm_type == LLMType.SPEECH2TEXT.value:
-            mdlnm = tenant.asr_id
+            return tenant.asr_id
         elif llm_type == LLMType.IMAGE2TEXT.value:
-            mdlnm = tenant.img2txt_id
+            return tenant.img2txt_id
         elif llm_type == LLMType.CHAT.value:
-            mdlnm = tenant.llm_id if not llm_name else llm_name
+            return tenant.llm_id if not llm_name else llm_name
         elif llm_type == LLMType.RERANK:
-            mdlnm = tenant.rerank_id if not llm_name else llm_name
+            return tenant.rerank_id if not llm_name else llm_name
         elif llm_type == LLMType.TTS:
-            mdlnm = tenant.tts_id if not llm_name else llm_name
+            return tenant.tts_id if not llm_name else llm_name
         else:
             assert False, "LLM type error"
 
-        num = 0
-        try:
-            for u in cls.query(tenant_id = tenant_id, llm_name=mdlnm):
-                num += cls.model.update(used_tokens = u.used_tokens + used_tokens)\
-                    .where(cls.model.tenant_id == tenant_id, cls.model.llm_name == mdlnm)\
-                    .execute()
-        except Exception as e:
-            pass
-        return num
+    @classmethod
+    @DB.connection_context()
+    def increase_usage_batch(cls, usage):
+        """
+        Adds the tokens of `usage`, {(tenant_id, llm_type, llm_name): tokens},
+        in one transaction, incrementing each tenant model row in SQL.
+        """
+        tokens = {}
+        tenants = {}
+        for (tenant_id, llm_type, llm_name), used_tokens in usage.items():
+            if tenant_id not in tenants:
+                e, tenants[tenant_id] = TenantService.get_by_id(tenant_id)
+                if not e:
+                    database_logger.error("Can't update token usage for {}: tenant not found".format(tenant_id))
+            if not tenants[tenant_id]:
+                continue
+            k = (tenant_id, cls.usage_llm_name(tenants[tenant_id], llm_type, llm_name))
+            tokens[k] = tokens.get(k, 0) + used_tokens
+        with DB.atomic():
+            for (tenant_id, mdlnm), used_tokens in tokens.items():
+                if not cls.model.update(used_tokens=cls.model.used_tokens + used_tokens)\
+                        .where(cls.model.tenant_id == tenant_id, cls.model.llm_name == mdlnm)\
+                        .execute():
+                    database_logger.error("Can't update token usage for {}/{}".format(tenant_id, mdlnm))
 
     @classmethod
     @DB.connection_context()
@@ -188,6 +268,9 @@ class TenantLLMService(CommonService):
         return list(objs)
 
 
+TOKEN_USAGE = UsageAccumulator(TenantLLMService.increase_usage_batch)
+
+
 class LLMBundle(object):
     def __init__(self, tenant_id, llm_type, llm_name=None, lang="Chinese"):
         self.tenant_id = tenant_id
@@ -197,76 +280,72 @@ class LLMBundle(object):
             tenant_id, llm_type, llm_name, lang=lang)
         assert self.mdl, "Can't find mole for {}/{}/{}".format(
             tenant_id, llm_type, llm_name)
-        self.max_length = 8192
-        for lm in LLMService.query(llm_name=llm_name):
-            self.max_length = lm.max_tokens
-            break
-    
+        self.max_length = LLMService.max_tokens(llm_name)
+
+    def _embd_model_id(self):
+        if self.llm_type != LLMType.EMBEDDING.value or not EMBEDDING_CACHE:
+            return
+        nm = getattr(self.mdl, "model_name", self.llm_name)
+        if not nm:
+            return
+        # Servers behind different base URLs or keys may serve different weights under one name.
+        model_config = TenantLLMService.cached_model_config(self.tenant_id, self.llm_type, self.llm_name)
+        return EMBD_CACHE.model_id(self.mdl.__class__.__name__, nm,
+                                   model_config.get("api_base"), model_config.get("api_key"))
+
     def encode(self, texts: list, batch_size=32):
-        emd, used_tokens = self.mdl.encode(texts, batch_size)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
+        mdl_id = self._embd_model_id()
+        if mdl_id:
+            emd, used_tokens = EMBD_CACHE.encode(mdl_id, texts, lambda t: self.mdl.encode(t, batch_size))
+        else:
+            emd, used_tokens = self.mdl.encode(texts, batch_size)
+        TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return emd, used_tokens
 
     def encode_queries(self, query: str):
-        emd, used_tokens = self.mdl.encode_queries(query)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
+        mdl_id = self._embd_model_id()
+        if mdl_id:
+            def encode_one(t):
+                v, c = self.mdl.encode_queries(t[0])
+                return [v], c
+            emd, used_tokens = EMBD_CACHE.encode(mdl_id, [query], encode_one, kind="query")
+            emd = emd[0]
+        else:
+            emd, used_tokens = self.mdl.encode_queries(query)
+        TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return emd, used_tokens
 
     def similarity(self, query: str, texts: list):
         sim, used_tokens = self.mdl.similarity(query, texts)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/RERANK".format(self.tenant_id))
+        TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return sim, used_tokens
 
     def describe(self, image, max_tokens=300):
         txt, used_tokens = self.mdl.describe(image, max_tokens)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/IMAGE2TEXT".format(self.tenant_id))
+        TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return txt
 
     def transcription(self, audio):
         txt, used_tokens = self.mdl.transcription(audio)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/SEQUENCE2TXT".format(self.tenant_id))
+        TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return txt
 
     def tts(self, text):
         for chunk in self.mdl.tts(text):
             if isinstance(chunk,int):
-                if not TenantLLMService.increase_usage(
-                    self.tenant_id, self.llm_type, chunk, self.llm_name):
-                        database_logger.error(
-                            "Can't update token usage for {}/TTS".format(self.tenant_id))
+                TOKEN_USAGE.add(self.tenant_id, self.llm_type, chunk, self.llm_name)
                 return
             yield chunk     
 
     
     def chat(self, system, history, gen_conf):
         txt, used_tokens = self.mdl.chat(system, history, gen_conf)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens, self.llm_name):
-            database_logger.error(
-                "Can't update token usage for {}/CHAT".format(self.tenant_id))
+        TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens, self.llm_name)
         return txt
 
     def chat_streamly(self, system, history, gen_conf):
         for txt in self.mdl.chat_streamly(system, history, gen_conf):
             if isinstance(txt, int):
-                if not TenantLLMService.increase_usage(
-                        self.tenant_id, self.llm_type, txt, self.llm_name):
-                    database_logger.error(
-                        "Can't update token usage for {}/CHAT".format(self.tenant_id))
+                TOKEN_USAGE.add(self.tenant_id, self.llm_type, txt, self.llm_name)
                 return
             yield txt
@@ -29,6 +29,7 @@ from deepdoc.parser.excel_parser import RAGFlowExcelParser
 from rag.settings import SVR_QUEUE_NAME
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_events import TASK_EVENTS
 from loguru import logger as LOGGER
 
 class TaskService(CommonService):
@@ -133,7 +134,7 @@ class TaskService(CommonService):
                     cls.model.id == id).execute()
 
 
-def queue_tasks(doc, bucket, name):
+def queue_tasks(doc, bucket, name, incremental=False):
     def new_task():
         nonlocal doc
         return {
@@ -182,7 +183,10 @@ def queue_tasks(doc, bucket, name):
 
     bulk_insert_into_db(Task, tsks, True)
     DocumentService.begin2parse(doc["id"])
+    TASK_EVENTS.resume(doc["id"])
 
     LOGGER.info(f"生产任务：{tsks}")
     for t in tsks:
+        if incremental:
+            t["incremental"] = True
         assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=t), "Can't access Redis. Please check the Redis' status."
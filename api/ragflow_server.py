@@ -34,15 +34,25 @@ from api import utils
 from api.db.db_models import init_database_tables as init_web_db
 from api.db.init_data import init_web_data
 from api.versions import get_versions
+from rag.settings import PROGRESS_RESYNC_INTERVAL
+from rag.utils.task_events import TASK_EVENTS
 
 
 def update_progress():
+    # Documents are updated when task executors announce progress; all the
+    # unfinished ones are re-checked now and then, for announcements lost.
+    last_resync = 0
     while True:
-        time.sleep(1)
         try:
-            DocumentService.update_progress()
+            doc_ids = TASK_EVENTS.progressed_docs()
+            if time.time() - last_resync > PROGRESS_RESYNC_INTERVAL:
+                last_resync = time.time()
+                DocumentService.update_progress()
+            elif doc_ids:
+                DocumentService.update_progress(doc_ids)
         except Exception as e:
             stat_logger.error("update_progress exception:" + str(e))
+            time.sleep(1)
 
 
 if __name__ == '__main__':
@@ -288,3 +288,39 @@ def token_required(func):
         return func(*args, **kwargs)
 
     return decorated_function
+
+
+class DeltaStream:
+    """
+    The opt-in delta mode of streamed chat completions (request field
+    "stream_mode": "delta"). Instead of the whole answer so far, the data of
+    each frame carries "delta", the text appended since the previous frame,
+    or "answer" when the text was rewritten (citations are inserted into the
+    final answer). "reference" is only sent when it changed, usually once at
+    the end. Other fields pass through, and the stream still ends with the
+    `"data": true` frame.
+    """
+
+    def __init__(self):
+        self.answer = ""
+        self.reference = None
+
+    def __call__(self, ans):
+        data = {k: v for k, v in ans.items() if k not in ["answer", "reference"]}
+        answer = ans.get("answer", "")
+        if answer.startswith(self.answer):
+            data["delta"] = answer[len(self.answer):]
+        else:
+            data["answer"] = answer
+        self.answer = answer
+        if "reference" in ans and ans["reference"] != self.reference:
+            data["reference"] = ans["reference"]
+            self.reference = ans["reference"]
+        return data
+
+
+def stream_data(stream_mode="full"):
+    """Maps each streamed answer to the data of its frame: as is, or see `DeltaStream`."""
+    if stream_mode == "delta":
+        return DeltaStream()
+    return lambda ans: ans
@@ -13,6 +13,10 @@
 
 import os
 import random
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
 
 import xgboost as xgb
 from io import BytesIO
@@ -27,6 +31,7 @@ from pypdf import PdfReader as pdf2_read
 from api.settings import LIGHTEN
 from api.utils.file_utils import get_project_base_directory
 from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
+from deepdoc.vision.page_ocr import ocr_pages, render_and_ocr
 from rag.nlp import rag_tokenizer
 from copy import deepcopy
 from huggingface_hub import snapshot_download
@@ -34,7 +39,77 @@ from huggingface_hub import snapshot_download
 logging.getLogger("pdfminer").setLevel(logging.WARNING)
 
 
+class PageImages:
+    """
+    Stand-in for the list of rendered pages when streaming. Pages are kept
+    losslessly, so layout, table recognition and crop() see exactly the
+    rendered image, but off the heap: each page is compressed, as one
+    channel when it is grey, and written to an anonymous temporary file.
+    Pages are decoded on access, with the last few decoded pages cached
+    since those steps work page by page, so memory stays flat however many
+    pages the document has.
+    """
+
+    def __init__(self, cache_size=4, level=1):
+        self.cache_size = cache_size
+        self.level = level
+        self._file = tempfile.TemporaryFile()
+        self._lock = threading.Lock()
+        self._pages = []
+        self._cache = OrderedDict()
+
+    def append(self, img):
+        mode, stored = img.mode, img
+        if mode == "RGB":
+            gray = img.convert("L")
+            if gray.convert("RGB").tobytes() == img.tobytes():
+                stored = gray
+        data = zlib.compress(stored.tobytes(), self.level)
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._pages.append((mode, stored.mode, img.size, self._file.tell(), len(data)))
+            self._file.write(data)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+            mode, stored_mode, size, offset, length = self._pages[i]
+            self._file.seek(offset)
+            data = self._file.read(length)
+        img = Image.frombytes(stored_mode, size, zlib.decompress(data))
+        if stored_mode != mode:
+            img = img.convert(mode)
+        with self._lock:
+            self._cache[i] = img
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return img
+
+
 class RAGFlowPdfParser:
+    # Text recognition for boxes without embedded chars is batched across
+    # this many pages, `ocr_batch_size` crops per ONNX run.
+    ocr_batch_pages = int(os.environ.get("OCR_BATCH_PAGES", 4))
+    ocr_batch_size = int(os.environ.get("OCR_BATCH_SIZE", 64))
+    # Render and OCR pages in this many worker processes; 0 or 1 keeps it in-process.
+    ocr_workers = int(os.environ.get("PDF_OCR_WORKERS", 0))
+    # Render pages window by window and keep them compressed in a temporary
+    # file (see PageImages), so memory does not grow with the page count.
+    stream_pages = os.environ.get("PDF_STREAM_PAGES", "0").lower() in ["1", "true", "yes"]
+
     def __init__(self):
         self.ocr = OCR()
         if hasattr(self, "model_speciess"):
@@ -274,51 +349,13 @@ class RAGFlowPdfParser:
                 b["H_right"] = spans[ii]["x1"]
                 b["SP"] = ii
 
-    def __ocr(self, pagenum, img, chars, ZM=3):
-        bxs = self.ocr.detect(np.array(img))
-        if not bxs:
-            self.boxes.append([])
-            return
-        bxs = [(line[0], line[1][0]) for line in bxs]
-        bxs = Recognizer.sort_Y_firstly(
-            [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
-              "top": b[0][1] / ZM, "text": "", "txt": t,
-              "bottom": b[-1][1] / ZM,
-              "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
-            self.mean_height[-1] / 3
-        )
-        
-        # merge chars in the same rect
-        for c in Recognizer.sort_Y_firstly(
-                chars, self.mean_height[pagenum - 1] // 4):
-            ii = Recognizer.find_overlapped(c, bxs)
-            if ii is None:
-                self.lefted_chars.append(c)
-                continue
-            ch = c["bottom"] - c["top"]
-            bh = bxs[ii]["bottom"] - bxs[ii]["top"]
-            if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
-                self.lefted_chars.append(c)
-                continue
-            if c["text"] == " " and bxs[ii]["text"]:
-                if re.match(r"[0-9a-zA-Zа-яА-Я,.?;:!%%]", bxs[ii]["text"][-1]):
-                    bxs[ii]["text"] += " "
-            else:
-                bxs[ii]["text"] += c["text"]
-
-        for b in bxs:
-            if not b["text"]:
-                left, right, top, bott = b["x0"] * ZM, b["x1"] * \
-                                         ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["text"] = self.ocr.recognize(np.array(img),
-                                               np.array([[left, top], [right, top], [right, bott], [left, bott]],
-                                                        dtype=np.float32))
-            del b["txt"]
-        bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[-1] == 0:
-            self.mean_height[-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
-        self.boxes.append(bxs)
+    def __ocr_pages(self, pages, ZM=3):
+        res = ocr_pages(self.ocr, [(pn, img, chars, self.mean_height[pn - 1]) for pn, img, chars in pages],
+                        ZM, self.ocr_batch_size)
+        for (pn, _, _), (bxs, mean_height, lefted) in zip(pages, res):
+            self.lefted_chars.extend(lefted)
+            self.mean_height[pn - 1] = mean_height
+            self.boxes.append(bxs)
 
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
@@ -938,6 +975,24 @@ class RAGFlowPdfParser:
         except Exception as e:
             logging.error(str(e))
 
+    def __page_chars(self, i):
+        chars = self.page_chars[i] if not self.is_english else []
+        self.mean_height.append(
+            np.median(sorted([c["height"] for c in chars])) if chars else 0
+        )
+        self.mean_width.append(
+            np.median(sorted([c["width"] for c in chars])) if chars else 8
+        )
+        j = 0
+        while j + 1 < len(chars):
+            if chars[j]["text"] and chars[j + 1]["text"] \
+                    and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
+                    and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
+                                                                   chars[j]["width"]) / 2:
+                chars[j]["text"] += " "
+            j += 1
+        return chars
+
     def __images__(self, fnm, zoomin=3, page_from=0,
                    page_to=299, callback=None):
         self.lefted_chars = []
@@ -948,14 +1003,27 @@ class RAGFlowPdfParser:
         self.page_cum_height = [0]
         self.page_layout = []
         self.page_from = page_from
+        self.page_images = PageImages() if self.stream_pages else []
+        parallel = False
         st = timer()
         try:
             self.pdf = pdfplumber.open(fnm) if isinstance(
                 fnm, str) else pdfplumber.open(BytesIO(fnm))
-            self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                enumerate(self.pdf.pages[page_from:page_to])]
-            self.page_chars = [[{**c, 'top': c['top'], 'bottom': c['bottom']} for c in page.dedupe_chars().chars if self._has_color(c)] for page in
-                               self.pdf.pages[page_from:page_to]]
+            plumber = self.pdf
+            parallel = self.ocr_workers > 1 and len(self.pdf.pages[page_from:page_to]) > self.ocr_batch_pages
+            if not parallel and not self.stream_pages:
+                self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
+                                    enumerate(self.pdf.pages[page_from:page_to])]
+            if self.stream_pages:
+                # Only the fields OCR reads are kept; pdfplumber's per-page caches are dropped.
+                self.page_chars = []
+                for page in self.pdf.pages[page_from:page_to]:
+                    self.page_chars.append([{k: c[k] for k in ["text", "x0", "x1", "top", "bottom", "width", "height"]}
+                                            for c in page.dedupe_chars().chars if self._has_color(c)])
+                    page.flush_cache()
+            else:
+                self.page_chars = [[{**c, 'top': c['top'], 'bottom': c['bottom']} for c in page.dedupe_chars().chars if self._has_color(c)] for page in
+                                   self.pdf.pages[page_from:page_to]]
             self.total_page = len(self.pdf.pages)
         except Exception as e:
             logging.error(str(e))
@@ -983,37 +1051,53 @@ class RAGFlowPdfParser:
             random.choices([c["text"] for c in self.page_chars[i]], k=min(100, len(self.page_chars[i]))))) for i in
                            range(len(self.page_chars))]
         if sum([1 if e else 0 for e in self.is_english]) > len(
-                self.page_images) / 2:
+                self.page_chars) / 2:
             self.is_english = True
         else:
             self.is_english = False
 
         st = timer()
-        for i, img in enumerate(self.page_images):
-            chars = self.page_chars[i] if not self.is_english else []
-            self.mean_height.append(
-                np.median(sorted([c["height"] for c in chars])) if chars else 0
-            )
-            self.mean_width.append(
-                np.median(sorted([c["width"] for c in chars])) if chars else 8
-            )
+        has_chars = any([c for c in self.page_chars])
+        if parallel:
+            # Pages are rendered by the OCR workers.
+            pages = []
+            for i in range(len(self.page_chars)):
+                chars = self.__page_chars(i)
+                pages.append((i, chars, self.mean_height[i]))
+            for i, (img, bxs, mean_height, lefted) in enumerate(
+                    render_and_ocr(fnm, page_from, zoomin, pages, self.ocr_workers,
+                                   self.ocr_batch_pages, self.ocr_batch_size, callback)):
+                self.page_images.append(img)
+                self.page_cum_height.append(img.size[1] / zoomin)
+                self.lefted_chars.extend(lefted)
+                self.mean_height[i] = mean_height
+                self.boxes.append(bxs)
+
+        window = []
+        page_num = len(self.page_chars) if self.stream_pages else len(self.page_images)
+        for i in range(0 if parallel else page_num):
+            if self.stream_pages:
+                page = plumber.pages[page_from + i]
+                img = page.to_image(resolution=72 * zoomin).annotated
+                page.flush_cache()
+            else:
+                img = self.page_images[i]
+            chars = self.__page_chars(i)
             self.page_cum_height.append(img.size[1] / zoomin)
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
-
-            self.__ocr(i + 1, img, chars, zoomin)
-            if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+            window.append((i + 1, img, chars))
+            if len(window) >= self.ocr_batch_pages or i + 1 == page_num:
+                self.__ocr_pages(window, zoomin)
+                if self.stream_pages:
+                    for pn, img, chars in window:
+                        self.page_images.append(img)
+                        self.page_chars[pn - 1] = []
+                    self.lefted_chars = []
+                window = []
+                if callback:
+                    callback(prog=(i + 1) * 0.6 / page_num, msg="")
         # print("OCR:", timer()-st)
 
-        if not self.is_english and not any(
-                [c for c in self.page_chars]) and self.boxes:
+        if not self.is_english and not has_chars and self.boxes:
             bxes = [b for bxs in self.boxes for b in bxs]
             self.is_english = re.search(r"[\na-zA-Z0-9,/¸;:'\[\]\(\)!@#$%^&*\"?<>._-]{30,}",
                                         "".join([b["text"] for b in random.choices(bxes, k=min(30, len(bxes)))]))
@@ -1022,8 +1106,8 @@ class RAGFlowPdfParser:
 
         self.page_cum_height = np.cumsum(self.page_cum_height)
         assert len(self.page_cum_height) == len(self.page_images) + 1
-        if len(self.boxes) == 0 and zoomin < 9: self.__images__(fnm, zoomin * 3, page_from,
-                                                                page_to, callback)
+        if len(self.boxes) == 0 and zoomin < 9:
+            self.__images__(fnm, zoomin * 3, page_from, page_to, callback)
 
     def __call__(self, fnm, need_image=True, zoomin=3, return_html=False):
         self.__images__(fnm, zoomin)
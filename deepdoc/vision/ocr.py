@@ -304,7 +304,7 @@ class TextRecognizer(object):
 
         return img
 
-    def __call__(self, img_list):
+    def __call__(self, img_list, batch_num=None):
         img_num = len(img_list)
         # Calculate the aspect ratio of all text bars
         width_list = []
@@ -313,7 +313,7 @@ class TextRecognizer(object):
         # Sorting can speed up the recognition process
         indices = np.argsort(np.array(width_list))
         rec_res = [['', 0.0]] * img_num
-        batch_num = self.rec_batch_num
+        batch_num = batch_num if batch_num else self.rec_batch_num
         st = time.time()
 
         for beg_img_no in range(0, img_num, batch_num):
@@ -578,6 +578,16 @@ class OCR(object):
             return ""
         return text
 
+    def recognize_batch(self, img_crops, batch_num=None):
+        """
+        Recognize already cropped text images, sorted by aspect ratio and run
+        `batch_num` at a time. Texts scoring below `drop_score` come back empty.
+        """
+        if not img_crops:
+            return []
+        rec_res, elapse = self.text_recognizer(img_crops, batch_num)
+        return [text if score >= self.drop_score else "" for text, score in rec_res]
+
     def __call__(self, img, cls=True):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
 
@@ -0,0 +1,188 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import math
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pdfplumber
+
+from .ocr import OCR
+from .recognizer import Recognizer
+
+
+def detect_page(ocr, pagenum, img, chars, mean_height, lefted_chars, ZM=3):
+    """
+    Detect the text boxes of a page and fill them from the embedded chars.
+    Chars that fit no box go to `lefted_chars`. Returns the boxes and
+    (box, crop image) pairs for the boxes that still need text recognition,
+    or (None, []) if nothing was detected.
+    """
+    img = np.array(img)
+    bxs = ocr.detect(img)
+    if not bxs:
+        return None, []
+    bxs = [(line[0], line[1][0]) for line in bxs]
+    bxs = Recognizer.sort_Y_firstly(
+        [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
+          "top": b[0][1] / ZM, "text": "", "txt": t,
+          "bottom": b[-1][1] / ZM,
+          "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
+        mean_height / 3
+    )
+
+    # merge chars in the same rect
+    for c in Recognizer.sort_Y_firstly(chars, mean_height // 4):
+        ii = Recognizer.find_overlapped(c, bxs)
+        if ii is None:
+            lefted_chars.append(c)
+            continue
+        ch = c["bottom"] - c["top"]
+        bh = bxs[ii]["bottom"] - bxs[ii]["top"]
+        if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
+            lefted_chars.append(c)
+            continue
+        if c["text"] == " " and bxs[ii]["text"]:
+            if re.match(r"[0-9a-zA-Zа-яА-Я,.?;:!%%]", bxs[ii]["text"][-1]):
+                bxs[ii]["text"] += " "
+        else:
+            bxs[ii]["text"] += c["text"]
+
+    crops = []
+    for b in bxs:
+        if not b["text"]:
+            left, right, top, bott = b["x0"] * ZM, b["x1"] * \
+                                     ZM, b["top"] * ZM, b["bottom"] * ZM
+            crops.append((b, ocr.get_rotate_crop_image(
+                img, np.array([[left, top], [right, top], [right, bott], [left, bott]], dtype=np.float32))))
+    return bxs, crops
+
+
+def ocr_pages(ocr, pages, ZM=3, batch_size=None):
+    """
+    OCR a window of (pagenum, img, chars, mean_height) pages: detection runs
+    per page, then the crops of all pages are recognized in large batches.
+    Returns (boxes, mean_height, lefted_chars) for every page, in order.
+    """
+    detected, crops = [], []
+    for pagenum, img, chars, mean_height in pages:
+        lefted = []
+        bxs, crps = detect_page(ocr, pagenum, img, chars, mean_height, lefted, ZM)
+        detected.append((bxs, lefted))
+        crops.extend(crps)
+
+    texts = ocr.recognize_batch([c for _, c in crops], batch_size)
+    for (b, _), txt in zip(crops, texts):
+        b["text"] = txt
+
+    res = []
+    for (_, _, _, mean_height), (bxs, lefted) in zip(pages, detected):
+        if bxs is None:
+            res.append(([], mean_height, lefted))
+            continue
+        for b in bxs:
+            del b["txt"]
+        bxs = [b for b in bxs if b["text"]]
+        if mean_height == 0:
+            mean_height = np.median([b["bottom"] - b["top"] for b in bxs])
+        res.append((bxs, mean_height, lefted))
+    return res
+
+
+_WORKER_OCR = None
+
+
+def _init_worker():
+    global _WORKER_OCR
+    _WORKER_OCR = OCR()
+
+
+def _render_and_ocr(fnm, page_from, zoomin, pages, batch_pages, batch_size):
+    pdf = pdfplumber.open(fnm) if isinstance(fnm, str) else pdfplumber.open(BytesIO(fnm))
+    res = []
+    try:
+        for b in range(0, len(pages), batch_pages):
+            window = []
+            for i, chars, mean_height in pages[b: b + batch_pages]:
+                img = pdf.pages[page_from + i].to_image(resolution=72 * zoomin).annotated
+                window.append((i + 1, img, chars, mean_height))
+            for (_, img, _, _), r in zip(window, ocr_pages(_WORKER_OCR, window, zoomin, batch_size)):
+                res.append((img,) + r)
+    finally:
+        pdf.close()
+    return res
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _pool(workers):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL._max_workers != workers:
+            if _POOL is not None:
+                _POOL.shutdown(wait=False)
+            # Spawned, not forked: the parent may hold ONNX sessions and threads.
+            _POOL = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker)
+        return _POOL
+
+
+def render_and_ocr(fnm, page_from, zoomin, pages, workers, batch_pages=4, batch_size=None, callback=None):
+    """
+    Render and OCR pages in a pool of `workers` processes, each holding its
+    own OCR sessions. `pages` is a list of (index from page_from, chars,
+    mean_height). Returns (image, boxes, mean_height, lefted_chars) per page,
+    in the order of `pages`.
+    """
+    pool = _pool(workers)
+    tmp, futures = None, []
+    if not isinstance(fnm, str):
+        # Workers open the PDF from a file rather than each receiving a copy of the binary.
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmpf:
+            tmpf.write(fnm)
+        fnm = tmp = tmpf.name
+    try:
+        # Whole windows of batch_pages per worker, so the pages are recognized in the same windows as serially.
+        n = math.ceil(len(pages) / (workers * 2) / batch_pages) * batch_pages
+        futures = [pool.submit(_render_and_ocr, fnm, page_from, zoomin, pages[s: s + n], batch_pages, batch_size)
+                   for s in range(0, len(pages), n)]
+        res = []
+        for f in futures:
+            res.extend(f.result())
+            if callback:
+                callback(prog=len(res) * 0.6 / len(pages), msg="")
+        return res
+    finally:
+        if tmp:
+            # On failure, the pages still running must be done with the file before it goes.
+            for f in futures:
+                f.cancel()
+            for f in futures:
+                if not f.cancelled():
+                    try:
+                        f.result()
+                    except Exception:
+                        pass
+            os.remove(tmp)
@@ -5,10 +5,12 @@ Reference:
  - [graphrag](https://github.com/microsoft/graphrag)
 """
 
+import hashlib
 import json
 import logging
 import os
 import re
+import threading
 import traceback
 from dataclasses import dataclass
 from typing import Any, List, Callable
@@ -19,8 +21,11 @@ from graphrag.community_report_prompt import COMMUNITY_REPORT_PROMPT
 from graphrag.leiden import add_community_info2graph
 from rag.llm.batch_model import BatchModel
 from rag.llm.chat_model import Base as CompletionLLM
-from graphrag.utils import ErrorHandlerFn, perform_variable_replacements, dict_has_keys_with_types,file_cache
+from rag.llm.dispatcher import get_dispatcher, provider_name
+from graphrag.utils import ErrorHandlerFn, perform_variable_replacements, dict_has_keys_with_types
+from rag.settings import COMMUNITY_REPORT_CACHE_TTL
 from rag.utils import num_tokens_from_string
+from rag.utils.redis_conn import REDIS_CONN
 from timeit import default_timer as timer
 
 log = logging.getLogger(__name__)
@@ -52,12 +57,14 @@ class CommunityReportsExtractor:
     ):
         """Init method definition."""
         self._llm = llm_invoker
+        self._dispatcher = get_dispatcher(llm_invoker)
         self._extraction_prompt = extraction_prompt or COMMUNITY_REPORT_PROMPT
         self._on_error = on_error or (lambda _e, _s, _d: None)
         self._max_report_length = max_report_length or 1500
 
-    def build_chat_messages(self,graph:nx.Graph):
-        communities: dict[str, dict[str, List]] = leiden.run(graph, {})
+    def build_chat_messages(self,graph:nx.Graph, communities: dict | None = None):
+        if communities is None:
+            communities: dict[str, dict[str, List]] = leiden.run(graph, {})
         relations_df = pd.DataFrame([{"source":s, "target": t, **attr} for s, t, attr in graph.edges(data=True)])
         result = {}
         for level, comm in communities.items():
@@ -75,36 +82,56 @@ class CommunityReportsExtractor:
                 
         return result
         
-    @file_cache
-    def __call__(self, graph: nx.Graph, callback: Callable | None = None):
-        chat_inputs = self.build_chat_messages(graph)
+    def _cache_keys(self, chat_inputs: dict):
+        """Reports are cached by their prompt, i.e. by the members of the community and their descriptions."""
+        llm = provider_name(self._llm)
+        return {id: "community_report:" + hashlib.md5(f"{llm}\n{text}".encode("utf-8")).hexdigest()
+                for id, (text, _) in chat_inputs.items()}
+
+    def __call__(self, graph: nx.Graph, callback: Callable | None = None, communities: dict | None = None):
+        chat_inputs = self.build_chat_messages(graph, communities)
+        keys = self._cache_keys(chat_inputs)
+        ids = list(chat_inputs.keys())
+        cached = {id: v for id, v in zip(ids, (REDIS_CONN.mget([keys[id] for id in ids]) if ids else None) or []) if v}
+        todo = {id: v for id, v in chat_inputs.items() if id not in cached}
+        log.info(f"community reports: {len(cached)} cached, {len(todo)} to generate")
         token_count = 0
         st = timer()
-        if os.environ.get('BatchMode',"").lower() == "online":
+        if not todo:
+            chat_results = {}
+        elif os.environ.get('BatchMode',"").lower() == "online":
+            lock = threading.Lock()
+
             def online_chat(text):
+                nonlocal token_count
                 try:
-                    response = self._llm.chat(text, [{"role": "user", "content": "Output:"}], {"temperature": 0.3})
-                    nonlocal token_count
-                    token_count += num_tokens_from_string(text + response)
+                    response = self._dispatcher.chat(self._llm, text, [{"role": "user", "content": "Output:"}], {"temperature": 0.3})
                 except Exception as e:
-                    print("ERROR: ", traceback.format_exc())
+                    log.exception("error generating community report")
                     self._on_error(e, traceback.format_exc(), None)
                     return None
+                with lock:
+                    token_count += num_tokens_from_string(text + response)
+                return response
             st = timer()
-            chat_results = {id: online_chat(text) for id,(text,_) in chat_inputs.items()}
+            todo_ids = list(todo.keys())
+            chat_results = dict(zip(todo_ids, self._dispatcher.map(online_chat, [todo[id][0] for id in todo_ids])))
         else:
-            log.info(f"batching community report.id_message cnt:{len(chat_inputs)}")
+            log.info(f"batching community report.id_message cnt:{len(todo)}")
             batch_llm = BatchModel(model_instance = self._llm.mdl)
             chat_results = batch_llm.batch_api_call({id:[{"role":"system","content":text},
                                                          {"role":"user","content":"Output:"}]
-                                                     for id,(text,_) in chat_inputs.items()})
+                                                     for id,(text,_) in todo.items()})
+        fresh = {}
+        chat_results = {**cached, **chat_results}
             
         if callback: 
                 callback(msg=f"batch_mode: {os.environ.get('BatchModel',True)} Communities: {len(chat_inputs)}, elapsed: {timer() - st}s, used tokens: {token_count}")
                 
         res_str,res_dict = [],[]
         for id,response in chat_results.items():
-            response = re.sub(r"^[^\{]*", "", response)
+            raw = response
+            response = re.sub(r"^[^\{]*", "", response or "")
             response = re.sub(r"[^\}]*$", "", response)
             response = re.sub(r'(?<!")\n(?!")','',response)
             response = response.replace("\\'", "'")
@@ -126,11 +153,15 @@ class CommunityReportsExtractor:
                 continue
             response["weight"] = chat_inputs[id][1]["weight"]
             response["entities"] = chat_inputs[id][1]["nodes"]
+            response["community_id"] = id
+            if id not in cached:
+                fresh[keys[id]] = raw
             add_community_info2graph(graph, response["entities"], response["title"])
             res_str.append(self._get_text_output(response))
             res_dict.append(response)
             
             
+        REDIS_CONN.mset(fresh, COMMUNITY_REPORT_CACHE_TTL)
         return CommunityReportsResult(
             structured_output=res_dict,
             output=res_str,
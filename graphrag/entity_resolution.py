@@ -14,12 +14,12 @@
 #  limitations under the License.
 #
 
-import itertools
 import logging
 import os
 import re
 import traceback
-from dataclasses import dataclass
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
 from typing import Any
 
 import networkx as nx
@@ -28,12 +28,55 @@ from rag.nlp import is_english
 import editdistance
 from graphrag.entity_resolution_prompt import ENTITY_RESOLUTION_PROMPT
 from rag.llm.chat_model import Base as CompletionLLM
+from rag.llm.dispatcher import get_dispatcher
 from graphrag.utils import ErrorHandlerFn, english_and_digits_of, perform_variable_replacements,file_cache
 from loguru import logger as log
 
 DEFAULT_RECORD_DELIMITER = "##"
 DEFAULT_ENTITY_INDEX_DELIMITER = "<|>"
 DEFAULT_RESOLUTION_RESULT_DELIMITER = "&&"
+NAME_PATTERN = re.compile(r'([^)\s]+)\(([^)]+)\)')
+
+
+def name_parts(name):
+    """(english name, chinese name) of a `english(chinese)` node name, or None."""
+    m = NAME_PATTERN.search(name)
+    return m.groups() if m else None
+
+
+def similar_names(a, b):
+    return editdistance.eval(a, b) <= min(len(a), len(b)) // 2
+
+
+def candidate_pairs(names):
+    """
+    Index pairs (i, j), i < j, of the names that may satisfy `similar_names`.
+    Within that edit distance, the longer name keeps at least
+    max(len) - min(len) // 2 of its characters (counted with multiplicity),
+    so two such names share one of the len // 2 + 1 globally rarest
+    characters of each: only those prefixes are indexed and probed.
+    """
+    tokens = []
+    freq = Counter()
+    for nm in names:
+        seen = Counter()
+        tks = []
+        for c in nm:
+            tks.append((c, seen[c]))
+            seen[c] += 1
+        tokens.append(tks)
+        freq.update(tks)
+
+    index = defaultdict(list)
+    pairs = set()
+    for i, tks in enumerate(tokens):
+        l = len(tks)
+        for tk in sorted(tks, key=lambda t: (freq[t], t))[:l // 2 + 1]:
+            for j in index[tk]:
+                if abs(l - len(tokens[j])) <= min(l, len(tokens[j])) // 2:
+                    pairs.add((j, i))
+            index[tk].append(i)
+    return pairs
 
 
 @dataclass
@@ -41,6 +84,7 @@ class EntityResolutionResult:
     """Entity resolution result class definition."""
 
     output: nx.Graph
+    merged: dict[str, str] = field(default_factory=dict)
 
 
 class EntityResolution:
@@ -66,6 +110,7 @@ class EntityResolution:
     ):
         """Init method definition."""
         self._llm = llm_invoker
+        self._dispatcher = get_dispatcher(llm_invoker)
         self._resolution_prompt = resolution_prompt or ENTITY_RESOLUTION_PROMPT
         self._on_error = on_error or (lambda _e, _s, _d: None)
         self._record_delimiter_key = record_delimiter_key or "record_delimiter"
@@ -107,8 +152,12 @@ class EntityResolution:
         return chat_messages
                     
     @file_cache
-    def __call__(self, graph: nx.Graph, prompt_variables: dict[str, Any] | None = None) -> EntityResolutionResult:
-        """Call method definition."""
+    def __call__(self, graph: nx.Graph, prompt_variables: dict[str, Any] | None = None,
+                 touched_nodes: set[str] | None = None) -> EntityResolutionResult:
+        """
+        Call method definition. With `touched_nodes`, only the pairs involving
+        one of them are resolved.
+        """
         if prompt_variables is None:
             prompt_variables = {}
 
@@ -135,7 +184,7 @@ class EntityResolution:
 
         candidate_resolution = {}
         for entity_type,nodes in node_clusters.items():
-            similar_pairs = [(a,b) for a,b in itertools.combinations(nodes, 2) if self.is_similarity(a, b)]
+            similar_pairs = self.similar_pairs(nodes, entity_type, touched_nodes)
             if similar_pairs:
                 candidate_resolution[entity_type] = similar_pairs
 
@@ -144,18 +193,22 @@ class EntityResolution:
         chat_id_messages = self.build_chat_messages(candidate_resolution,prompt_variables)
         
         if os.environ.get('BatchMode',"").lower() == "online":
-            for key,(nodes,text) in chat_id_messages.items():
+            def resolve(item):
+                nodes, text = item
                 try:
-                    response = self._llm.chat(text, [{"role": "user", "content": "Output:"}], gen_conf)
+                    response = self._dispatcher.chat(self._llm, text, [{"role": "user", "content": "Output:"}], gen_conf)
                     result = self._process_results(len(nodes), response,
                                                 prompt_variables.get(self._record_delimiter_key,DEFAULT_RECORD_DELIMITER),
                                                 prompt_variables.get(self._entity_index_dilimiter_key,DEFAULT_ENTITY_INDEX_DELIMITER),
                                                 prompt_variables.get(self._resolution_result_delimiter_key,DEFAULT_RESOLUTION_RESULT_DELIMITER))
-                    for result_i in result:
-                        resolution_result.add(nodes[result_i[0] - 1])
+                    return [nodes[result_i[0] - 1] for result_i in result]
                 except Exception as e:
                     logging.exception("error entity resolution")
                     self._on_error(e, traceback.format_exc(), None)
+                    return []
+
+            for pairs in self._dispatcher.map(resolve, chat_id_messages.values()):
+                resolution_result.update(pairs or [])
         else:
             batch_llm = BatchModel(model_instance = self._llm.mdl)
             id_messages = {key:[{"role":"system","content":text},{"role":"user","content":"Output:"}] for key,(_,text) in chat_id_messages.items()}
@@ -171,6 +224,7 @@ class EntityResolution:
                 for result_i in result:
                     resolution_result.add(nodes[result_i[0] - 1])
             
+        merged = {}
         connect_graph = nx.Graph()
         connect_graph.add_edges_from(resolution_result)
         for sub_connect_graph in nx.connected_components(connect_graph):
@@ -199,12 +253,14 @@ class EntityResolution:
                                        source_id="")
                         graph.remove_edge(remove_node, remove_node_neighbor)
                 graph.remove_node(remove_node)
+                merged[remove_node] = keep_node
 
         for node_degree in graph.degree:
             graph.nodes[str(node_degree[0])]["rank"] = int(node_degree[1])
 
         return EntityResolutionResult(
             output=graph,
+            merged=merged,
         )
 
     def _process_results(
@@ -234,20 +290,31 @@ class EntityResolution:
 
         return ans_list
 
+    def similar_pairs(self, nodes, entity_type="", touched=None):
+        """
+        The pairs of `nodes` accepted by `is_similarity`, in the order of
+        `itertools.combinations(nodes, 2)`, without comparing all of them.
+        With `touched`, only the pairs involving one of those nodes.
+        """
+        parsed = [(i, name_parts(n)) for i, n in enumerate(nodes)]
+        parsed = [(i, p) for i, p in parsed if p]
+
+        candidates = set()
+        for k in range(2):
+            candidates |= {(parsed[a][0], parsed[b][0]) for a, b in candidate_pairs([p[k] for _, p in parsed])}
+        if touched is not None:
+            candidates = {(a, b) for a, b in candidates if nodes[a] in touched or nodes[b] in touched}
+        parts = dict(parsed)
+        pairs = [(nodes[a], nodes[b]) for a, b in sorted(candidates)
+                 if any(similar_names(x, y) for x, y in zip(parts[a], parts[b]))]
+
+        total = len(nodes) * (len(nodes) - 1) // 2
+        log.info(f"entity resolution [{entity_type}]: {len(nodes)} nodes, {total - len(candidates)} of {total} pairs pruned, "
+                 f"{len(candidates)} compared, {len(pairs)} similar")
+        return pairs
+
     def is_similarity(self, a, b):
-        pattern = r'([^)\s]+)\(([^)]+)\)'
-        a_find = re.findall(pattern, a)
-        b_find = re.findall(pattern, b)
-        if not a_find or not b_find:
+        a_parts, b_parts = name_parts(a), name_parts(b)
+        if not a_parts or not b_parts:
             return False
-        
-        a_en_name,a_cn_name = a_find[0]
-        b_en_name,b_cn_name = b_find[0]
-        
-        if editdistance.eval(a_en_name,b_en_name) <= min(len(a_en_name), len(b_en_name)) // 2:
-            return True
-
-        if editdistance.eval(a_cn_name,b_cn_name) <= min(len(a_cn_name), len(b_cn_name)) // 2:
-            return True
-              
-        return False
+        return any(similar_names(x, y) for x, y in zip(a_parts, b_parts))
@@ -10,6 +10,8 @@ from api.db.services.document_service import DocumentService
 from rag.nlp import rag_tokenizer, search
 from rag.svr import task_executor
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
+from graphrag.graph_store import GraphStore, diff, import_es_graph, snapshot
 from loguru import logger as log
 
 # 当新增加的节点找不到附着文档时，则从这个文档开始附着
@@ -118,6 +120,9 @@ def process_graph(tenant, kb, nodes_or_links,process_fun):
     """
     先按照 doc_id 分组
     每个 doc_id 内部统处理：增删改查节点和边
+
+    Only the touched nodes and their neighbours are loaded from the graph
+    store, and the edits are written back as a delta.
     """
     grouped_data = defaultdict(list)
     for link in nodes_or_links:
@@ -125,38 +130,27 @@ def process_graph(tenant, kb, nodes_or_links,process_fun):
         grouped_data[doc].append(link)
     
     for doc, doc_links in grouped_data.items():
-        query = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"knowledge_graph_kwd": "graph"}},
-                        {"term": {"kb_id": kb.id}},
-                        {"term": {"doc_id": doc.id}},
-                    ]
-                }
-            }
-        }
-        resp = ELASTICSEARCH.search(query,search.index_name(tenant.id))
-        if not (hits := resp.body['hits']['hits']):
-            raise Exception(f"search:{query} fail!no hits")
-        if len(hits) > 1:
-            hits.sort(key=lambda i:i['_source']['create_timestamp_flt'],reverse=True)
-            log.warning(f"search:{query} fail! {len(hits)}>1 hits")
-        
-        graph_json_str = hits[0]['_source']['content_with_weight']
-        graph_json = json.loads(graph_json_str)
-        graph: nx.Graph = nx.node_link_graph(graph_json)
-        
-        added = []
-        deleted = []
-        for link in doc_links:
-            r = process_fun(graph,link)
-            if isinstance(r,dict):
-                if r.get('added'):
-                    added.append(r['added'])
-                if r.get('deleted'):
-                    deleted.append(r['deleted'])
-                
+        store = GraphStore(kb.id, doc.id)
+        with store.lock():
+            if not import_es_graph(store, tenant.id, kb.id, doc.id):
+                raise Exception(f"graph of doc:{doc.id} in kb:{kb.id} not found!")
+            touched = {x for link in doc_links
+                       for x in ([link['properties'].get('id')] if 'start_node_id' not in link
+                                 else [link['start_node_id'], link['end_node_id']])}
+            graph = store.load(touched)
+            before = snapshot(graph)
+
+            added = []
+            deleted = []
+            for link in doc_links:
+                r = process_fun(graph,link)
+                if isinstance(r,dict):
+                    if r.get('added'):
+                        added.append(r['added'])
+                    if r.get('deleted'):
+                        deleted.append(r['deleted'])
+
+            store.apply(diff(before, graph))
                 
         update_graph(tenant,kb,doc,graph,added,deleted)
         
@@ -178,18 +172,12 @@ def graph_nodes2chunks(graph:nx.Graph, llm_bdl:LLMBundle,added_node_ids):
         }
         chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
         chunks.append(chunk)
-
-    chunks.append(
-        {
-            "content_with_weight": json.dumps(nx.node_link_data(graph), ensure_ascii=False, indent=2),
-            "knowledge_graph_kwd": "graph"
-        })
     return chunks
 
 def update_graph(tenant,kb,doc,graph:nx.Graph,added_ids:list[str],deleted_ids:list[str]):
     """
         当内存图更新时，需要继续更新：
-        1. 图对应的 chunks (包含图的节点chunk,图本身chunk,图的小区chunks,图的mindmap chunk)
+        1. 图对应的 chunks (图的节点chunk; 图本身在 graph store 中以 delta 保存)
         2. 图对应的 Embedding
         3. 图对应的 ES document
         
@@ -209,14 +197,14 @@ def update_graph(tenant,kb,doc,graph:nx.Graph,added_ids:list[str],deleted_ids:li
     log.info(f"embedding {len(cks)} chunks ...")
     tk_count = task_executor.embedding(cks, embd_mdl,callback=callback)
 
-    # TODO : 此处需要探讨下是否删除旧的 entity_chunks 和 graph_chunks? 是否忽略 mindmap (因为mindmap 知识总结了书籍的目录结构),是否忽略小区抽取？
-    query = Q("term", kb_id=kb.id) & Q("term", doc_id=doc.id) & Q("term", knowledge_graph_kwd="graph") | \
-            Q("term", kb_id=kb.id) & Q("term", doc_id=doc.id) & Q("term", knowledge_graph_kwd="entity") & Q("terms", name_kwd=deleted_ids)
+    # TODO : 此处需要探讨下是否忽略 mindmap (因为mindmap 知识总结了书籍的目录结构),是否忽略小区抽取？
+    query = Q("term", kb_id=kb.id) & Q("term", doc_id=doc.id) & Q("term", knowledge_graph_kwd="entity") & Q("terms", name_kwd=deleted_ids)
     log.info(f"es deleteByQuery {query} ...")
     ELASTICSEARCH.deleteByQuery(query, idxnm=search.index_name(tenant.id))
     
     log.info(f"es bulking {len(cks)} chunks ...")
     es_r = ELASTICSEARCH.bulk(cks, search.index_name(tenant))  
+    RETRIEVAL_CACHE.bump(kb.id)
     if es_r:
         raise Exception(f"es bulk fail: {es_r}")
     
@@ -235,4 +223,4 @@ def get_doc(kb_id:str,source_id:str):
         raise ValueError(f"get {len(docs)} document by {doc_name} in kb:{kb_id}!")
     return docs[0]
     
-    
\ No newline at end of file
+    
\ No newline at end of file
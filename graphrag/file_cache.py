@@ -0,0 +1,213 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Memoization of long running graphrag steps, so a failed and retried task
+resumes from the steps it already finished. Results are keyed by a
+structural content hash of the arguments and kept in a size-bounded LRU
+directory on local disk, optionally backed by a store shared between
+task executors (object storage or Redis).
+"""
+import base64
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+
+import networkx as nx
+from loguru import logger as log
+
+from rag import settings
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.storage_factory import STORAGE_IMPL
+
+
+def _json(obj):
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _digest(txt: str) -> int:
+    return int.from_bytes(hashlib.md5(txt.encode("utf-8")).digest(), "big")
+
+
+def _update(h, obj):
+    if isinstance(obj, nx.Graph):
+        # Order independent: the sum of the hashes of the nodes and edges with their attributes.
+        total = 0
+        for n, attrs in obj.nodes(data=True):
+            total += _digest(_json(["n", n, attrs]))
+        for s, t, attrs in obj.edges(data=True):
+            if not obj.is_directed() and str(t) < str(s):
+                s, t = t, s
+            total += _digest(_json(["e", s, t, attrs]))
+        h.update(f"graph:{type(obj).__name__}:{obj.number_of_nodes()}:{obj.number_of_edges()}:".encode("utf-8"))
+        h.update((total % (1 << 128)).to_bytes(16, "big"))
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"list:{len(obj)}:".encode("utf-8"))
+        for o in obj:
+            _update(h, o)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(f"set:{len(obj)}:".encode("utf-8"))
+        for d in sorted(content_hash(o) for o in obj):
+            h.update(d.encode("utf-8"))
+    elif isinstance(obj, dict):
+        h.update(f"dict:{len(obj)}:".encode("utf-8"))
+        for k in sorted(obj, key=str):
+            _update(h, k)
+            _update(h, obj[k])
+    elif isinstance(obj, (str, bytes)):
+        b = obj.encode("utf-8") if isinstance(obj, str) else obj
+        h.update(f"{type(obj).__name__}:{len(b)}:".encode("utf-8"))
+        h.update(b)
+    else:
+        h.update(f"{type(obj).__name__}:{obj!r}".encode("utf-8"))
+
+
+def content_hash(*objs) -> str:
+    """md5 of the content of `objs`; graphs hash their nodes, edges and attributes, in any order."""
+    h = hashlib.md5()
+    for obj in objs:
+        _update(h, obj)
+    return h.hexdigest()
+
+
+class DiskCache:
+    """Files under `path`, the least recently read ones evicted beyond `max_bytes`."""
+
+    def __init__(self, path=settings.FILE_CACHE_DIR, max_bytes=settings.FILE_CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        fnm = self.path / key
+        try:
+            with open(fnm, "rb") as f:
+                binary = f.read()
+            os.utime(fnm)
+            return binary
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, binary):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = self.path / f".{key}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "wb") as f:
+            f.write(binary)
+        os.replace(tmp, self.path / key)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            files = []
+            for fnm in self.path.iterdir():
+                try:
+                    st = fnm.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, fnm))
+            total = sum(size for _, size, _ in files)
+            for _, size, fnm in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                fnm.unlink(missing_ok=True)
+                total -= size
+                log.debug(f"file_cache evicted {fnm}")
+
+
+class StorageCache:
+    """Objects in a bucket of the document storage (MinIO, S3, Azure)."""
+
+    def __init__(self, bucket=settings.FILE_CACHE_BUCKET):
+        self.bucket = bucket
+
+    def get(self, key):
+        if not STORAGE_IMPL.obj_exist(self.bucket, key):
+            return None
+        return STORAGE_IMPL.get(self.bucket, key)
+
+    def put(self, key, binary):
+        STORAGE_IMPL.put(self.bucket, key, binary)
+
+
+class RedisCache:
+
+    def get(self, key):
+        v = REDIS_CONN.get("file_cache:" + key)
+        return base64.b64decode(v) if v else None
+
+    def put(self, key, binary):
+        REDIS_CONN.set("file_cache:" + key, base64.b64encode(binary).decode("ascii"), settings.FILE_CACHE_TTL)
+
+
+LOCAL_CACHE = DiskCache()
+SHARED_CACHE = {"storage": StorageCache, "redis": RedisCache}.get(settings.FILE_CACHE_SHARED, lambda: None)()
+
+
+def _load(binary):
+    ts, ret = pickle.loads(binary)
+    if ts + settings.FILE_CACHE_TTL < time.time():
+        raise KeyError("expired")
+    return ret
+
+
+def file_cache(func):
+    """
+    file_cache 适用于需要长时间执行的函数（例如:超过1分钟,防止失败重试的成本过大，
+    在整个过程中，缓存‘重’函数的执行结果，在失败重启时，可以从上次终端点快速执行。
+
+    file_cache 完全用参数来判断是否读取缓存信息，对于 class method 和 instance method 会自动忽略 cls 和 self参数。
+    使用函数参数的内容 hash 作为缓存的 key（见 `content_hash`），先查本地磁盘，再查共享存储。
+
+    """
+    has_self = 'self' in inspect.signature(func).parameters
+
+    @functools.wraps(func)
+    def decorator(*args, **kwargs):
+        assert len(args) > 0
+        args_for_hash = args[1:] if has_self else args
+        key = f"{func.__module__}.{func.__qualname__}-{content_hash(list(args_for_hash), kwargs)}"
+
+        for cache in [LOCAL_CACHE, SHARED_CACHE]:
+            if cache is None:
+                continue
+            try:
+                binary = cache.get(key)
+                if binary:
+                    ret = _load(binary)
+                    log.debug(f"{func.__module__}.{func.__name__} using cache {type(cache).__name__}:{key}.")
+                    if cache is not LOCAL_CACHE:
+                        LOCAL_CACHE.put(key, binary)
+                    return ret
+            except Exception as e:
+                log.debug(f"file_cache {type(cache).__name__}:{key} unusable: {e}")
+
+        ret = func(*args, **kwargs)
+        binary = pickle.dumps((time.time(), ret))
+        for cache in [LOCAL_CACHE, SHARED_CACHE]:
+            if cache is None:
+                continue
+            try:
+                cache.put(key, binary)
+            except Exception as e:
+                log.warning(f"file_cache {type(cache).__name__}:{key} put fail: {e}")
+        log.debug(f"{func.__module__}.{func.__name__} result cached as {key}.")
+        return ret
+    return decorator
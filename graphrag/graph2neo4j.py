@@ -1,23 +1,85 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import json
 from typing import List
 import time
 import fire
 from graphrag.db import driver
+from graphrag.graph_store import GraphStore
 import networkx as nx
 from loguru import logger as log
+from rag.settings import NEO4J_SYNC_BATCH, NEO4J_SYNC_CONCURRENCY
 from rag.utils.es_conn import ELASTICSEARCH
-from graphrag.utils import escape, file_cache
+from graphrag.utils import file_cache
 
 @file_cache
 def graph2neo4j(graph: nx.Graph, nodeLabel_attr: List[str] = ['entity_type']):
-    do_graph2neo4j(graph,nodeLabel_attr)
-    
+    return do_graph2neo4j(graph,nodeLabel_attr)
+
+
+def node_labels(attrs: dict, nodeLabel_attr: List[str]):
+    return tuple(f"`{str(attrs[attr]).replace('`', '``')}`" for attr in nodeLabel_attr if attrs.get(attr))
+
+
+def label_str(labels):
+    return "".join(":" + label for label in labels)
+
+
+def neo4j_value(v):
+    """Neo4j properties are primitives or lists of them; anything else is stored as JSON."""
+    if v is None or isinstance(v, (str, bool, int, float)):
+        return v
+    if isinstance(v, (list, tuple)) and all(isinstance(i, (str, bool, int, float)) for i in v):
+        return list(v)
+    return json.dumps(v, ensure_ascii=False, default=str)
+
+
+_INDEXED_LABELS = set()
+
+
+def ensure_id_indexes(labels):
+    """A unique constraint on `id` per label, or a plain index if existing duplicates forbid it."""
+    with driver.session() as session:
+        for label in labels:
+            if label in _INDEXED_LABELS:
+                continue
+            try:
+                session.run(f"CREATE CONSTRAINT IF NOT EXISTS FOR (n:{label}) REQUIRE n.id IS UNIQUE").consume()
+            except Exception as e:
+                log.warning(f"unique id constraint on {label} failed, creating an index instead: {e}")
+                session.run(f"CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.id)").consume()
+            _INDEXED_LABELS.add(label)
+
+
+def _run_batches(jobs):
+    """Runs (cypher, rows) jobs on a pool of sessions, each batch in its own retried write transaction."""
+    def run(job):
+        cypher, rows = job
+        with driver.session() as session:
+            return session.execute_write(lambda tx: tx.run(cypher, rows=rows).consume().counters)
+
+    created = {"nodes_created": 0, "relationships_created": 0, "properties_set": 0}
+    with ThreadPoolExecutor(max_workers=NEO4J_SYNC_CONCURRENCY) as exe:
+        for counters in exe.map(run, jobs):
+            for k in created:
+                created[k] += getattr(counters, k)
+    return created
+
+
+def _batches(rows, size):
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
 def do_graph2neo4j(graph: nx.Graph, nodeLabel_attr: List[str] = ['entity_type']):
     """
     将当前的 python 里的 nx.Graph 里的数据同步到 neo4j ;
     确保节点的属性和关系的属性全部同步过去,节点的属性和关系的属性schema是未知的;
     如果和 neo4j 中现有的 node 和 relation 有冲突，则要融合进现有的节点。
+
+    Nodes are grouped by label and edges by the labels of their ends, and
+    each group is sent as parameterized `UNWIND $rows` batches, so the
+    statements are planned once and the MERGE/MATCH on `id` use the label
+    indexes. Returns the sync statistics.
     """
     if not nodeLabel_attr:
         log.error("nodeLabel_attr shouldn't be empty")
@@ -25,68 +87,42 @@ def do_graph2neo4j(graph: nx.Graph, nodeLabel_attr: List[str] = ['entity_type'])
     if not graph:
         log.error("graph shouldn't be None")
         return
-    
-    def quota_escape(v):
-        if isinstance(v, str):
-            return "'" + escape(v) + "'"
-        return v
-    
-    with driver.session() as session:
-        # 批量创建或融合节点
-        node_queries = []
-        nodes_dict = defaultdict(int)
-        for node, attrs in graph.nodes(data=True):
-            labels = [f':`{escape(attrs[attr])}`' for attr in nodeLabel_attr if attrs.get(attr)]
-            label_str = "".join(labels) if labels else ''
-            nodes_dict[label_str] += 1
-            node_properties = ', '.join([f"{k}: {quota_escape(v)}" for k, v in attrs.items()])
-            node_queries.append(f"""
-                MERGE (n{label_str} {{id: {quota_escape(node)}}})
-                ON CREATE SET n += {{{node_properties}}}
-                ON MATCH SET n += {{{node_properties}}}
-            """)
-        log.info(f"importing nodes {nodes_dict}.")
-        # 批量创建或融合边
-        edge_queries = []
-        for source, target, attrs in graph.edges(data=True):
-            
-            edge_properties = ', '.join([f"{k}: {quota_escape(v)}" for k, v in attrs.items()])
-            edge_queries.append(f"""
-                MATCH (a {{id: {quota_escape(source)}}}), (b {{id: {quota_escape(target)}}})
-                MERGE (a)-[r:CONNECTED_TO]-(b)
-                ON CREATE SET r += {{{edge_properties}}}
-                ON MATCH SET r += {{{edge_properties}}}
-            """)
-
-        BATCH_SIZE = 32
-        start = time.time()
-        # 执行节点的批量
-        if node_queries:
-            log.info(f"importing {len(node_queries)} nodes to neo4j")
-            batchs = [node_queries[i:i + BATCH_SIZE] for i in range(0, len(node_queries), BATCH_SIZE)]
-            for batch in batchs:
-                node_query_string = "CALL() { " + " UNION ALL ".join(batch) + " } RETURN 1"
-                result = session.run(node_query_string)
-                summary = result.consume()
-                log.info(f"{summary.counters.nodes_created} nodes created,{summary.counters.relationships_created} edges created,{summary.counters.properties_set} properties set,{summary.result_available_after/1000:.2f} s")
-
-        log.info(f"{len(node_queries)} nodes imported to neo4j, last:{time.time()-start:.2f}s")
-        
-        start = time.time()
-        # 执行边的批量
-        if edge_queries:
-            log.info(f"importing {len(edge_queries)} edges to neo4j")
-            batchs = [edge_queries[i:i + BATCH_SIZE] for i in range(0, len(edge_queries), BATCH_SIZE)]
-            for batch in batchs:
-                edge_query_string = "CALL() { " + " UNION ALL ".join(batch) + " } RETURN 1"
-                result = session.run(edge_query_string)
-                summary = result.consume()
-                log.info(f"{summary.counters.nodes_created} nodes created,{summary.counters.relationships_created} edges created,{summary.counters.properties_set} properties set,{summary.result_available_after/1000:.2f} s")
-            
-        log.info(f"{len(edge_queries)} edges imported to neo4j, last:{time.time()-start:.2f}s")
-        
-        # session 不会主动关闭，需要手动关闭
-        driver.close()
+
+    labels = {}
+    node_rows = defaultdict(list)
+    for node, attrs in graph.nodes(data=True):
+        labels[node] = node_labels(attrs, nodeLabel_attr)
+        node_rows[labels[node]].append({"id": node, "props": {k: neo4j_value(v) for k, v in attrs.items()}})
+    edge_rows = defaultdict(list)
+    for source, target, attrs in graph.edges(data=True):
+        edge_rows[(labels[source], labels[target])].append(
+            {"source": source, "target": target, "props": {k: neo4j_value(v) for k, v in attrs.items()}})
+    log.info(f"importing nodes { {label_str(k): len(v) for k, v in node_rows.items()} }.")
+
+    ensure_id_indexes({label for lbs in node_rows.keys() for label in lbs})
+    stats = {"nodes": graph.number_of_nodes(), "edges": graph.number_of_edges()}
+
+    start = time.time()
+    jobs = [(f"UNWIND $rows AS row MERGE (n{label_str(lbs)} {{id: row.id}}) SET n += row.props", rows)
+            for lbs, rows in node_rows.items() for rows in _batches(rows, NEO4J_SYNC_BATCH)]
+    stats.update(_run_batches(jobs))
+    stats["node_seconds"] = time.time() - start
+    log.info(f"{stats['nodes']} nodes imported to neo4j in {len(jobs)} batches, "
+             f"{stats['nodes'] / max(stats['node_seconds'], 1e-6):.0f} nodes/s, last:{stats['node_seconds']:.2f}s")
+
+    start = time.time()
+    jobs = [(f"UNWIND $rows AS row MATCH (a{label_str(la)} {{id: row.source}}) MATCH (b{label_str(lb)} {{id: row.target}}) "
+             "MERGE (a)-[r:CONNECTED_TO]-(b) SET r += row.props", rows)
+            for (la, lb), rows in edge_rows.items() for rows in _batches(rows, NEO4J_SYNC_BATCH)]
+    for k, v in _run_batches(jobs).items():
+        stats[k] += v
+    stats["edge_seconds"] = time.time() - start
+    log.info(f"{stats['edges']} edges imported to neo4j in {len(jobs)} batches, "
+             f"{stats['edges'] / max(stats['edge_seconds'], 1e-6):.0f} edges/s, last:{stats['edge_seconds']:.2f}s")
+    log.info(f"{stats['nodes_created']} nodes created,{stats['relationships_created']} edges created,"
+             f"{stats['properties_set']} properties set")
+    return stats
+
 
 def sync(index:str="ragflow_7d19a176807611efb0f80242ac120006",
          kb_id:str="fb7c4312973b11ef88ed0242ac120006",
@@ -133,10 +169,13 @@ def sync(index:str="ragflow_7d19a176807611efb0f80242ac120006",
     
     for hits in ELASTICSEARCH.scrollIter(q=query):
         for hit in hits:
-            log.info(f"processing graph of doc:{hit['_source']['docnm_kwd']}")
-            graph_json = hit['_source']['content_with_weight']
-            node_link_data = json.loads(graph_json)
-            graph = nx.node_link_graph(node_link_data)
+            src = hit['_source']
+            log.info(f"processing graph of doc:{src['docnm_kwd']}")
+            store = GraphStore(src['kb_id'], src['doc_id'])
+            if store.is_current(src.get('create_timestamp_flt')):
+                graph = store.load()
+            else:
+                graph = nx.node_link_graph(json.loads(src['content_with_weight']))
             
             if uisng_cache:
                 graph2neo4j(graph)
@@ -7,9 +7,8 @@ Reference:
 
 import logging
 import numbers
-import random
-import time
 import re
+import threading
 import traceback
 from dataclasses import dataclass
 from typing import Any, Mapping, Callable
@@ -18,6 +17,7 @@ from graphrag import prompt_messages
 from graphrag.graph_prompt import GRAPH_EXTRACTION_PROMPT, CONTINUE_PROMPT, LOOP_PROMPT
 from graphrag.utils import ErrorHandlerFn, full_to_half, perform_variable_replacements, clean_str
 from rag.llm.chat_model import Base as CompletionLLM
+from rag.llm.dispatcher import get_dispatcher
 import networkx as nx
 from rag.utils import build_sub_texts_2d, num_tokens_from_string
 from timeit import default_timer as timer
@@ -73,6 +73,7 @@ class GraphExtractor:
         """Init method definition."""
         # TODO: streamline construction
         self._llm = llm_invoker
+        self._dispatcher = get_dispatcher(llm_invoker)
         self._join_descriptions = join_descriptions
         self._input_text_key = input_text_key or "input_text"
         self._tuple_delimiter_key = tuple_delimiter_key or "tuple_delimiter"
@@ -116,7 +117,6 @@ class GraphExtractor:
         self, texts: list[str],
             prompt_variables: dict[str, Any] | None = None,
             callback: Callable | None = None,
-            retry_cnt:int = 3
     ) -> GraphExtractionResult:
         """Call method definition."""
         if prompt_variables is None:
@@ -138,34 +138,38 @@ class GraphExtractor:
         st = timer()
         total = len(texts)
         total_token_count = 0
-        for doc_index, text in enumerate(texts):
-            left_cnt = retry_cnt
-            while left_cnt > 0:
-                try:
-                    # Invoke the entity extraction
-                    result, token_count = self._process_document(text, prompt_variables)
-                    source_doc_map[doc_index] = text
-                    all_records[doc_index] = result
-                    total_token_count += token_count
-                    if callback: callback(msg=f"{doc_index+1}/{total}, elapsed: {timer() - st}s, used tokens: {total_token_count}")
-                    time.sleep(random.random())
-                    break
-                except Exception as e:
-                    if callback: callback(msg="Knowledge graph extraction error:{}".format(str(e)))
-                    logging.exception("error extracting graph")
-                    self._on_error(
-                        e,
-                        traceback.format_exc(),
-                        {
-                            "doc_index": doc_index,
-                            "text": text,
-                        },
-                    )
-                finally:
-                    left_cnt -= 1
+        done = 0
+        lock = threading.Lock()
+
+        def extract(doc_index):
+            nonlocal total_token_count, done
+            text = texts[doc_index]
+            try:
+                # Invoke the entity extraction
+                result, token_count = self._process_document(text, prompt_variables)
+            except Exception as e:
+                if callback: callback(msg="Knowledge graph extraction error:{}".format(str(e)))
+                logging.exception("error extracting graph")
+                self._on_error(
+                    e,
+                    traceback.format_exc(),
+                    {
+                        "doc_index": doc_index,
+                        "text": text,
+                    },
+                )
+                return
+            with lock:
+                source_doc_map[doc_index] = text
+                all_records[doc_index] = result
+                total_token_count += token_count
+                done += 1
+                if callback: callback(msg=f"{done}/{total}, elapsed: {timer() - st}s, used tokens: {total_token_count}")
+
+        self._dispatcher.map(extract, range(total))
 
         output = self._process_results(
-            all_records,
+            dict(sorted(all_records.items())),
             prompt_variables.get(self._tuple_delimiter_key, DEFAULT_TUPLE_DELIMITER),
             prompt_variables.get(self._record_delimiter_key, DEFAULT_RECORD_DELIMITER),
         )
@@ -188,8 +192,7 @@ class GraphExtractor:
             "temperature": 0.3,
             "max_tokens": 40960
         }
-        response = self._llm.chat(text, [{"role": "user", "content": "Output:"}], gen_conf)
-        if response.find("**ERROR**") >=0: raise Exception(response)
+        response = self._dispatcher.chat(self._llm, text, [{"role": "user", "content": "Output:"}], gen_conf)
         token_count = num_tokens_from_string(text + response)
 
         results = response or ""
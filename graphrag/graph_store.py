@@ -0,0 +1,282 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Versioned storage of a document's knowledge graph in object storage. A
+version is a set of node and edge tables split into hash shards by node id,
+so the neighbourhood of a few nodes is loaded without reading the whole
+graph. Edits are appended as small delta files on top of the version, and
+folded into a new version once there are too many of them.
+"""
+import json
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+
+import networkx as nx
+import ormsgpack
+from loguru import logger as log
+
+from rag import settings
+from rag.nlp import search
+from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.storage_factory import STORAGE_IMPL
+
+
+def _columns(rows, keys):
+    """Row dicts to {column: [values]}; attributes a row lacks are None."""
+    attrs = sorted({k for r in rows for k in r} - set(keys))
+    return {c: [r.get(c) for r in rows] for c in list(keys) + attrs}
+
+
+def _rows(table, keys):
+    n = len(table[keys[0]]) if table else 0
+    attrs = [c for c in table if c not in keys]
+    for i in range(n):
+        yield [table[k][i] for k in keys], {c: table[c][i] for c in attrs if table[c][i] is not None}
+
+
+class GraphStore:
+    """A graph stored under `graph/<name>/` in `bucket`, see the module docstring."""
+
+    def __init__(self, bucket: str, name: str, shards: int = settings.GRAPH_STORE_SHARDS):
+        self.bucket = bucket
+        self.prefix = f"graph/{name}/"
+        self.shards = shards
+        self._manifest = None
+
+    def _get(self, fnm):
+        binary = STORAGE_IMPL.get(self.bucket, self.prefix + fnm)
+        if not binary:
+            raise FileNotFoundError(f"{self.bucket}/{self.prefix}{fnm}")
+        return ormsgpack.unpackb(zlib.decompress(binary))
+
+    def _put(self, fnm, obj):
+        STORAGE_IMPL.put(self.bucket, self.prefix + fnm, zlib.compress(ormsgpack.packb(obj)))
+
+    def manifest(self):
+        if self._manifest is None and STORAGE_IMPL.obj_exist(self.bucket, self.prefix + "manifest.json"):
+            self._manifest = json.loads(STORAGE_IMPL.get(self.bucket, self.prefix + "manifest.json"))
+        return self._manifest
+
+    def _put_manifest(self, manifest):
+        STORAGE_IMPL.put(self.bucket, self.prefix + "manifest.json", json.dumps(manifest).encode("utf-8"))
+        self._manifest = manifest
+
+    def is_current(self, base_ts):
+        """Whether the store was imported from the graph chunk created at `base_ts`."""
+        manifest = self.manifest()
+        return bool(manifest) and manifest.get("base_ts") == base_ts
+
+    def shard(self, node_id):
+        return zlib.crc32(str(node_id).encode("utf-8")) % self.manifest()["shards"]
+
+    @contextmanager
+    def lock(self, timeout=600):
+        """Serializes the writers of the graph across processes; the manifest is re-read inside."""
+        self._manifest = None
+        if not REDIS_CONN.is_alive():
+            log.warning(f"redis unavailable, writing graph {self.bucket}/{self.prefix} without lock")
+            yield
+            return
+        with REDIS_CONN.REDIS.lock(f"graph_store_lock:{self.bucket}:{self.prefix}", timeout=timeout,
+                                   blocking_timeout=timeout):
+            yield
+
+    def save(self, graph: nx.Graph, base_ts: float | None = None):
+        """Writes `graph` as a new version, dropping the deltas of the previous one."""
+        old = self.manifest()
+        version = old["version"] + 1 if old else 1
+        nodes, edges = defaultdict(list), defaultdict(list)
+        for n, attrs in graph.nodes(data=True):
+            nodes[zlib.crc32(str(n).encode("utf-8")) % self.shards].append({"id": n, **attrs})
+        for u, v, attrs in graph.edges(data=True):
+            row = {"source": u, "target": v, **attrs}
+            su, sv = [zlib.crc32(str(x).encode("utf-8")) % self.shards for x in (u, v)]
+            edges[su].append(row)
+            if sv != su:
+                edges[sv].append(row)
+        for i in range(self.shards):
+            self._put(f"v{version}/nodes-{i}", _columns(nodes[i], ["id"]))
+            self._put(f"v{version}/edges-{i}", _columns(edges[i], ["source", "target"]))
+
+        # The files of the replaced version are kept for one more version, for
+        # readers that listed them before this manifest was written.
+        previous = {k: old[k] for k in ["version", "shards", "deltas"]} if old else None
+        self._put_manifest({"version": version, "shards": self.shards, "deltas": [], "previous": previous,
+                            "base_ts": base_ts if base_ts is not None else (old or {}).get("base_ts")})
+        if old and old.get("previous"):
+            self._remove(old["previous"])
+
+    def _remove(self, manifest):
+        v = manifest["version"]
+        for i in range(manifest["shards"]):
+            STORAGE_IMPL.rm(self.bucket, f"{self.prefix}v{v}/nodes-{i}")
+            STORAGE_IMPL.rm(self.bucket, f"{self.prefix}v{v}/edges-{i}")
+        for fnm in manifest["deltas"]:
+            STORAGE_IMPL.rm(self.bucket, self.prefix + fnm)
+
+    def apply(self, ops: list):
+        """
+        Appends a delta of ops: ["add_node", id, attrs], ["update_node", id,
+        attrs], ["remove_node", id], ["add_edge", u, v, attrs], ["update_edge",
+        u, v, attrs], ["remove_edge", u, v]. Call under `lock`.
+        """
+        if not ops:
+            return
+        manifest = dict(self.manifest())
+        fnm = "v{}/delta-{}".format(manifest["version"], len(manifest["deltas"]))
+        self._put(fnm, ops)
+        manifest["deltas"] = manifest["deltas"] + [fnm]
+        self._put_manifest(manifest)
+        if len(manifest["deltas"]) >= settings.GRAPH_STORE_MAX_DELTAS:
+            log.info(f"compacting graph {self.bucket}/{self.prefix}, {len(manifest['deltas'])} deltas")
+            self.save(self.load())
+
+    def load(self, nodes=None, retries=3) -> nx.Graph:
+        """
+        The whole graph, or with `nodes` only those nodes, their neighbours
+        and the edges incident to them. Readers don't lock: when the version
+        read was replaced twice meanwhile, the new manifest is read again.
+        """
+        for i in range(retries):
+            try:
+                return self._load(self.manifest(), nodes)
+            except FileNotFoundError:
+                if i + 1 == retries:
+                    raise
+                log.info(f"graph {self.bucket}/{self.prefix} changed while loading, retrying")
+                self._manifest = None
+
+    def _load(self, manifest, nodes=None) -> nx.Graph:
+        ops = [op for fnm in manifest["deltas"] for op in self._get(fnm)]
+        v = manifest["version"]
+        if nodes is None:
+            node_shards = edge_shards = range(manifest["shards"])
+            wanted = None
+        else:
+            wanted = set(nodes)
+            edge_shards = {self.shard(n) for n in wanted}
+
+        edges = []
+        for i in edge_shards:
+            for (u, t), attrs in _rows(self._get(f"v{v}/edges-{i}"), ["source", "target"]):
+                if wanted is None or u in wanted or t in wanted:
+                    edges.append((u, t, attrs))
+        if wanted is not None:
+            keep = set(wanted)
+            keep.update(x for u, t, _ in edges for x in (u, t))
+            keep.update(x for op in ops if op[0] == "add_edge" and wanted.intersection(op[1:3]) for x in op[1:3])
+            node_shards = {self.shard(n) for n in keep}
+
+        graph = nx.Graph()
+        for i in node_shards:
+            for (n,), attrs in _rows(self._get(f"v{v}/nodes-{i}"), ["id"]):
+                if wanted is None or n in keep:
+                    graph.add_node(n, **attrs)
+        graph.add_edges_from(edges)
+
+        for op in ops:
+            if op[0] == "add_node":
+                if wanted is None or op[1] in keep:
+                    graph.add_node(op[1], **op[2])
+            elif op[0] == "update_node":
+                if graph.has_node(op[1]):
+                    graph.nodes[op[1]].update(op[2])
+            elif op[0] == "remove_node":
+                if graph.has_node(op[1]):
+                    graph.remove_node(op[1])
+            elif op[0] == "add_edge":
+                if wanted is None or wanted.intersection(op[1:3]):
+                    graph.add_edge(op[1], op[2], **op[3])
+            elif op[0] == "update_edge":
+                if graph.has_edge(op[1], op[2]):
+                    graph[op[1]][op[2]].update(op[3])
+            elif op[0] == "remove_edge":
+                if graph.has_edge(op[1], op[2]):
+                    graph.remove_edge(op[1], op[2])
+        return graph
+
+
+def snapshot(graph: nx.Graph):
+    return ({n: dict(a) for n, a in graph.nodes(data=True)},
+            {(u, v): dict(a) for u, v, a in graph.edges(data=True)})
+
+
+def diff(before, graph: nx.Graph):
+    """The ops turning the `snapshot` `before` into `graph`."""
+    nodes, edges = before
+    ops = [["remove_node", n] for n in nodes if not graph.has_node(n)]
+    for n, attrs in graph.nodes(data=True):
+        if n not in nodes:
+            ops.append(["add_node", n, dict(attrs)])
+        elif attrs != nodes[n]:
+            ops.append(["update_node", n, dict(attrs)])
+    ops.extend(["remove_edge", u, v] for u, v in edges if graph.has_node(u) and graph.has_node(v)
+               and not graph.has_edge(u, v))
+    for u, v, attrs in graph.edges(data=True):
+        old = edges.get((u, v), edges.get((v, u)))
+        if old is None:
+            ops.append(["add_edge", u, v, dict(attrs)])
+        elif attrs != old:
+            ops.append(["update_edge", u, v, dict(attrs)])
+    return ops
+
+
+def _es_graph(tenant_id, kb_id, doc_id, source=True):
+    query = {"query": {"bool": {"must": [{"term": {"knowledge_graph_kwd": "graph"}},
+                                         {"term": {"kb_id": kb_id}},
+                                         {"term": {"doc_id": doc_id}}]}},
+             "_source": True if source else ["create_timestamp_flt"]}
+    hits = ELASTICSEARCH.search(query, search.index_name(tenant_id)).body["hits"]["hits"]
+    if not hits:
+        return None
+    if len(hits) > 1:
+        hits.sort(key=lambda i: i["_source"].get("create_timestamp_flt", 0), reverse=True)
+        log.warning(f"{len(hits)} graphs of doc:{doc_id} in kb:{kb_id}")
+    return hits[0]["_source"]
+
+
+def import_es_graph(store: GraphStore, tenant_id, kb_id, doc_id):
+    """
+    (Re-)imports a document's graph from its Elasticsearch graph chunk when
+    the store is missing or older than the chunk, i.e. the document was
+    parsed again. Returns False if the document has no graph. Call under
+    `store.lock()`.
+    """
+    src = _es_graph(tenant_id, kb_id, doc_id, source=False)
+    if not src:
+        return False
+    if store.is_current(src.get("create_timestamp_flt")):
+        return True
+    src = _es_graph(tenant_id, kb_id, doc_id)
+    log.info(f"importing graph of doc:{doc_id} in kb:{kb_id} into the graph store")
+    store.save(nx.node_link_graph(json.loads(src["content_with_weight"])), src.get("create_timestamp_flt"))
+    return True
+
+
+def stored_doc_graph(tenant_id, kb_id, doc_id, nodes=None):
+    """
+    The graph of a document with its edits (see `GraphStore.load`), or None
+    when it was never edited since parsing and the graph chunk is current.
+    """
+    store = GraphStore(kb_id, doc_id)
+    if not store.manifest():
+        return None
+    src = _es_graph(tenant_id, kb_id, doc_id, source=False)
+    if not src or not store.is_current(src.get("create_timestamp_flt")):
+        return None
+    return store.load(nodes)
@@ -15,6 +15,7 @@
 #
 import json
 import os
+from contextlib import nullcontext
 from functools import reduce
 from typing import List
 
@@ -28,13 +29,19 @@ from graphrag.community_reports_extractor import CommunityReportsExtractor
 from graphrag.entity_resolution import EntityResolution
 from graphrag.graph2neo4j import graph2neo4j
 from graphrag.graph_extractor import GraphExtractor
+from graphrag.kb_graph import kb_graph_lock, kb_graph_version, load_kb_graph, save_kb_graph, put_doc, doc_entities, \
+    resolve, merge_aliases, recompute_communities, drop_community_titles, communities_by_level, community_kwd, \
+    kb_graph_doc_id, entity_chunk_id, report_chunk_id, add_retired
 from graphrag.mind_map_extractor import MindMapExtractor
 from graphrag.prompt_messages import DEFAULT_TUPLE_DELIMITER, DEFAULT_RECORD_DELIMITER, DEFAULT_TUPLE_DELIMITER_KEY, DEFAULT_RECORD_DELIMITER_KEY
 from rag.llm.batch_model import BatchModel
+from rag.llm.dispatcher import get_dispatcher
 from rag.nlp import rag_tokenizer
 from rag.utils import build_sub_texts_2d
 from loguru import logger as log
 
+MERGE_ATTEMPTS = 3
+
 
 def graph_merge(g1, g2):
     g = g2.copy()
@@ -58,10 +65,10 @@ def graph_merge(g1, g2):
     return g
 
     
-def graph2chunks(graph:nx.Graph, llm_bdl:LLMBundle,callback):
+def entities2chunks(graph:nx.Graph, nodes=None):
     chunks = []
     ignore_nodes = []
-    for n, attr in graph.nodes(data=True):
+    for n, attr in graph.subgraph(nodes).nodes(data=True) if nodes is not None else graph.nodes(data=True):
         if attr.get("rank", 0) == 0:
             ignore_nodes.append(n)
             continue
@@ -79,7 +86,11 @@ def graph2chunks(graph:nx.Graph, llm_bdl:LLMBundle,callback):
         chunks.append(chunk)
                 
     log.info(f"graph2chunks ignore rank==0 {len(ignore_nodes)}/{len(graph.nodes(data=True))} entities,{ignore_nodes}")
+    return chunks
+
 
+def graph2chunks(graph:nx.Graph, llm_bdl:LLMBundle,callback):
+    chunks = entities2chunks(graph)
     chunks.append(
         {
             "content_with_weight": json.dumps(nx.node_link_data(graph), ensure_ascii=False, indent=2),
@@ -87,25 +98,122 @@ def graph2chunks(graph:nx.Graph, llm_bdl:LLMBundle,callback):
         })
     return chunks
 
+def community2chunk(community: dict, desc: str):
+    chunk = {
+        "title_tks": rag_tokenizer.tokenize(community["title"]),
+        "content_with_weight": desc,
+        "content_ltks": rag_tokenizer.tokenize(desc),
+        "knowledge_graph_kwd": "community_report",
+        "weight_flt": community["weight"],
+        "entities_kwd": community["entities"],
+        "important_kwd": community["entities"],
+        "community_kwd": community["community_id"]
+    }
+    chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
+    return chunk
+
 def build_commnity2chunks(graph:nx.Graph, llm_bdl:LLMBundle,callback):
-    chunks = []
     callback(0.6, "Extracting community reports.")
     cr = CommunityReportsExtractor(llm_bdl)
     cr = cr(graph, callback=callback)
-    for community, desc in zip(cr.structured_output, cr.output):
-        chunk = {
-            "title_tks": rag_tokenizer.tokenize(community["title"]),
-            "content_with_weight": desc,
-            "content_ltks": rag_tokenizer.tokenize(desc),
-            "knowledge_graph_kwd": "community_report",
-            "weight_flt": community["weight"],
-            "entities_kwd": community["entities"],
-            "important_kwd": community["entities"]
-        }
-        chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
-        chunks.append(chunk)
-    return chunks
-    
+    return [community2chunk(community, desc) for community, desc in zip(cr.structured_output, cr.output)]
+
+
+def _merge_doc(kb: dict, kb_id: str, doc_id: str, graph: nx.Graph, llm_bdl: LLMBundle, callback, reports: dict):
+    """
+    Puts the document's graph into `kb` in place of its previous one and runs
+    entity resolution, Leiden and the community reports over what changed.
+    `reports` caches the reports across attempts by community id.
+    Returns the entities re-indexed, the chunks to index and the index entries
+    they make obsolete.
+    """
+    touched, removed_nodes = put_doc(kb, doc_id, graph)
+    kb_graph = kb["graph"]
+    doc_nodes = {resolve(kb["aliases"], n) for n in graph.nodes} & set(kb_graph.nodes)
+
+    callback(0.5, "Extracting entities.")
+    er = EntityResolution(llm_bdl)(kb_graph.copy(), touched_nodes=doc_nodes)
+    removed_nodes |= merge_aliases(kb, er.merged)
+    touched |= set(er.merged.keys()) | set(er.merged.values())
+
+    old_communities = kb["communities"]
+    communities, added, removed = recompute_communities(kb_graph, old_communities, touched)
+    kb["communities"] = communities
+    drop_community_titles(kb, old_communities, removed)
+
+    # Communities left without a report by a document deletion or a failed extraction get one too.
+    todo = [cid for cid, comm in communities.items() if not comm.get("title") and cid not in reports]
+    if todo:
+        callback(0.6, "Extracting community reports.")
+        cr = CommunityReportsExtractor(llm_bdl)(kb_graph, callback=callback,
+                                                communities=communities_by_level(communities, todo))
+        for community, desc in zip(cr.structured_output, cr.output):
+            reports[community["community_id"].split("-", 2)[2]] = (community, desc)
+    community_chunks = []
+    for cid, comm in communities.items():
+        if cid not in reports or comm.get("title"):
+            continue
+        community, desc = reports[cid]
+        comm["title"] = community["title"]
+        chunk = community2chunk(community, desc)
+        chunk["_id"] = report_chunk_id(kb_id, chunk["community_kwd"])
+        community_chunks.append(chunk)
+
+    entities = {n for n in touched | set(kb["stale"]) if n in kb_graph}
+    kb["stale"] = []
+    entity_chunks = entities2chunks(kb_graph, entities)
+    for chunk in entity_chunks:
+        chunk["_id"] = entity_chunk_id(kb_id, chunk["name_kwd"])
+    for chunk in entity_chunks + community_chunks:
+        chunk["doc_id"] = kb_graph_doc_id(kb_id)
+
+    indexed = {c["_id"] for c in entity_chunks}
+    retired = [entity_chunk_id(kb_id, n) for n in (touched | removed_nodes)] + \
+              [report_chunk_id(kb_id, community_kwd(old_communities, cid)) for cid in removed]
+    log.info(f"kb:{kb_id} graph: {len(kb_graph.nodes)} entities, {len(touched)} touched, {len(er.merged)} merged, "
+             f"{len(community_chunks)} community reports regenerated, {len(removed)} dropped")
+    return entities, entity_chunks + community_chunks, [i for i in retired if i not in indexed]
+
+
+def merge2kb_graph(tenant_id: str, kb_id: str, doc_id: str, graph: nx.Graph, llm_bdl: LLMBundle, callback):
+    """
+    Merges the graph extracted from one document into the persistent graph of
+    its knowledge base, replacing what a previous parse of the document put
+    there. Entity resolution only looks at pairs involving the document's
+    entities, Leiden only re-clusters their communities, and only the reports
+    of communities whose membership changed are regenerated.
+
+    The LLM work runs without the lock; the result is saved only if nobody
+    saved the graph meanwhile, and recomputed otherwise. The last attempt
+    holds the lock throughout.
+    The returned chunks carry the entities and reports of the knowledge base
+    that changed, plus the document's part of the graph. The index entries
+    they replace or drop are deleted by `retire` once they are indexed.
+    """
+    reports = {}
+    for attempt in range(MERGE_ATTEMPTS):
+        last = attempt == MERGE_ATTEMPTS - 1
+        with kb_graph_lock(kb_id, timeout=3600) if last else nullcontext():
+            version = kb_graph_version(kb_id)
+            kb = load_kb_graph(kb_id)
+            entities, chunks, retired = _merge_doc(kb, kb_id, doc_id, graph, llm_bdl, callback, reports)
+            with nullcontext() if last else kb_graph_lock(kb_id):
+                if kb_graph_version(kb_id) == version:
+                    save_kb_graph(kb_id, kb)
+                    add_retired(kb_id, doc_id, retired)
+                    break
+        if last:
+            raise RuntimeError(f"The knowledge graph of kb:{kb_id} was saved by another task while merging.")
+        log.info(f"kb:{kb_id} graph changed while merging doc:{doc_id}, attempt {attempt + 2}/{MERGE_ATTEMPTS}")
+
+    kb_graph = kb["graph"]
+    graph2neo4j(kb_graph.subgraph(set(entities).union(*[kb_graph[n] for n in entities])))
+    doc_graph = kb_graph.subgraph(doc_entities(kb, doc_id))
+    return chunks + [{
+        "content_with_weight": json.dumps(nx.node_link_data(doc_graph), ensure_ascii=False, indent=2),
+        "knowledge_graph_kwd": "graph"
+    }]
+
 def mind_map2chunk(mind_map: dict):
     return [{
             "content_with_weight": json.dumps(mind_map, ensure_ascii=False, indent=2),
@@ -114,7 +222,13 @@ def mind_map2chunk(mind_map: dict):
 
     
 def build_knowlege_graph_chunks(tenant_id: str, filename:str,chunks: List[str], callback,
-                                entity_types=["organization", "person", "location", "event", "time"]):
+                                entity_types=["organization", "person", "location", "event", "time"],
+                                kb_id: str | None = None, doc_id: str | None = None):
+    """
+    With `kb_id`, the graph of document `doc_id` is merged into the persistent
+    graph of the knowledge base (see `merge2kb_graph`) instead of being
+    resolved and summarized on its own.
+    """
     _, tenant = TenantService.get_by_id(tenant_id)
     llm_bdl = LLMBundle(tenant_id, LLMType.CHAT, tenant.llm_id)
     graph_ext = GraphExtractor(llm_bdl)
@@ -127,7 +241,9 @@ def build_knowlege_graph_chunks(tenant_id: str, filename:str,chunks: List[str],
         assert left_token_count > 0, f"The LLM context length({llm_bdl.max_length}) is smaller than prompt({graph_ext.prompt_token_count})"
         
         sub_texts_2d = build_sub_texts_2d(chunks, left_token_count)
-        graphs = [graph_ext(["\n".join(texts)], {"entity_types": entity_types}, callback).output for texts in sub_texts_2d]
+        graphs = get_dispatcher(llm_bdl).map(
+            lambda texts: graph_ext(["\n".join(texts)], {"entity_types": entity_types}, callback).output, sub_texts_2d)
+        graphs = [g for g in graphs if g is not None]
         graph = reduce(graph_merge, graphs) if graphs else nx.Graph()
         mind_map_result = mind_map_ext(chunks).output
     else:
@@ -149,6 +265,11 @@ def build_knowlege_graph_chunks(tenant_id: str, filename:str,chunks: List[str],
         mind_map_chat_results = {f"{filename}-{k}":v for k,v in chat_results.items() if k.startswith('mind_')}
         mind_map_result = mind_map_ext.responses2result(mind_map_chat_results).output
 
+    if kb_id:
+        graph_chunks = merge2kb_graph(tenant_id, kb_id, doc_id, graph, llm_bdl, callback)
+        log.info(f"{filename} merged into the knowledge graph of kb:{kb_id}.")
+        return graph_chunks + mind_map2chunk(mind_map_result)
+
     callback(0.5, "Extracting entities.")
     er = EntityResolution(llm_bdl)
     graph = er(graph).output
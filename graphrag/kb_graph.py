@@ -0,0 +1,332 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+The persistent knowledge graph of a knowledge base, which documents parsed
+in incremental mode are merged into, together with its communities.
+
+The graph extracted from every document is kept next to the merged graph,
+and an entity is the fold of its documents' contributions, so that a
+document can be taken out again on re-parse or deletion. Entity resolution
+is recorded as aliases from the merged-away names to the kept ones.
+The index entries of entities and community reports belong to the knowledge
+base (`kb_graph_doc_id`), not to one of its documents.
+"""
+import hashlib
+import json
+import time
+from contextlib import contextmanager
+
+import networkx as nx
+from elasticsearch_dsl import Q
+from loguru import logger as log
+
+from graphrag import leiden
+from rag.nlp import search
+from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
+from rag.utils.storage_factory import STORAGE_IMPL
+
+KB_GRAPH_FILE = "knowledge_graph.json"
+
+
+def kb_graph_doc_id(kb_id: str):
+    """The owner of the index entries of the graph of a knowledge base."""
+    return f"kb_graph_{kb_id}"
+
+
+def entity_chunk_id(kb_id: str, name: str):
+    return hashlib.md5(f"{kb_id}:entity:{name}".encode("utf-8")).hexdigest()
+
+
+def report_chunk_id(kb_id: str, community_kwd: str):
+    return hashlib.md5(f"{kb_id}:community_report:{community_kwd}".encode("utf-8")).hexdigest()
+
+
+def load_kb_graph(kb_id: str):
+    """
+    Returns the graph of the knowledge base as {"graph", "communities", "docs",
+    "aliases", "stale"}: communities are {id: {level, nodes, weight, title}},
+    docs the {"nodes", "edges"} of the graph of each document in merge order,
+    and stale the entities whose index entries are out of date.
+    """
+    try:
+        binary = STORAGE_IMPL.get(kb_id, KB_GRAPH_FILE)
+    except Exception as e:
+        log.warning(f"load knowledge graph of kb:{kb_id} fail: {e}")
+        binary = None
+    data = json.loads(binary) if binary else {}
+    return {"graph": nx.node_link_graph(data["graph"]) if data.get("graph") else nx.Graph(),
+            "communities": data.get("communities", {}),
+            "docs": data.get("docs", {}),
+            "aliases": data.get("aliases", {}),
+            "stale": data.get("stale", [])}
+
+
+def save_kb_graph(kb_id: str, kb: dict):
+    data = {**kb, "graph": nx.node_link_data(kb["graph"])}
+    STORAGE_IMPL.put(kb_id, KB_GRAPH_FILE, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    if REDIS_CONN.is_alive():
+        REDIS_CONN.REDIS.incr(f"kb_graph_version:{kb_id}")
+
+
+def kb_graph_version(kb_id: str):
+    """Bumped by every save, so a merge computed outside the lock can tell whether it is still current."""
+    if not REDIS_CONN.is_alive():
+        return None
+    return REDIS_CONN.REDIS.get(f"kb_graph_version:{kb_id}")
+
+
+@contextmanager
+def kb_graph_lock(kb_id: str, timeout=600):
+    """Serializes the saves of the graph of a knowledge base across task executors."""
+    if not REDIS_CONN.is_alive():
+        log.warning(f"redis unavailable, saving the knowledge graph of kb:{kb_id} without lock")
+        yield
+        return
+    with REDIS_CONN.REDIS.lock(f"kb_graph_lock:{kb_id}", timeout=timeout, blocking_timeout=timeout):
+        yield
+
+
+def resolve(aliases: dict, name: str):
+    """The entity `name` was merged into by entity resolution, if any."""
+    seen = set()
+    while name in aliases and name not in seen:
+        seen.add(name)
+        name = aliases[name]
+    return name
+
+
+def doc_entities(kb: dict, doc_id: str):
+    if doc_id not in kb["docs"]:
+        return set()
+    return {resolve(kb["aliases"], n) for n in kb["docs"][doc_id]["nodes"]}
+
+
+def rebuild(kb: dict, names: set):
+    """
+    Recomputes the entities `names` and their relations from the graphs of
+    the documents, folded in merge order the way `graph_merge` does. Entities
+    no document contributes to any more are removed. The communities an
+    entity belongs to are kept. Returns the removed entities.
+    """
+    graph, aliases = kb["graph"], kb["aliases"]
+    nodes, edges = {}, {}
+    for data in kb["docs"].values():
+        for n, attr in data["nodes"].items():
+            name = resolve(aliases, n)
+            if name not in names:
+                continue
+            if name not in nodes:
+                nodes[name] = dict(attr)
+                continue
+            nodes[name]["weight"] += 1
+            if nodes[name]["description"].lower().find(attr["description"][:32].lower()) < 0:
+                nodes[name]["description"] += "\n" + attr["description"]
+        for s, t, attr in data["edges"]:
+            s, t = resolve(aliases, s), resolve(aliases, t)
+            if s == t or (s not in names and t not in names):
+                continue
+            key = (s, t) if s < t else (t, s)
+            if key in edges:
+                edges[key]["weight"] = attr["weight"] + 1
+                continue
+            edges[key] = dict(attr)
+
+    removed = set()
+    for name in names:
+        if name not in graph:
+            if name in nodes:
+                graph.add_node(name, **nodes[name])
+            continue
+        graph.remove_edges_from([(name, m) for m in list(graph[name])])
+        if name not in nodes:
+            graph.remove_node(name)
+            removed.add(name)
+            continue
+        communities = graph.nodes[name].get("communities")
+        graph.nodes[name].clear()
+        graph.nodes[name].update(nodes[name])
+        if communities is not None:
+            graph.nodes[name]["communities"] = communities
+    for (s, t), attr in edges.items():
+        if s in graph and t in graph:
+            graph.add_edge(s, t, **attr)
+    for n, degree in graph.degree:
+        graph.nodes[n]["rank"] = int(degree)
+    return removed
+
+
+def put_doc(kb: dict, doc_id: str, graph: nx.Graph | None):
+    """
+    Replaces the contribution of the document with `graph` (None takes the
+    document out). Returns the entities it touched and those removed.
+    """
+    touched = doc_entities(kb, doc_id)
+    kb["docs"].pop(doc_id, None)
+    if graph is not None:
+        kb["docs"][doc_id] = {"nodes": dict(graph.nodes(data=True)),
+                              "edges": [[s, t, attr] for s, t, attr in graph.edges(data=True)]}
+        touched |= doc_entities(kb, doc_id)
+    return touched, rebuild(kb, touched)
+
+
+def merge_aliases(kb: dict, merged: dict):
+    """Records entity resolution's {merged-away: kept} and refolds the entities involved."""
+    kb["aliases"].update(merged)
+    return rebuild(kb, set(merged.keys()) | set(merged.values()))
+
+
+def drop_community_titles(kb: dict, old_communities: dict, removed):
+    for cid in removed:
+        title = old_communities[cid].get("title")
+        for n in old_communities[cid]["nodes"]:
+            if title and n in kb["graph"] and title in kb["graph"].nodes[n].get("communities", []):
+                kb["graph"].nodes[n]["communities"].remove(title)
+
+
+def community_kwd(communities: dict, cid: str):
+    return f"community-{communities[cid]['level']}-{cid}"
+
+
+def _retired_file(doc_id: str):
+    return f"{KB_GRAPH_FILE}.{doc_id}.retired"
+
+
+def add_retired(kb_id: str, doc_id: str, ids):
+    """
+    Records index entries the merge of the document replaced or dropped, to
+    be deleted by `retire` once its own chunks are indexed. Call under the lock.
+    """
+    if not ids:
+        return
+    retired = {}
+    if STORAGE_IMPL.obj_exist(kb_id, _retired_file(doc_id)):
+        retired = json.loads(STORAGE_IMPL.get(kb_id, _retired_file(doc_id)))
+    now = time.time()
+    retired.update({i: now for i in ids})
+    STORAGE_IMPL.put(kb_id, _retired_file(doc_id), json.dumps(retired).encode("utf-8"))
+
+
+def retire(tenant_id: str, kb_id: str, doc_id: str):
+    """
+    Deletes the index entries recorded by `add_retired` for the document.
+    An entry indexed again after it was retired (another document brought the
+    entity or community back) is newer than its retirement and kept.
+    """
+    if not STORAGE_IMPL.obj_exist(kb_id, _retired_file(doc_id)):
+        return
+    retired = json.loads(STORAGE_IMPL.get(kb_id, _retired_file(doc_id)))
+    by_time = {}
+    for i, t in retired.items():
+        by_time.setdefault(t, []).append(i)
+    for t, ids in by_time.items():
+        ELASTICSEARCH.deleteByQuery(Q("ids", values=ids) & Q("term", kb_id=kb_id) &
+                                    Q("range", create_timestamp_flt={"lt": t}), idxnm=search.index_name(tenant_id))
+    STORAGE_IMPL.rm(kb_id, _retired_file(doc_id))
+    RETRIEVAL_CACHE.bump(kb_id)
+    log.info(f"kb:{kb_id} {len(retired)} graph index entries retired after doc:{doc_id}")
+
+
+def retract_doc(tenant_id: str, kb_id: str, doc_id: str):
+    """
+    Takes a deleted document out of the graph of its knowledge base. The index
+    entries of the entities and community reports left without a document are
+    deleted; the entities it only contributed to are marked stale and the
+    communities that changed left without a report, both being redone by the
+    next merge into the knowledge base.
+    """
+    with kb_graph_lock(kb_id):
+        kb = load_kb_graph(kb_id)
+        if doc_id not in kb["docs"]:
+            return
+        touched, removed_nodes = put_doc(kb, doc_id, None)
+        old_communities = kb["communities"]
+        kb["communities"], _, removed = recompute_communities(kb["graph"], old_communities, touched)
+        drop_community_titles(kb, old_communities, removed)
+        kb["stale"] = sorted((set(kb["stale"]) | touched) - removed_nodes)
+        save_kb_graph(kb_id, kb)
+
+    retire(tenant_id, kb_id, doc_id)
+    ids = [entity_chunk_id(kb_id, n) for n in removed_nodes] + \
+          [report_chunk_id(kb_id, community_kwd(old_communities, cid)) for cid in removed]
+    if ids:
+        ELASTICSEARCH.deleteByQuery(Q("ids", values=ids) & Q("term", kb_id=kb_id), idxnm=search.index_name(tenant_id))
+        RETRIEVAL_CACHE.bump(kb_id)
+    log.info(f"doc:{doc_id} taken out of the knowledge graph of kb:{kb_id}: {len(touched)} entities touched, "
+             f"{len(removed_nodes)} removed, {len(removed)} community reports dropped")
+
+
+def community_id(level, nodes):
+    txt = "{}:{}".format(level, "\n".join(sorted(nodes)))
+    return hashlib.md5(txt.encode("utf-8")).hexdigest()
+
+
+def community_weight(graph: nx.Graph, nodes):
+    return sum(graph.nodes[n].get("rank", 0) * graph.nodes[n].get("weight", 1) for n in nodes)
+
+
+def affected_nodes(graph: nx.Graph, communities: dict, touched: set):
+    """The touched nodes plus every member of a community one of them was in."""
+    nodes = set(touched)
+    for comm in communities.values():
+        if touched.intersection(comm["nodes"]):
+            nodes.update(comm["nodes"])
+    return {n for n in nodes if n in graph}
+
+
+def recompute_communities(graph: nx.Graph, communities: dict, touched: set):
+    """
+    Re-runs Leiden over the communities of the touched nodes only, the rest
+    of the graph keeping its communities. Communities are identified by
+    their level and membership, so a community whose members did not change
+    keeps its id (and its report).
+    Returns (communities, added ids, removed ids).
+    """
+    region = affected_nodes(graph, communities, touched)
+    old = {cid for cid, comm in communities.items() if region.union(touched).intersection(comm["nodes"])}
+
+    sub = graph.subgraph(region)
+    sub = sub.subgraph([n for n in sub.nodes if sub.degree(n) > 0]).copy()
+    fresh = {}
+    for level, comms in leiden.run(sub, {"use_lcc": False}).items():
+        for comm in comms.values():
+            cid = community_id(level, comm["nodes"])
+            fresh[cid] = {"level": level, "nodes": sorted(comm["nodes"]),
+                          "weight": community_weight(graph, comm["nodes"]),
+                          "title": communities.get(cid, {}).get("title", "")}
+
+    res = {cid: comm for cid, comm in communities.items() if cid not in old}
+    res.update(fresh)
+    added = [cid for cid in fresh if cid not in communities]
+    removed = [cid for cid in old if cid not in fresh]
+    log.info(f"communities: {len(region)} nodes re-clustered, {len(added)} added, {len(removed)} removed, "
+             f"{len(res) - len(added)} kept")
+    return res, added, removed
+
+
+def communities_by_level(communities: dict, ids):
+    """{level: {id: {"weight", "nodes"}}} for `ids`, weights normalized per level like `leiden.run`."""
+    max_weight = {}
+    for comm in communities.values():
+        max_weight[comm["level"]] = max(max_weight.get(comm["level"], 0), comm["weight"])
+    res = {}
+    for cid in ids:
+        comm = communities[cid]
+        res.setdefault(comm["level"], {})[cid] = {
+            "weight": comm["weight"] / max_weight[comm["level"]] if max_weight[comm["level"]] else 0,
+            "nodes": comm["nodes"]}
+    return res
@@ -5,15 +5,24 @@ Reference:
  - [graphrag](https://github.com/microsoft/graphrag)
 """
 
+import hashlib
+import json
 import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any, cast, List
 import html
+from cachetools import LRUCache
 from graspologic.partition import hierarchical_leiden
 from graspologic.utils import largest_connected_component
 
 import networkx as nx
 from networkx import is_empty
 
+from rag import settings
+from rag.utils.redis_conn import REDIS_CONN
+
 log = logging.getLogger(__name__)
 
 
@@ -72,24 +81,102 @@ def stable_largest_connected_component(graph: nx.Graph) -> nx.Graph:
     return _stabilize_graph(graph)
 
 
+def _leiden_component(edges: list, max_cluster_size: int, seed: int) -> dict[int, dict[str, int]]:
+    """Hierarchical Leiden over one connected component given as (source, target, weight) edges."""
+    graph = _stabilize_graph(nx.Graph([(s, t, {"weight": w}) for s, t, w in edges]))
+    results: dict[int, dict[str, int]] = {}
+    for partition in hierarchical_leiden(graph, max_cluster_size=max_cluster_size, random_seed=seed):
+        results.setdefault(partition.level, {})[partition.node] = partition.cluster
+    return results
+
+
+def _component_edges(graph: nx.Graph) -> list:
+    edges = [(min(s, t), max(s, t), float(attr.get("weight", 1))) for s, t, attr in graph.edges(data=True)]
+    return sorted(edges)
+
+
+def _component_key(edges: list, max_cluster_size: int, seed: int) -> str:
+    """Stable content hash of a component: the same edges and weights give the same communities."""
+    txt = json.dumps([max_cluster_size, seed, edges], ensure_ascii=False)
+    return "leiden:" + hashlib.md5(txt.encode("utf-8")).hexdigest()
+
+
+_CACHE = LRUCache(maxsize=1024)
+_CACHE_LOCK = threading.Lock()
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # Spawned, not forked: the parent runs LLM and storage threads.
+            _POOL = ProcessPoolExecutor(max_workers=settings.LEIDEN_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _POOL
+
+
+def _get_cached(keys: list) -> list:
+    res = [None] * len(keys)
+    with _CACHE_LOCK:
+        for i, k in enumerate(keys):
+            res[i] = _CACHE.get(k)
+    missing = [i for i, v in enumerate(res) if v is None]
+    if missing:
+        for i, v in zip(missing, REDIS_CONN.mget([keys[i] for i in missing]) or []):
+            if v:
+                res[i] = {int(level): comm for level, comm in json.loads(v).items()}
+    return res
+
+
+def _set_cached(kvs: dict):
+    with _CACHE_LOCK:
+        _CACHE.update(kvs)
+    REDIS_CONN.mset({k: json.dumps(v, ensure_ascii=False) for k, v in kvs.items()}, settings.LEIDEN_CACHE_TTL)
+
+
 def _compute_leiden_communities(
         graph: nx.Graph | nx.DiGraph,
         max_cluster_size: int,
         use_lcc: bool,
         seed=0xDEADBEEF,
-) -> dict[int, dict[str, int]]:
-    """Return Leiden root communities."""
-    results: dict[int, dict[str, int]] = {}
+) -> dict[int, dict[str, str]]:
+    """
+    Return Leiden root communities. Each connected component is clustered
+    on its own, the components missing from the cache in a process pool.
+    Community ids are prefixed with the component's content hash, so the
+    communities of a component that did not change keep their ids.
+    """
+    results: dict[int, dict[str, str]] = {}
     if is_empty(graph): return results
     if use_lcc:
         graph = stable_largest_connected_component(graph)
-
-    community_mapping = hierarchical_leiden(
-        graph, max_cluster_size=max_cluster_size, random_seed=seed
-    )
-    for partition in community_mapping:
-        results[partition.level] = results.get(partition.level, {})
-        results[partition.level][partition.node] = partition.cluster
+    graph = graph.to_undirected() if graph.is_directed() else graph
+
+    components = [_component_edges(graph.subgraph(c)) for c in nx.connected_components(graph)]
+    components = [edges for edges in components if edges]
+    keys = [_component_key(edges, max_cluster_size, seed) for edges in components]
+    communities = _get_cached(keys)
+
+    todo = [i for i, comm in enumerate(communities) if comm is None]
+    if len(todo) > 1 and sum(len(components[i]) for i in todo) >= settings.LEIDEN_POOL_MIN_EDGES:
+        computed = list(_pool().map(_leiden_component, [components[i] for i in todo],
+                                    [max_cluster_size] * len(todo), [seed] * len(todo)))
+    else:
+        computed = [_leiden_component(components[i], max_cluster_size, seed) for i in todo]
+    for i, comm in zip(todo, computed):
+        communities[i] = comm
+    if todo:
+        _set_cached({keys[i]: communities[i] for i in todo})
+    log.info("leiden: %d components, %d clustered, %d from cache", len(components), len(todo),
+             len(components) - len(todo))
+
+    for key, comm in zip(keys, communities):
+        prefix = key.split(":")[1][:8]
+        for level, mapping in comm.items():
+            for node, cluster in mapping.items():
+                results.setdefault(level, {})[node] = f"{prefix}-{cluster}"
 
     return results
 
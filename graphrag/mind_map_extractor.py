@@ -19,13 +19,13 @@ import logging
 import re
 import logging
 import traceback
-from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Any, List
 
 from graphrag.mind_map_prompt import MIND_MAP_EXTRACTION_PROMPT
 from graphrag.utils import ErrorHandlerFn, perform_variable_replacements
 from rag.llm.chat_model import Base as CompletionLLM
+from rag.llm.dispatcher import get_dispatcher
 import markdown_to_json
 from functools import reduce
 from rag.utils import num_tokens_from_string
@@ -54,6 +54,7 @@ class MindMapExtractor:
         """Init method definition."""
         # TODO: streamline construction
         self._llm = llm_invoker
+        self._dispatcher = get_dispatcher(llm_invoker)
         self._input_text_key = input_text_key or "input_text"
         self._mind_map_prompt = prompt or MIND_MAP_EXTRACTION_PROMPT
         self._on_error = on_error or (lambda _e, _s, _d: None)
@@ -135,25 +136,23 @@ class MindMapExtractor:
             prompt_variables = {}
 
         try:
-            exe = ThreadPoolExecutor(max_workers=12)
-            threads = []
             token_count = max(self._llm.max_length * 0.8, self._llm.max_length-512)
             texts = []
-            res = []
+            batches = []
             cnt = 0
             for i in range(len(sections)):
                 section_cnt = num_tokens_from_string(sections[i])
                 if cnt + section_cnt >= token_count and texts:
-                    threads.append(exe.submit(self._process_document, "".join(texts), prompt_variables))
+                    batches.append("".join(texts))
                     texts = []
                     cnt = 0
                 texts.append(sections[i])
                 cnt += section_cnt
             if texts:
-                threads.append(exe.submit(self._process_document, "".join(texts), prompt_variables))
+                batches.append("".join(texts))
 
-            for i, _ in enumerate(threads):
-                res.append(_.result())
+            res = [r for r in self._dispatcher.map(lambda t: self._process_document(t, prompt_variables), batches)
+                   if r is not None]
 
             if not res:
                 return MindMapResult(output={"id": "root", "children": []})
@@ -232,7 +231,7 @@ class MindMapExtractor:
         }
         text = perform_variable_replacements(self._mind_map_prompt, variables=variables)
         gen_conf = {"temperature": 0.5}
-        response = self._llm.chat(text, [{"role": "user", "content": "Output:"}], gen_conf)
+        response = self._dispatcher.chat(self._llm, text, [{"role": "user", "content": "Output:"}], gen_conf)
         response = re.sub(r"```[^\n]*", "", response)
         print(response)
         print("---------------------------------------------------\n", self._todict(markdown_to_json.dictify(response)))
@@ -1,89 +1,140 @@
 import json
 import re
+from collections import defaultdict
+from functools import lru_cache
 import networkx as nx
-from lark import Lark, Transformer, v_args, Token, Tree
+from cachetools import TTLCache
+from lark import Lark, Transformer, v_args, Token
 from rag.utils.es_conn import ELASTICSEARCH
 from graphrag.policy.grammar import grammar
+from graphrag.graph_store import GraphStore
 from loguru import logger as log
 
 
+rule_parser = Lark(grammar, parser="lalr")
+
+
+@lru_cache(maxsize=100000)
+def parse_rule(rule: str):
+    return rule_parser.parse(rule)
+
+
+def parse_rules(rules: list[str]):
+    """{rule: tree} for the rules that parse; the others are logged and left out."""
+    trees = {}
+    for rule in rules:
+        try:
+            trees[rule] = parse_rule(rule)
+        except Exception as ex:
+            log.error(f"parse rule:【{rule}】 failed,{str(ex)}")
+    return trees
+
+
+@lru_cache(maxsize=None)
+def compile_regexp(pattern: str):
+    return re.compile(pattern)
+
+
 @v_args(inline=True)  # Affects the signatures of the methods
-class NetWorkGraphTree(Transformer):
-    
-    def __init__(self,graph:nx.Graph):
-        self.graph = graph 
-    
-    def start(self,exp:Token):
+class RuleTree(Transformer):
+    """
+    Evaluates a parsed rule. Whether some node matches a term is answered by
+    `query(entity_type, attr, value, op)`, op being one of '=', '~', '=~'.
+    """
+
+    def __init__(self, query):
+        super().__init__()
+        self.query = query
+
+    def start(self, exp):
         return exp
-    
+
     def exp(self, *args):
         return any(args)
-        
+
     def and_exp(self, *args):
         return all(args)
 
-    def not_exp(self, exp:Token|Tree):
-        if isinstance(exp,Tree):
-            term = exp.children[0]
-            return not self.term(term.children)
-        elif isinstance(exp,bool):
-            return not exp
-        else:
-            raise Exception(f"unexpected type:{type(exp)}")
-        
-    def term(self,term:Token):
-        if isinstance(term,dict):
-            return term
-        match(term.data.value):
-            case "item_eq":
-                return self.term_eq(*term.children)
-            case "item_contains":
-                return self.item_contains(*term.children)
-            case "item_regexp":
-                return self.item_regexp(*term.children)
+    def not_exp(self, exp):
+        return not exp
+
+    def term(self, exp):
+        return exp
+
+    def _term(self, op, entity_type: Token, *rest: Token):
+        attr = "id"
+        if rest and rest[0].type == "ENTITY_ATTRIBUTE":
+            attr, rest = rest[0][1:].strip("'"), rest[1:]
+        values = [v.strip("'") for v in rest]
+        if op == "=":
+            values = [x for v in values for x in v.split(",")]
+        return all([self.query(entity_type.strip("'"), attr, v, op) for v in values])
+
+    def item_eq(self, *args):
+        return self._term("=", *args)
+
+    def item_contains(self, *args):
+        return self._term("~", *args)
+
+    def item_regexp(self, *args):
+        return self._term("=~", *args)
+
+
+class GraphIndex:
+    """
+    Answers rule terms against an in-memory graph from per-(entity_type,
+    attribute) value indexes, built on first use and shared by all the rules
+    evaluated on the graph.
+    """
+
+    def __init__(self, graph: nx.Graph):
+        self.by_type = defaultdict(list)
+        for node, attr_dict in graph.nodes(data=True):
+            self.by_type[attr_dict.get("entity_type")].append((node, attr_dict))
+        self.values = {}
+        self.others = {}
+        self.texts = {}
+        self.memo = {}
+
+    def _values(self, entity_type, attr):
+        k = (entity_type, attr)
+        if k not in self.values:
+            vals, others = set(), []
+            for node, attr_dict in self.by_type.get(entity_type, []):
+                v = node if attr == "id" else attr_dict.get(attr)
+                if v is None:
+                    continue
+                try:
+                    vals.add(v)
+                except TypeError:
+                    # Lists (`source_id`, `communities`, ...) can't be indexed; they are scanned per node.
+                    others.append(v)
+            self.values[k] = vals
+            self.others[k] = others
+            # All the string values in one text, so `contains` is a single substring search.
+            self.texts[k] = "\0".join(v for v in vals if isinstance(v, str))
+        return self.values[k]
+
+    def query(self, entity_type, attr, value, op="="):
+        k = (entity_type, attr, value, op)
+        if k in self.memo:
+            return self.memo[k]
+        vals = self._values(entity_type, attr)
+        others = self.others[(entity_type, attr)]
+        match(op):
+            case "=":
+                r = value in vals or any(v == value for v in others)
+            case "~":
+                r = (any(isinstance(v, str) for v in vals) and value in self.texts[(entity_type, attr)]) \
+                    or any(value in v for v in others)
+            case "=~":
+                pattern = compile_regexp(value)
+                r = any(isinstance(v, str) and pattern.match(v) for v in vals)
             case _:
-                return self.exp(*term.children)
-            
-    def term_eq(self, entity_type:Token, attr_or_value:Token, value:Token=None):
-        entity_type = entity_type.strip("'")
-        attr = (attr_or_value[1:] if value else "id").strip("'")
-        value = (value or attr_or_value).strip("'")
-        
-        if ',' in str(value):
-            values = value.split(',')
-            return all([self.graph_query(entity_type,attr,value,'=') for value in values])
-        else:
-            return self.graph_query(entity_type,attr,value,'=')
-    
-    def graph_query(self,entity_type,attr,value,op='='):
-        entity_type = str(entity_type).strip("'")
-        attr = str(attr).strip("'")
-        value = str(value).strip("'")
-        
-        for node,attr_dict in self.graph.nodes(data=True):
-            if not attr_dict.get('entity_type') == entity_type:
-                continue
-            v = node if attr=='id' else attr_dict.get(attr)
-            match(op):
-                case "=" if v == value:
-                    return True
-                case "~" if value in v:
-                    return True
-                case "=~" if re.match(value,v):
-                    return True
-        return False
-        
-    def item_contains(self,entity_type:Token, attr_or_value:Token, value:Token=None):
-        attr = attr_or_value[1:] if value else "id"
-        value = value or attr_or_value
-        return self.graph_query(entity_type,attr,value,'~')
-        
-    def item_regexp(self, entity_type:Token, attr_or_value:Token, value:Token=None):
-        attr = attr_or_value[1:] if value else "id"
-        value = value or attr_or_value
-        return self.graph_query(entity_type,attr,value,'=~')
-   
-  
+                raise Exception(f"unexpected op:{op}")
+        self.memo[k] = r
+        return r
+
 
 def graph_of_doc(index:str="ragflow_7d19a176807611efb0f80242ac120006",
                 doc:str="aa610bd08c8111ef804c0242ac120003"):
@@ -120,28 +171,47 @@ def graph_of_doc(index:str="ragflow_7d19a176807611efb0f80242ac120006",
     
     for hits in ELASTICSEARCH.scrollIter(q=q):
         for hit in hits:
-            graph_json = hit['_source']['content_with_weight']
+            src = hit['_source']
+            store = GraphStore(src['kb_id'], src['doc_id'])
+            if store.is_current(src.get('create_timestamp_flt')):
+                return store.load()
+            graph_json = src['content_with_weight']
             node_link_data = json.loads(graph_json)
             graph = nx.node_link_graph(node_link_data)
             return graph
         
 
+_GRAPH_INDEXES = TTLCache(maxsize=32, ttl=600)
+
+
+def graph_index(doc: str, index: str = "ragflow_7d19a176807611efb0f80242ac120006"):
+    """The `GraphIndex` of a document's graph, kept for a few minutes across rule files."""
+    k = (index, doc)
+    if k not in _GRAPH_INDEXES:
+        graph = graph_of_doc(index=index, doc=doc)
+        if not graph:
+            return None
+        _GRAPH_INDEXES[k] = GraphIndex(graph)
+    return _GRAPH_INDEXES[k]
+
+
 def evaluate_rule_on_network_graph(rules:str|list[str],doc:str):
     batch_result = {}
     if isinstance(rules,str):
         rules = [rules]
 
     # 获取稳定的图结构
-    graph = graph_of_doc(doc=doc)
-    if not graph:
+    idx = graph_index(doc)
+    if not idx:
         log.error(f"找不到文档:{doc}")
         return
     # 基于此图的策略引擎
-    engine = Lark(grammar, parser="lalr", transformer=NetWorkGraphTree(graph)).parse
+    engine = RuleTree(idx.query)
+    trees = parse_rules(rules)
     
     for rule in rules:
         # 执行引擎，返回结果
-        is_pass = engine(rule)
+        is_pass = rule in trees and engine.transform(trees[rule])
         log.info(f"run rule:【{rule}】,{"PASS" if is_pass else "NO_PASS"}")
         batch_result[rule] = is_pass
         
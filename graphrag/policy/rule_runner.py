@@ -1,6 +1,7 @@
 import sys
 import yaml
 import glob
+from collections import defaultdict
 from pathlib import Path
 from loguru import logger as log
 from graphrag.policy.graph_transformer import evaluate_rule_on_network_graph
@@ -22,6 +23,8 @@ def evaluate_rule_file(file_path:str):
         rule_files = glob.glob(f"{file_path}/**/*.yaml", recursive=True)
         rule_files += glob.glob(f"{file_path}/**/*.yml", recursive=True)
     
+    # 先读取全部策略文件，同一个 source 的规则合并后一次执行
+    rule_sets = []
     for rule_file in rule_files:
         log.info(f"正则扫描策略文件:{rule_file}")
         try:
@@ -34,16 +37,30 @@ def evaluate_rule_file(file_path:str):
                 if not data.get('rules'):
                     log.error(f"{rule_file} 中不存在 rules 节点")
                     continue
-                rules = data['rules']
-                
-                log.info(f"{rule_file},evaluating rule:{name},source:{source},{len(rules)} rules")
-                if source == 'global':
-                    result = evaluate_rule_on_neo4j(rules)
-                else:
-                    result = evaluate_rule_on_network_graph(rules,doc=source)
-                log.info(f"策略：{rule_file} 执行完成，成功:{sum(result.values())}条，失败:{len(result)-sum(result.values())}条，成功率:{sum(result.values())/len(result):.2%}。")
+                rule_sets.append((rule_file, name, source, data['rules']))
+        except Exception as ex:
+            log.error(f"load {rule_file} failed,{str(ex)}",exc_info=True)
+
+    rules_by_source = defaultdict(dict)
+    for _, _, source, rules in rule_sets:
+        rules_by_source[source].update(dict.fromkeys(rules))
+
+    results = {}
+    for source, rules in rules_by_source.items():
+        log.info(f"evaluating {len(rules)} rules,source:{source}")
+        try:
+            if source == 'global':
+                results[source] = evaluate_rule_on_neo4j(list(rules))
+            else:
+                results[source] = evaluate_rule_on_network_graph(list(rules),doc=source)
         except Exception as ex:
-            log.error(f"execute {rule_file} failed,{str(ex)}",exc_info=True)
+            log.error(f"evaluate rules of source:{source} failed,{str(ex)}",exc_info=True)
+
+    for rule_file, name, source, rules in rule_sets:
+        if not results.get(source):
+            continue
+        result = {rule: results[source][rule] for rule in rules}
+        log.info(f"策略：{rule_file}({name}) 执行完成，成功:{sum(result.values())}条，失败:{len(result)-sum(result.values())}条，成功率:{sum(result.values())/len(result):.2%}。")
                 
 
 if __name__ == "__main__":
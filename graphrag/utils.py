@@ -6,16 +6,12 @@ Reference:
 """
 
 import html
-import inspect
-import time
-from pathlib import Path
 import re
 from collections.abc import Callable
 from typing import Any
 import networkx as nx
-import pickle
 from loguru import logger as log
-from rag.utils import md5_hash
+from graphrag.file_cache import file_cache
 
 ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
 
@@ -98,46 +94,6 @@ def escape(input_string):
     escaped_string = escaped_string.replace('"', '\\"')   # 转义双引号
     return escaped_string
             
-def custom_str(obj):
-    if isinstance(obj,nx.Graph):
-        return f"nodes:{list(obj.nodes())},edges:{list(obj.edges())}"
-    return str(obj)
-
-# 给Graph定制化__str__函数，这样在使用 file_cache 时，就可以确保每个入参为 nx.Graph 的函数可以分辨出不同的Graph。
-nx.Graph.__str__ = custom_str
-         
-def file_cache(func):
-    """
-    file_cache 适用于需要长时间执行的函数（例如:超过1分钟,防止失败重试的成本过大，
-    在整个过程中，缓存‘重’函数的执行结果，在失败重启时，可以从上次终端点快速执行。
-    
-    file_cache 完全用参数来判断是否读取缓存信息，对于 class method 和 instance method 会自动忽略 cls 和 self参数。
-    使用函数参数的 md5 hash 作为文件名，也作为是否缓存的依据。
-     
-    """
-    def decorator(*args, **kwargs):
-        assert len(args) > 0
-        if 'self' in inspect.signature(func).parameters:
-            args_for_hash = args[1:]
-        else:
-            args_for_hash = args
-        args_str = ",".join([str(arg) for arg in args_for_hash])
-        cache_file = md5_hash(f"{func.__module__}.{func.__name__}({args_str},{str(kwargs)})")
-        filepath = Path('.cache') / cache_file
-        
-        if filepath.exists() and filepath.stat().st_mtime + 7 * 24 * 3600 > time.time():
-            log.debug(f"{func.__module__}{func.__name__} using cache file {filepath}.")
-            with open(filepath, 'rb') as f:
-                return pickle.load(f)
-        else:
-            ret = func(*args, **kwargs)
-            with open(filepath, 'wb') as f:
-                pickle.dump(ret, f)
-            log.debug(f"{func.__module__}{func.__name__} result dump to file {filepath}.")
-            return ret
-    return decorator
-
-
 def get_filepaths_from_source_id(multi_source_id:str):
     if not multi_source_id:
         return ""
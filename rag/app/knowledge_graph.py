@@ -22,7 +22,9 @@ def chunk(filename, binary, tenant_id, from_page=0, to_page=100000,
                                          filename,
                                          sections,
                                          callback,
-                                         parser_config.get("entity_types", ["organization", "person", "location", "event", "time"])
+                                         parser_config.get("entity_types", ["organization", "person", "location", "event", "time"]),
+                                         kwargs.get("kb_id") if parser_config.get("graph_incremental") else None,
+                                         kwargs.get("doc_id")
                                          )
     for c in chunks: 
         c["docnm_kwd"] = filename
@@ -1,11 +1,12 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import asdict, dataclass
 import json
-import os
 import time
 from typing import List, Optional, Tuple
 from pathlib import Path
 from loguru import logger as log
 from openai import OpenAI
+from rag import settings
 from rag.llm.chat_model import Base
 from rag.utils import assure_security, md5_hash, tries
 from rag.utils.redis_conn import REDIS_CONN
@@ -72,14 +73,65 @@ class BatchModel:
         对于大的 id_messages,拆分调用api
         """
         all_chat_results = {}
-        items = sorted(list(id_messages.items()))  # 为了确保生成的 hash一致，此处需要排序
-        for i in range(0, len(items), chunk_size):
-            all_chat_results |= self.do_batch_api_call(items[i:i+chunk_size])
+        for chat_results in self.iter_batch_api_call(id_messages, chunk_size):
+            all_chat_results |= chat_results
         return all_chat_results
 
+    def iter_batch_api_call(self,id_messages: dict,chunk_size=1000):
+        """
+        拆分为多个 batch 一次性全部提交，并发轮询（指数退避），每完成一个 batch 即 yield 其结果。
+        batch 的 id 由内容 hash 决定，中断后重新调用会从 redis 中的 BatchTaskInfo 恢复进行中的 batch，不会重复提交。
+        """
+        items = sorted(list(id_messages.items()))  # 为了确保生成的 hash一致，此处需要排序
+        chunks = [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+        if not chunks:
+            return
+        st = time.time()
+        with ThreadPoolExecutor(max_workers=min(settings.BATCH_CONCURRENCY, len(chunks))) as exe:
+            tasks = list(exe.map(self.submit, chunks))
+            log.info(f"{len(tasks)} batches submitted in {time.time() - st:.1f}s")
+            inputs = {task.id: [id for id, _ in chunk] for task, chunk in zip(tasks, chunks)}
+            pending = {task.id: task for task in tasks}
+            interval = {task.id: settings.BATCH_QUERY_MIN_INTERVAL for task in tasks}
+            due = {task.id: 0 for task in tasks}
+            polling = {}
+            while pending:
+                now = time.monotonic()
+                for id in pending:
+                    if id not in polling.values() and due[id] <= now:
+                        polling[exe.submit(self.poll, pending[id])] = id
+                timeout = None
+                if len(polling) < len(pending):
+                    timeout = max(0, min(due[id] for id in pending if id not in polling.values()) - now)
+                if not polling:
+                    # Every batch is backing off: wait() on nothing would return at once.
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(polling, timeout=timeout, return_when=FIRST_COMPLETED)
+                for f in done:
+                    id = polling.pop(f)
+                    chat_results = f.result()
+                    if chat_results is None:
+                        due[id] = time.monotonic() + interval[id]
+                        interval[id] = min(interval[id] * 2, settings.BATCH_QUERY_INTERVAL)
+                        continue
+                    task = pending.pop(id)
+                    # 校验是否有丢失的数据没有返回来
+                    not_back_ids = set(inputs[id]) - set(chat_results.keys())
+                    if not_back_ids:
+                        log.error(f"{task.local_input_file} 中的 custom_id in {not_back_ids} not back, may be secure blocked by server.")
+                    log.info(f"batch {task.batch_id} done, {len(tasks) - len(pending)}/{len(tasks)}, elapsed: {time.time() - st:.1f}s")
+                    yield chat_results
+
     def do_batch_api_call(self,id_messages: List[Tuple]):
+        """
+        调用单个 batch api 返回结果
+        """
+        return self.batch_api_call(dict(id_messages), chunk_size=len(id_messages))
+
+    def submit(self,id_messages: List[Tuple]) -> "BatchTaskInfo":
         '''
-        调用 batch api 返回结果, 添加文件缓存，防止重复调用，浪费成本
+        上传并创建 batch（已提交过的直接从 redis 恢复），添加文件缓存，防止重复调用，浪费成本
         '''
         assert len(id_messages) > 0, "id_messages is invalid!"
         assert all(id and isinstance(messages,list) for id,messages in id_messages), "id not empty and message must be list and element format :{'role':'system/user','content':'text'} "
@@ -97,6 +149,8 @@ class BatchModel:
         content = "\n".join([json.dumps(line, ensure_ascii=False) for line in chat_input_lines])
         id = md5_hash(content)
         task = get_task(id)
+        if task.batch_id:
+            log.info(f"resuming batch {task.batch_id}, status:{task.batch_status}")
         
         if not task.local_input_file:
             file = Path(id).with_suffix(".jsonl")
@@ -111,16 +165,26 @@ class BatchModel:
         
         # 一般情况，任务在等待过程中中断，因此期望在此临时保存下任务。
         save_task(task)
-        
-        interval = int(os.environ.get('BATCH_QUERY_INTERVAL',60))
-        log.info(f"waiting {interval}s to get_batch {task.batch_id} result.")
-        while (batch := self.get_batch(task.batch_id)).status != 'completed':
-            task.batch_status = batch.status
-            time.sleep(interval)
+        return task
+
+    def poll(self,task: "BatchTaskInfo") -> Optional[dict]:
+        """
+        查询一次 batch 状态，未完成返回 None，完成则取回结果（结果落盘，之后直接读取本地文件）
+        """
+        if task.local_output_file and Path(task.local_output_file).exists():
+            with open(task.local_output_file, 'r') as file:
+                chat_results = json.load(file)
+            log.info(f"{task.local_output_file} exists, skip api_call")
+            return chat_results
 
         if not task.server_output_file_id:
-            if not batch:
-                batch = self.get_batch(task.batch_id)
+            batch = self.get_batch(task.batch_id)
+            if batch.status != 'completed':
+                if task.batch_status != batch.status:
+                    task.batch_status = batch.status
+                    save_task(task)
+                return None
+            task.batch_status = batch.status
             if not batch.output_file_id:
                 if batch.error_file_id:
                      errors = self.get_results(batch.error_file_id,is_error=True)
@@ -130,25 +194,12 @@ class BatchModel:
         chat_results = self.get_results(task.server_output_file_id)
         save_task(task)
         
-        if not task.local_output_file \
-        or not Path(task.local_output_file).exists():
-            filepath = Path(task.local_input_file).with_suffix('.out.json')
-            with open(filepath, 'w') as file:
-                json.dump(chat_results, file, ensure_ascii=False,indent=4)
-            log.info(f"##########  chat_results dumps to {filepath}")
-            task.local_output_file = str(filepath)
-            save_task(task)
-        else:
-            with open(task.local_output_file, 'r') as file:
-                chat_results = json.load(file)
-            log.info(f"{task.local_output_file} exists, skip api_call")
-            
-        # 校验是否有丢失的数据没有返回来
-        input_ids = [line['custom_id'] for line in chat_input_lines]
-        not_back_ids = set(input_ids) - set(chat_results.keys())
-        if not_back_ids:
-            log.error(f"{task.local_input_file} 中的 custom_id in {not_back_ids} not back, may be secure blocked by server.")
-    
+        filepath = Path(task.local_input_file).with_suffix('.out.json')
+        with open(filepath, 'w') as file:
+            json.dump(chat_results, file, ensure_ascii=False,indent=4)
+        log.info(f"##########  chat_results dumps to {filepath}")
+        task.local_output_file = str(filepath)
+        save_task(task)
         return chat_results
 
             
@@ -160,7 +211,7 @@ class BatchModel:
         try:
             
             file = Path(inputs_dir) / file
-            Path(inputs_dir).mkdir(exist_ok=True)
+            Path(inputs_dir).mkdir(parents=True, exist_ok=True)
             if file.exists():
                 log.info(f"{file} exists, skip writing")
                 return str(file)
@@ -18,6 +18,7 @@ from zhipuai import ZhipuAI
 from dashscope import Generation
 from abc import ABC
 from openai import OpenAI
+from rag.llm.http_client import shared_http_client
 import openai
 from ollama import Client
 from volcengine.maas.v2 import MaasService
@@ -31,7 +32,7 @@ import asyncio
 
 class Base(ABC):
     def __init__(self, key, model_name, base_url):
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
 
     @tries()
@@ -116,7 +117,8 @@ class DeepSeekChat(Base):
 
 class AzureChat(Base):
     def __init__(self, key, model_name, **kwargs):
-        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01")
+        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01",
+                                  http_client=shared_http_client())
         self.model_name = model_name
 
 
@@ -206,6 +208,9 @@ class BaiChuanChat(Base):
 
 
 class QWenChat(Base):
+    # Sets the process-wide dashscope key when built, so a kept instance would call with the key of the last one built.
+    reusable = False
+
     def __init__(self, key, model_name=Generation.Models.qwen_turbo, **kwargs):
         base_url = kwargs['base_url'] if kwargs.get('base_url') else "https://dashscope.aliyuncs.com/compatible-mode/v1"
         super().__init__(key,model_name,base_url)
@@ -385,7 +390,7 @@ class LocalAIChat(Base):
             raise ValueError("Local llm url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="empty", base_url=base_url)
+        self.client = OpenAI(api_key="empty", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name.split("___")[0]
 
 
@@ -711,6 +716,8 @@ class BedrockChat(Base):
 
 
 class GeminiChat(Base):
+    # Keeps the system prompt of the last call, so an instance must not be shared between callers.
+    reusable = False
 
     def __init__(self, key, model_name,base_url=None):
         from google.generativeai import client,GenerativeModel 
@@ -866,7 +873,7 @@ class LmStudioChat(Base):
             raise ValueError("Local llm url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="lm-studio", base_url=base_url)
+        self.client = OpenAI(api_key="lm-studio", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
 
 
@@ -1013,6 +1020,9 @@ class YiChat(Base):
 
 
 class ReplicateChat(Base):
+    # Keeps the system prompt of the last call, so an instance must not be shared between callers.
+    reusable = False
+
     def __init__(self, key, model_name, base_url=None):
         from replicate.client import Client
 
@@ -1165,6 +1175,9 @@ class SparkChat(Base):
 
 
 class BaiduYiyanChat(Base):
+    # Keeps the system prompt of the last call, so an instance must not be shared between callers.
+    reusable = False
+
     def __init__(self, key, model_name, base_url=None):
         import qianfan
 
@@ -1233,6 +1246,9 @@ class BaiduYiyanChat(Base):
 
 
 class AnthropicChat(Base):
+    # Keeps the system prompt of the last call, so an instance must not be shared between callers.
+    reusable = False
+
     def __init__(self, key, model_name, base_url=None):
         import anthropic
 
@@ -1299,6 +1315,9 @@ class AnthropicChat(Base):
 
 
 class GoogleChat(Base):
+    # Keeps the system prompt of the last call, so an instance must not be shared between callers.
+    reusable = False
+
     def __init__(self, key, model_name, base_url=None):
         from google.oauth2 import service_account
         import base64
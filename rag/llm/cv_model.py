@@ -20,6 +20,7 @@ from abc import ABC
 from ollama import Client
 from PIL import Image
 from openai import OpenAI
+from rag.llm.http_client import shared_http_client
 import os
 import base64
 from io import BytesIO
@@ -140,7 +141,7 @@ class Base(ABC):
 class GptV4(Base):
     def __init__(self, key, model_name="gpt-4-vision-preview", lang="Chinese", base_url="https://api.openai.com/v1"):
         if not base_url: base_url="https://api.openai.com/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
         self.lang = lang
 
@@ -160,7 +161,8 @@ class GptV4(Base):
 
 class AzureGptV4(Base):
     def __init__(self, key, model_name, lang="Chinese", **kwargs):
-        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01")
+        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01",
+                                  http_client=shared_http_client())
         self.model_name = model_name
         self.lang = lang
 
@@ -180,6 +182,9 @@ class AzureGptV4(Base):
 
 
 class QWenCV(Base):
+    # Sets the process-wide dashscope key when built, so a kept instance would call with the key of the last one built.
+    reusable = False
+
     def __init__(self, key, model_name="qwen-vl-chat-v1", lang="Chinese", **kwargs):
         import dashscope
         dashscope.api_key = key
@@ -442,7 +447,7 @@ class LocalAICV(GptV4):
             raise ValueError("Local cv model url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="empty", base_url=base_url)
+        self.client = OpenAI(api_key="empty", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name.split("___")[0]
         self.lang = lang
 
@@ -451,7 +456,7 @@ class XinferenceCV(Base):
     def __init__(self, key, model_name="", lang="Chinese", base_url=""):
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="xxx", base_url=base_url)
+        self.client = OpenAI(api_key="xxx", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
         self.lang = lang
 
@@ -553,7 +558,7 @@ class OpenRouterCV(GptV4):
     ):
         if not base_url:
             base_url = "https://openrouter.ai/api/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
         self.lang = lang
 
@@ -631,7 +636,7 @@ class NvidiaCV(Base):
 class StepFunCV(GptV4):
     def __init__(self, key, model_name="step-1v-8k", lang="Chinese", base_url="https://api.stepfun.com/v1"):
         if not base_url: base_url="https://api.stepfun.com/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
         self.lang = lang
 
@@ -642,7 +647,7 @@ class LmStudioCV(GptV4):
             raise ValueError("Local llm url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="lm-studio", base_url=base_url)
+        self.client = OpenAI(api_key="lm-studio", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
         self.lang = lang
 
@@ -653,7 +658,7 @@ class OpenAI_APICV(GptV4):
             raise ValueError("url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name.split("___")[0]
         self.lang = lang
 
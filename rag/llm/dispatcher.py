@@ -0,0 +1,177 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import logging
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from rag import settings
+from rag.utils import num_tokens_from_string
+
+
+class TokenBucket:
+    """
+    Allows `rate` units per minute with bursts of up to one minute's worth.
+    A rate <= 0 means unlimited.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / 60.)
+        self.updated = now
+
+    def acquire(self, n=1):
+        """Block until `n` units are available and take them."""
+        if self.rate <= 0:
+            return
+        n = min(n, self.rate)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) * 60. / self.rate
+            time.sleep(wait)
+
+    def consume(self, n):
+        """Take `n` units without waiting; the bucket may go into debt."""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+
+
+class LLMDispatcher:
+    """
+    Throttles the chat calls made to one provider: at most `concurrency`
+    requests in flight, `rpm` requests and `tpm` tokens per minute, and
+    failed calls retried with exponential backoff and jitter. One dispatcher
+    is shared by every caller of the provider in the process (see
+    `get_dispatcher`), so concurrent extractions add up against the same limits.
+    """
+
+    def __init__(self, name, concurrency=settings.LLM_CONCURRENCY, rpm=settings.LLM_RPM, tpm=settings.LLM_TPM,
+                 max_retries=settings.LLM_MAX_RETRIES, backoff=settings.LLM_BACKOFF):
+        self.name = name
+        self.concurrency = max(1, int(concurrency))
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max(0, int(max_retries))
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def chat(self, llm, system, history, gen_conf):
+        """
+        `llm.chat(system, history, gen_conf)` within the limits. Responses
+        carrying "**ERROR**" count as failures; the last one is raised once
+        the retries are exhausted.
+        """
+        prompt_tokens = num_tokens_from_string(system + "".join(m["content"] for m in history))
+        for i in range(self.max_retries + 1):
+            self.requests.acquire()
+            self.tokens.acquire(prompt_tokens)
+            with self.slots:
+                try:
+                    response = llm.chat(system, history, gen_conf)
+                    if response.find("**ERROR**") >= 0:
+                        raise Exception(response)
+                    err = None
+                except Exception as e:
+                    err = e
+            with self.lock:
+                self.calls += 1
+            if err is None:
+                self.tokens.consume(num_tokens_from_string(response))
+                return response
+            if i == self.max_retries:
+                with self.lock:
+                    self.failures += 1
+                raise err
+            with self.lock:
+                self.retries += 1
+            delay = min(60, self.backoff * 2 ** i) * (0.5 + random.random())
+            logging.warning("LLM [{}] call failed ({}), retry {}/{} in {:.1f}s".format(
+                self.name, str(err)[:256], i + 1, self.max_retries, delay))
+            time.sleep(delay)
+
+    def map(self, func, items):
+        """
+        `[func(item) for item in items]` on up to `concurrency` threads, in
+        order. An item whose call raised gets None. `func` is expected to go
+        through `chat`, which holds the actual limits, so nested maps are safe.
+        """
+        items = list(items)
+        if not items:
+            return []
+
+        def run(item):
+            try:
+                return func(item)
+            except Exception as e:
+                logging.error("LLM [{}] dispatch: {}".format(self.name, str(e)))
+                traceback.print_exc()
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items))) as exe:
+            return list(exe.map(run, items))
+
+    def stats(self):
+        with self.lock:
+            return {"calls": self.calls, "retries": self.retries, "failures": self.failures}
+
+
+_DISPATCHERS = {}
+_DISPATCHERS_LOCK = threading.Lock()
+
+
+def provider_name(llm):
+    mdl = getattr(llm, "mdl", llm)
+    nm = getattr(mdl, "model_name", None)
+    return "{}/{}".format(mdl.__class__.__name__, nm) if nm else mdl.__class__.__name__
+
+
+def _limits(name):
+    """Settings overridden by LLM_RATE_LIMITS for "<chat class>/<model>", then "<chat class>"."""
+    try:
+        overrides = json.loads(settings.LLM_RATE_LIMITS) if settings.LLM_RATE_LIMITS else {}
+    except Exception as e:
+        logging.warning("LLM_RATE_LIMITS is not valid JSON: " + str(e))
+        overrides = {}
+    return overrides.get(name) or overrides.get(name.split("/")[0]) or {}
+
+
+def get_dispatcher(llm):
+    """The process-wide dispatcher of the provider behind `llm` (an LLMBundle or chat model)."""
+    name = provider_name(llm)
+    with _DISPATCHERS_LOCK:
+        if name not in _DISPATCHERS:
+            _DISPATCHERS[name] = LLMDispatcher(name, **_limits(name))
+        return _DISPATCHERS[name]
@@ -25,6 +25,7 @@ from abc import ABC
 from ollama import Client
 import dashscope
 from openai import OpenAI
+from rag.llm.http_client import shared_http_client
 import numpy as np
 import asyncio
 
@@ -98,7 +99,7 @@ class OpenAIEmbed(Base):
                  base_url="https://api.openai.com/v1"):
         if not base_url:
             base_url = "https://api.openai.com/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
@@ -120,7 +121,7 @@ class LocalAIEmbed(Base):
             raise ValueError("Local embedding model url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="empty", base_url=base_url)
+        self.client = OpenAI(api_key="empty", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name.split("___")[0]
 
     def encode(self, texts: list, batch_size=32):
@@ -137,7 +138,8 @@ class LocalAIEmbed(Base):
 
 class AzureEmbed(OpenAIEmbed):
     def __init__(self, key, model_name, **kwargs):
-        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01")
+        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01",
+                                  http_client=shared_http_client())
         self.model_name = model_name
 
 
@@ -151,6 +153,9 @@ class BaiChuanEmbed(OpenAIEmbed):
 
 
 class QWenEmbed(Base):
+    # Sets the process-wide dashscope key when built, so a kept instance would call with the key of the last one built.
+    reusable = False
+
     def __init__(self, key, model_name="text_embedding_v2", **kwargs):
         dashscope.api_key = key
         self.model_name = model_name
@@ -272,7 +277,7 @@ class XinferenceEmbed(Base):
     def __init__(self, key, model_name="", base_url=""):
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="xxx", base_url=base_url)
+        self.client = OpenAI(api_key="xxx", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
@@ -448,6 +453,9 @@ class BedrockEmbed(Base):
         return np.array(embeddings), token_count
 
 class GeminiEmbed(Base):
+    # Configures the process-wide genai key when built, so a kept instance would call with the key of the last one built.
+    reusable = False
+
     def __init__(self, key, model_name='models/text-embedding-004',
                  **kwargs):
         genai.configure(api_key=key)
@@ -517,7 +525,7 @@ class LmStudioEmbed(LocalAIEmbed):
             raise ValueError("Local llm url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="lm-studio", base_url=base_url)
+        self.client = OpenAI(api_key="lm-studio", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
 
 
@@ -527,7 +535,7 @@ class OpenAI_APIEmbed(OpenAIEmbed):
             raise ValueError("url cannot be None")
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name.split("___")[0]
 
 
@@ -0,0 +1,56 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import threading
+
+import httpx
+from openai import DefaultHttpxClient
+
+from rag import settings
+
+_CLIENTS = {}
+_LOCK = threading.Lock()
+
+
+def _http2():
+    if not settings.LLM_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logging.warning("LLM_HTTP2 is set but the h2 package is not installed, using HTTP/1.1")
+        return False
+
+
+def shared_http_client() -> httpx.Client:
+    """
+    The keep-alive connection pool shared by the OpenAI-compatible clients of
+    the process, so that model instances of every tenant reuse the open TLS
+    connections to a provider. One pool per process, as connections must not
+    be shared across a fork.
+    """
+    pid = os.getpid()
+    with _LOCK:
+        if pid not in _CLIENTS:
+            _CLIENTS.clear()
+            _CLIENTS[pid] = DefaultHttpxClient(
+                http2=_http2(),
+                limits=httpx.Limits(max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE,
+                                    keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY))
+        return _CLIENTS[pid]
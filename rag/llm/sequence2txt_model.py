@@ -19,6 +19,7 @@ import io
 from abc import ABC
 from ollama import Client
 from openai import OpenAI
+from rag.llm.http_client import shared_http_client
 import os
 import json
 from rag.utils import num_tokens_from_string
@@ -48,11 +49,14 @@ class Base(ABC):
 class GPTSeq2txt(Base):
     def __init__(self, key, model_name="whisper-1", base_url="https://api.openai.com/v1"):
         if not base_url: base_url = "https://api.openai.com/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
 
 
 class QWenSeq2txt(Base):
+    # Sets the process-wide dashscope key when built, so a kept instance would call with the key of the last one built.
+    reusable = False
+
     def __init__(self, key, model_name="paraformer-realtime-8k-v1", **kwargs):
         import dashscope
         dashscope.api_key = key
@@ -86,7 +90,8 @@ class OllamaSeq2txt(Base):
 
 class AzureSeq2txt(Base):
     def __init__(self, key, model_name, lang="Chinese", **kwargs):
-        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01")
+        self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01",
+                                  http_client=shared_http_client())
         self.model_name = model_name
         self.lang = lang
 
@@ -95,7 +100,7 @@ class XinferenceSeq2txt(Base):
     def __init__(self, key, model_name="", base_url=""):
         if base_url.split("/")[-1] != "v1":
             base_url = os.path.join(base_url, "v1")
-        self.client = OpenAI(api_key="xxx", base_url=base_url)
+        self.client = OpenAI(api_key="xxx", base_url=base_url, http_client=shared_http_client())
         self.model_name = model_name
 
 
@@ -116,6 +116,9 @@ class FishAudioTTS(Base):
 
 
 class QwenTTS(Base):
+    # Sets the process-wide dashscope key when built, so a kept instance would call with the key of the last one built.
+    reusable = False
+
     def __init__(self, key, model_name, base_url=""):
         import dashscope
 
@@ -213,9 +216,6 @@ class SparkTTS:
         self.APIKey = key.get("spark_api_key", "xxxxxx")
         self.model_name = model_name
         self.CommonArgs = {"app_id": self.APPID}
-        self.audio_queue = queue.Queue()
-
-    # 用来存储音频数据
 
     # 生成url
     def create_url(self):
@@ -243,7 +243,8 @@ class SparkTTS:
         BusinessArgs = {"aue": "lame", "sfl": 1, "auf": "audio/L16;rate=16000", "vcn": self.model_name, "tte": "utf8"}
         Data = {"status": 2, "text": base64.b64encode(text.encode('utf-8')).decode('utf-8')}
         CommonArgs = {"app_id": self.APPID}
-        audio_queue = self.audio_queue
+        # 用来存储音频数据, one queue per call so concurrent calls don't read each other's audio
+        audio_queue = queue.Queue()
         model_name = self.model_name
 
         class Callback:
@@ -288,7 +289,7 @@ class SparkTTS:
         status_code = 0
         ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
         while True:
-            audio_chunk = self.audio_queue.get()
+            audio_chunk = audio_queue.get()
             if audio_chunk is None:
                 if status_code == 0:
                     raise Exception(
@@ -19,7 +19,13 @@ import math
 import re
 import logging
 import copy
+import hashlib
+import threading
+
+import numpy as np
+from cachetools import LRUCache
 from elasticsearch_dsl import Q
+from scipy.sparse import csr_matrix
 
 from rag.nlp import rag_tokenizer, term_weight, synonym
 
@@ -29,6 +35,8 @@ class EsQueryer:
         self.es = es
         self.syn = synonym.Dealer()
         self.flds = ["ask_tks^10", "ask_small_tks"]
+        self.term_cache = LRUCache(maxsize=100000)
+        self.term_lock = threading.Lock()
 
     @staticmethod
     def subSpecialChar(line):
@@ -153,27 +161,61 @@ class EsQueryer:
 
     def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3,
                           vtweight=0.7):
-        from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
-        sims = CosineSimilarity([avec], bvecs)
+        avec = np.asarray(avec, dtype=np.float64)
+        bvecs = np.asarray(bvecs, dtype=np.float64)
+        norms = np.linalg.norm(bvecs, axis=1) * np.linalg.norm(avec)
+        sims = np.divide(bvecs @ avec, norms, out=np.zeros(len(bvecs)), where=norms > 0)
         tksim = self.token_similarity(atks, btkss)
-        return np.array(sims[0]) * vtweight + \
-            np.array(tksim) * tkweight, tksim, sims[0]
+        return sims * vtweight + tksim * tkweight, tksim, sims
+
+    def toDict(self, tks):
+        d = {}
+        if isinstance(tks, str):
+            tks = tks.split(" ")
+        for t, c in self.tw.weights(tks):
+            if t not in d:
+                d[t] = 0
+            d[t] += c
+        return d
+
+    def chunk_terms(self, tks):
+        """
+        Distinct weighted terms of a chunk. Only their presence counts in
+        `similarity`, so they are cached per chunk content.
+        """
+        if isinstance(tks, str):
+            tks = tks.split(" ")
+        k = hashlib.md5(" ".join(tks).encode("utf-8")).digest()
+        with self.term_lock:
+            terms = self.term_cache.get(k)
+        if terms is None:
+            terms = frozenset(self.toDict(tks).keys())
+            with self.term_lock:
+                self.term_cache[k] = terms
+        return terms
 
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            d = {}
-            if isinstance(tks, str):
-                tks = tks.split(" ")
-            for t, c in self.tw.weights(tks):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+        """
+        Vectorized `similarity` of the query against every chunk: a sparse
+        chunk x query-term presence matrix times the query term weights.
+        """
+        qtwt = self.toDict(atks)
+        col = {t: i for i, t in enumerate(qtwt.keys())}
+        qw = np.array(list(qtwt.values()), dtype=np.float64)
+
+        indices, indptr, dlen = [], [0], np.zeros(len(btkss))
+        for i, tks in enumerate(btkss):
+            terms = self.chunk_terms(tks)
+            dlen[i] = len(terms)
+            indices.extend(col[t] for t in terms if t in col)
+            indptr.append(len(indices))
+        s = np.full(len(btkss), 1e-9)
+        if col:
+            m = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(btkss), len(col)))
+            s += m @ qw
+        q = 1e-9 + qw.sum()
+        n = np.maximum(np.maximum(dlen, len(col)), 1)
+        return s / q / np.maximum(1, np.sqrt(np.log10(n)))
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
@@ -17,15 +17,20 @@
 import copy
 import datrie
 import math
+import multiprocessing
 import os
 import re
 import string
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from cachetools import LRUCache
 from hanziconv import HanziConv
 from huggingface_hub import snapshot_download
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
+from rag import settings
 
 
 class RagTokenizer:
@@ -59,6 +64,11 @@ class RagTokenizer:
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
         self.trie_ = datrie.Trie(string.printable)
+        # tokenize and fine_grained_tokenize results of the current dictionaries
+        self.cache_ = LRUCache(maxsize=settings.TOKENIZER_CACHE_SIZE)
+        self.cache_lock_ = threading.Lock()
+        # user dictionaries loaded, replayed in the tokenize_batch workers
+        self.dicts_ = []
         self.DIR_ = os.path.join(get_project_base_directory(), "rag/res", "huqie")
 
         self.stemmer = PorterStemmer()
@@ -75,6 +85,8 @@ class RagTokenizer:
         self.loadDict_(self.DIR_ + ".txt")
 
     def loadUserDict(self, fnm):
+        self.clear_cache()
+        self.dicts_ = [("load", fnm)]
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
             return
@@ -83,8 +95,24 @@ class RagTokenizer:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        self.clear_cache()
+        self.dicts_.append(("add", fnm))
         self.loadDict_(fnm)
 
+    def clear_cache(self):
+        with self.cache_lock_:
+            self.cache_.clear()
+
+    def cached_(self, kind, line, func):
+        k = (kind, line)
+        with self.cache_lock_:
+            if k in self.cache_:
+                return self.cache_[k]
+        res = func(line)
+        with self.cache_lock_:
+            self.cache_[k] = res
+        return res
+
     def _strQ2B(self, ustring):
         """把字符串全角转半角"""
         rstring = ""
@@ -152,6 +180,81 @@ class RagTokenizer:
 
         return self.dfs_(chars, s + 1, preTks, tkslist)
 
+    def segment_(self, chars, topn=1):
+        """
+        The first `topn` token lists of `sortTks_(tkslist)`, tkslist being the
+        segmentations `dfs_(chars, 0, [], tkslist)` enumerates, computed over
+        the word lattice instead of enumerating every path.
+
+        `dfs_` explores the words of the trie starting at each position, with
+        pruning that only depends on the position and the number of single
+        character tokens just before it (up to 3). The score of a
+        segmentation only depends on its number of tokens, number of multi-
+        character tokens and sum of frequencies, so for each state
+        (position, trailing single characters) the suffixes are grouped by
+        those three numbers, keeping the `topn` lexicographically first ones:
+        `dfs_` enumerates in lexicographic order of the token ends, which is
+        how `sortTks_` breaks ties.
+        """
+        prefixes, words = {}, {}
+
+        def has_prefix(t):
+            if t not in prefixes:
+                prefixes[t] = self.trie_.has_keys_with_prefix(self.key_(t))
+            return prefixes[t]
+
+        def word(t):
+            if t not in words:
+                k = self.key_(t)
+                words[t] = self.trie_[k] if k in self.trie_ else None
+            return words[t]
+
+        memo = {}
+
+        def suffixes(s, trail):
+            if s >= len(chars):
+                return {(0, 0, 0): [()]}
+            if (s, trail) in memo:
+                return memo[(s, trail)]
+
+            # the pruning of dfs_
+            S = s + 1
+            if s + 2 <= len(chars) and has_prefix(chars[s:s + 1]) and not has_prefix(chars[s:s + 2]):
+                S = s + 2
+            if trail >= 3 and has_prefix(chars[s - 1:s + 1]):
+                S = s + 2
+
+            edges = []
+            for e in range(S, len(chars) + 1):
+                t = chars[s:e]
+                if e > s + 1 and not has_prefix(t):
+                    break
+                w = word(t)
+                if w is not None:
+                    edges.append((e, w[0]))
+            if not edges:
+                w = word(chars[s:s + 1])
+                edges.append((s + 1, w[0] if w is not None else -12))
+
+            res = {}
+            for e, f in edges:
+                long = 1 if e - s > 1 else 0
+                for (n, L, F), paths in suffixes(e, 0 if long else min(trail + 1, 3)).items():
+                    top = res.setdefault((n + 1, L + long, F + f), [])
+                    for p in paths[:topn - len(top)]:
+                        top.append((e,) + p)
+            memo[(s, trail)] = res
+            return res
+
+        B = 30
+        candidates = []
+        for (n, L, F), paths in suffixes(0, 0).items():
+            # the arithmetic of score_, for identical ties
+            score = B / n + L / n + F / n
+            candidates.extend((-score, p) for p in paths)
+        candidates.sort()
+        return [[chars[b:e] for b, e in zip((0,) + p, p)] for _, p in candidates[:topn]]
+
     def freq(self, tk):
         k = self.key_(tk)
         if k not in self.trie_:
@@ -259,6 +362,9 @@ class RagTokenizer:
         return [self.stemmer.stem(self.lemmatizer.lemmatize(t)) if re.match(r"[a-zA-Z_-]+$", t) else t for t in tks]
 
     def tokenize(self, line):
+        return self.cached_("tks", line, self.tokenize_)
+
+    def tokenize_(self, line):
         line = self._strQ2B(line).lower()
         line = self._tradi2simp(line)
         zh_num = len([1 for c in line if is_chinese(c)])
@@ -304,9 +410,7 @@ class RagTokenizer:
                 while e < len(tks) and e - s < 5 and diff[e] == 1:
                     e += 1
 
-                tkslist = []
-                self.dfs_("".join(tks[s:e + 1]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+                res.append(" ".join(self.segment_("".join(tks[s:e + 1]))[0]))
 
                 i = e + 1
 
@@ -316,6 +420,9 @@ class RagTokenizer:
         return self.merge_(res)
 
     def fine_grained_tokenize(self, tks):
+        return self.cached_("fine", tks, self.fine_grained_tokenize_)
+
+    def fine_grained_tokenize_(self, tks):
         tks = tks.split(" ")
         zh_num = len([1 for c in tks if c and is_chinese(c[0])])
         if zh_num < len(tks) * 0.2:
@@ -329,15 +436,14 @@ class RagTokenizer:
             if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
                 res.append(tk)
                 continue
-            tkslist = []
             if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
+                res.append(tk)
+                continue
+            tkslist = self.segment_(tk, topn=2)
             if len(tkslist) < 2:
                 res.append(tk)
                 continue
-            stk = self.sortTks_(tkslist)[1][0]
+            stk = tkslist[1]
             if len(stk) == len(tk):
                 stk = tk
             else:
@@ -356,6 +462,52 @@ class RagTokenizer:
         return " ".join(self.english_normalize_(res))
 
 
+    def tokenize_batch(self, lines, workers=settings.TOKENIZER_WORKERS):
+        """
+        `[self.tokenize(line) for line in lines]`, spread over `workers`
+        processes for large inputs.
+        """
+        lines = list(lines)
+        if workers < 2 or len(lines) < settings.TOKENIZER_POOL_MIN_LINES:
+            return [self.tokenize(line) for line in lines]
+        pool = _pool(workers, tuple(self.dicts_))
+        n = max(64, math.ceil(len(lines) / (workers * 4)))
+        res = []
+        for tks in pool.map(_tokenize_lines, [lines[i: i + n] for i in range(0, len(lines), n)]):
+            res.extend(tks)
+        return res
+
+
+_POOL = None
+_POOL_KEY = None
+_POOL_LOCK = threading.Lock()
+
+
+def _init_worker(dicts):
+    for op, fnm in dicts:
+        if op == "load":
+            tokenizer.loadUserDict(fnm)
+        else:
+            tokenizer.addUserDict(fnm)
+
+
+def _tokenize_lines(lines):
+    return [tokenizer.tokenize(line) for line in lines]
+
+
+def _pool(workers, dicts):
+    global _POOL, _POOL_KEY
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_KEY != (workers, dicts):
+            if _POOL is not None:
+                _POOL.shutdown(wait=False)
+            _POOL = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker, initargs=(dicts,))
+            _POOL_KEY = (workers, dicts)
+        return _POOL
+
+
 def is_chinese(s):
     if s >= u'\u4e00' and s <= u'\u9fa5':
         return True
@@ -390,6 +542,7 @@ def naiveQie(txt):
 
 tokenizer = RagTokenizer()
 tokenize = tokenizer.tokenize
+tokenize_batch = tokenizer.tokenize_batch
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
 tag = tokenizer.tag
 freq = tokenizer.freq
@@ -22,8 +22,10 @@ from elasticsearch_dsl import Q, Search
 from typing import List, Optional, Dict, Union
 from dataclasses import dataclass
 
+from rag import settings
 from rag.settings import es_logger
 from rag.utils import rmSpace
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE, model_id
 from rag.nlp import rag_tokenizer, query, is_english
 import numpy as np
 
@@ -205,6 +207,9 @@ class Dealer:
         for d in self.es.getSource(sres):
             m = {n: d.get(n) for n in flds if d.get(n) is not None}
             for n, v in m.items():
+                if n.endswith("_vec"):
+                    m[n] = np.asarray(v, dtype=np.float32)
+                    continue
                 if isinstance(v, type([])):
                     m[n] = "\t".join([str(vv) if not isinstance(
                         vv, list) else "\t".join([str(vvv) for vvv in vv]) for vv in v])
@@ -222,6 +227,22 @@ class Dealer:
     def trans2floats(txt):
         return [float(t) for t in txt.split("\t")]
 
+    @staticmethod
+    def vectors(sres, ids=None):
+        """
+        Stack the vectors of `ids` (all hits by default) into one contiguous
+        float32 matrix, with zero rows for chunks lacking a vector.
+        """
+        ids = sres.ids if ids is None else ids
+        dim = len(sres.query_vector)
+        fld = "q_%d_vec" % dim
+        mtx = np.zeros((len(ids), dim), dtype=np.float32)
+        for i, id in enumerate(ids):
+            v = sres.field[id].get(fld)
+            if v is not None and len(v) == dim:
+                mtx[i] = v
+        return mtx
+
     def insert_citations(self, answer, chunks, chunk_v,
                          embd_mdl, tkweight=0.1, vtweight=0.9):
         assert len(chunks) == len(chunk_v)
@@ -265,6 +286,7 @@ class Dealer:
             return answer, set([])
 
         ans_v, _ = embd_mdl.encode(pieces_)
+        chunk_v = np.asarray(chunk_v, dtype=np.float64)
         assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
                 len(ans_v[0]), len(chunk_v[0]))
 
@@ -309,11 +331,9 @@ class Dealer:
     def rerank(self, sres, query, tkweight=0.3,
                vtweight=0.7, cfield="content_ltks"):
         _, keywords = self.qryr.question(query)
-        ins_embd = [
-            Dealer.trans2floats(
-                sres.field[i].get("q_%d_vec" % len(sres.query_vector), "\t".join(["0"] * len(sres.query_vector)))) for i in sres.ids]
-        if not ins_embd:
+        if not sres.ids:
             return [], [], []
+        ins_embd = Dealer.vectors(sres)
 
         for i in sres.ids:
             if isinstance(sres.field[i].get("important_kwd", []), str):
@@ -363,6 +383,17 @@ class Dealer:
         ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
         if not question:
             return ranks
+        cache_key, cacheable = None, False
+        if settings.RETRIEVAL_CACHE:
+            cache_key, cacheable = RETRIEVAL_CACHE.key(
+                kb_ids, question, searcher=self.__class__.__name__, tenant_id=tenant_id, doc_ids=doc_ids,
+                page=page, page_size=page_size, similarity_threshold=similarity_threshold,
+                vector_similarity_weight=vector_similarity_weight, top=top, aggs=aggs, highlight=highlight,
+                embd_mdl=model_id(embd_mdl), rerank_mdl=model_id(rerank_mdl))
+            if cache_key:
+                cached = RETRIEVAL_CACHE.get(cache_key)
+                if cached is not None:
+                    return cached
         RERANK_PAGE_LIMIT = 3
         req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size*RERANK_PAGE_LIMIT,
                "question": question, "vector": True, "topk": top,
@@ -386,7 +417,8 @@ class Dealer:
             sim = tsim = vsim = [1]*len(sres.ids)
             idx = list(range(len(sres.ids)))
 
-        dim = len(sres.query_vector)
+        ids = [sres.ids[i] for i in idx]
+        vecs = dict(zip(ids, self.vectors(sres, ids)))
         for i in idx:
             if sim[i] < similarity_threshold:
                 break
@@ -409,7 +441,7 @@ class Dealer:
                 "similarity": sim[i],
                 "vector_similarity": vsim[i],
                 "term_similarity": tsim[i],
-                "vector": self.trans2floats(sres.field[id].get("q_%d_vec" % dim, "\t".join(["0"] * dim))),
+                "vector": vecs[id],
                 "positions": sres.field[id].get("position_int", "").split("\t")
             }
             if highlight:
@@ -433,6 +465,8 @@ class Dealer:
                              v in sorted(ranks["doc_aggs"].items(),
                                          key=lambda x:x[1]["count"] * -1)]
 
+        if cache_key and cacheable:
+            RETRIEVAL_CACHE.set(cache_key, ranks)
         return ranks
 
     def sql_retrieval(self, sql, fetch_size=128, format="json"):
@@ -463,6 +497,14 @@ class Dealer:
             chat_logger.error(f"SQL failure: {sql} =>" + str(e))
             return {"error": str(e)}
 
+    def chunk_ids(self, doc_id, tenant_id, filter=None, fields=[]):
+        """{chunk id: {field: value}} of every indexed chunk of the document."""
+        q = Q("match", doc_id=doc_id)
+        if filter is not None:
+            q = q & filter
+        return {hit["_id"]: hit.get("_source", {})
+                for hit in self.es.scan(q, idxnm=index_name(tenant_id), src=fields if fields else False)}
+
     def chunk_list(self, doc_id, tenant_id, max_count=1024, fields=["docnm_kwd", "content_with_weight", "img_id"]):
         s = Search()
         s = s.query(Q("match", doc_id=doc_id))[0:max_count]
@@ -33,7 +33,62 @@ except Exception as e:
     REDIS = {}
     pass
 NEO4J=get_base_config("neo4j", {})
+NEO4J_SYNC_BATCH = int(os.environ.get("NEO4J_SYNC_BATCH", 5000))
+NEO4J_SYNC_CONCURRENCY = int(os.environ.get("NEO4J_SYNC_CONCURRENCY", 4))
+GRAPH_STORE_SHARDS = int(os.environ.get("GRAPH_STORE_SHARDS", 16))
+GRAPH_STORE_MAX_DELTAS = int(os.environ.get("GRAPH_STORE_MAX_DELTAS", 32))
+LEIDEN_WORKERS = int(os.environ.get("LEIDEN_WORKERS", 4))
+# Below this many edges to cluster, components are clustered in-process.
+LEIDEN_POOL_MIN_EDGES = int(os.environ.get("LEIDEN_POOL_MIN_EDGES", 5000))
+LEIDEN_CACHE_TTL = int(os.environ.get("LEIDEN_CACHE_TTL", 7 * 24 * 3600))
+COMMUNITY_REPORT_CACHE_TTL = int(os.environ.get("COMMUNITY_REPORT_CACHE_TTL", 7 * 24 * 3600))
+# graphrag.file_cache: local LRU directory, plus "storage" or "redis" to share results between executors.
+FILE_CACHE_DIR = os.environ.get("FILE_CACHE_DIR", ".cache")
+FILE_CACHE_MAX_BYTES = int(os.environ.get("FILE_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+FILE_CACHE_TTL = int(os.environ.get("FILE_CACHE_TTL", 7 * 24 * 3600))
+FILE_CACHE_SHARED = os.environ.get("FILE_CACHE_SHARED", "").lower()
+FILE_CACHE_BUCKET = os.environ.get("FILE_CACHE_BUCKET", "graphrag-cache")
+ES_BULK_MAX_BYTES = int(os.environ.get("ES_BULK_MAX_BYTES", 8 * 1024 * 1024))
+ES_BULK_CONCURRENCY = int(os.environ.get("ES_BULK_CONCURRENCY", 4))
+ES_BULK_RETRIES = int(os.environ.get("ES_BULK_RETRIES", 5))
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
+EMBEDDING_CACHE = os.environ.get("EMBEDDING_CACHE", "1").lower() in ["1", "true", "yes"]
+EMBEDDING_CACHE_LRU_SIZE = int(os.environ.get("EMBEDDING_CACHE_LRU_SIZE", 10000))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+RETRIEVAL_CACHE = os.environ.get("RETRIEVAL_CACHE", "1").lower() in ["1", "true", "yes"]
+RETRIEVAL_CACHE_LRU_SIZE = int(os.environ.get("RETRIEVAL_CACHE_LRU_SIZE", 1000))
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL", 3600))
+# Writes become searchable after the next ES refresh, so results aren't cached right after one.
+RETRIEVAL_CACHE_SETTLE = int(os.environ.get("RETRIEVAL_CACHE_SETTLE", 3))
+# rag_tokenizer: results of repeated lines are cached; tokenize_batch uses worker processes for large inputs.
+TOKENIZER_CACHE_SIZE = int(os.environ.get("TOKENIZER_CACHE_SIZE", 10000))
+TOKENIZER_WORKERS = int(os.environ.get("TOKENIZER_WORKERS", 0))
+TOKENIZER_POOL_MIN_LINES = int(os.environ.get("TOKENIZER_POOL_MIN_LINES", 2000))
+# Online-mode LLM calls per provider; rpm/tpm of 0 mean unlimited.
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 8))
+LLM_RPM = int(os.environ.get("LLM_RPM", 0))
+LLM_TPM = int(os.environ.get("LLM_TPM", 0))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 3))
+LLM_BACKOFF = float(os.environ.get("LLM_BACKOFF", 2))
+# JSON like {"QWenChat/qwen-plus": {"concurrency": 16, "rpm": 600, "tpm": 1000000}}
+LLM_RATE_LIMITS = os.environ.get("LLM_RATE_LIMITS", "")
+# Keep-alive connections shared by the OpenAI-compatible clients; HTTP/2 needs the h2 package.
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "0").lower() in ["1", "true", "yes"]
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", 200))
+LLM_HTTP_MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", 50))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", 60))
+# Model instances reused per tenant; the tenant's model settings are re-read from the DB after MODEL_CONFIG_TTL.
+MODEL_INSTANCE_CACHE_SIZE = int(os.environ.get("MODEL_INSTANCE_CACHE_SIZE", 512))
+MODEL_INSTANCE_TTL = int(os.environ.get("MODEL_INSTANCE_TTL", 3600))
+MODEL_CONFIG_TTL = int(os.environ.get("MODEL_CONFIG_TTL", 30))
+# Token usage is summed in Redis and written to tenant_llm in batches; unflushed claims are retried after the stale age.
+USAGE_FLUSH_INTERVAL = int(os.environ.get("USAGE_FLUSH_INTERVAL", 10))
+USAGE_FLUSH_SIZE = int(os.environ.get("USAGE_FLUSH_SIZE", 1000))
+USAGE_FLUSH_STALE = int(os.environ.get("USAGE_FLUSH_STALE", 300))
+# Batch-mode LLM calls: batches submitted at once, polled with backoff from the min interval up to BATCH_QUERY_INTERVAL.
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+BATCH_QUERY_MIN_INTERVAL = int(os.environ.get("BATCH_QUERY_MIN_INTERVAL", 5))
+BATCH_QUERY_INTERVAL = int(os.environ.get("BATCH_QUERY_INTERVAL", 60))
 
 # Logger
 LoggerFactory.set_directory(
@@ -58,3 +113,19 @@ SVR_QUEUE_RETENTION = 60*60
 SVR_QUEUE_MAX_LEN = 1024
 SVR_CONSUMER_NAME = "rag_flow_svr_consumer"
 SVR_CONSUMER_GROUP_NAME = "rag_flow_svr_consumer_group"
+
+# Task events: cancellations pushed to executors, progress pushed to the document progress aggregator,
+# which also re-checks every unfinished document each PROGRESS_RESYNC_INTERVAL seconds.
+TASK_CANCEL_TTL = int(os.environ.get("TASK_CANCEL_TTL", 24 * 3600))
+PROGRESS_BATCH_INTERVAL = float(os.environ.get("PROGRESS_BATCH_INTERVAL", 1))
+PROGRESS_RESYNC_INTERVAL = int(os.environ.get("PROGRESS_RESYNC_INTERVAL", 60))
+PROGRESS_STREAM_MAX_LEN = int(os.environ.get("PROGRESS_STREAM_MAX_LEN", 100000))
+
+# Pipelined task executor: download, parse, embed and index run as separate
+# stages with their own worker pools, connected by bounded queues.
+TASK_EXECUTOR_PIPELINE = os.environ.get("TASK_EXECUTOR_PIPELINE", "0").lower() in ["1", "true", "yes"]
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 4))
+PIPELINE_DOWNLOAD_WORKERS = int(os.environ.get("PIPELINE_DOWNLOAD_WORKERS", 2))
+PIPELINE_PARSE_WORKERS = int(os.environ.get("PIPELINE_PARSE_WORKERS", 2))
+PIPELINE_EMBED_WORKERS = int(os.environ.get("PIPELINE_EMBED_WORKERS", 2))
+PIPELINE_INDEX_WORKERS = int(os.environ.get("PIPELINE_INDEX_WORKERS", 2))
@@ -33,6 +33,9 @@ from rag.utils.storage_factory import STORAGE_IMPL
 from api.db.db_models import close_connection
 from rag.settings import database_logger, SVR_QUEUE_NAME
 from rag.settings import cron_logger, DOC_MAXIMUM_SIZE
+from rag.settings import TASK_EXECUTOR_PIPELINE, PIPELINE_QUEUE_SIZE, PIPELINE_DOWNLOAD_WORKERS, \
+    PIPELINE_PARSE_WORKERS, PIPELINE_EMBED_WORKERS, PIPELINE_INDEX_WORKERS
+from rag.utils.pipeline import Stage, Pipeline
 from multiprocessing import Pool
 import numpy as np
 from elasticsearch_dsl import Q, Search
@@ -51,8 +54,12 @@ from rag.app import laws, paper, presentation, manual, qa, table, book, resume,
 from api.db import LLMType, ParserType
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
+from graphrag.kb_graph import retire
 from api.utils.file_utils import get_project_base_directory
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.embedding_cache import EMBEDDING_CACHE
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
+from rag.utils.task_events import TASK_EVENTS
 
 BATCH_SIZE = 64
 
@@ -76,13 +83,18 @@ FACTORY = {
 
 CONSUMEER_NAME = "task_consumer_" + ("0" if len(sys.argv) < 2 else sys.argv[1])
 PAYLOAD = None
+PIPELINE = None
+CANCELED_TASKS = set()
 
 def set_progress(task_id, from_page=0, to_page=-1,
-                 prog=None, msg="Processing..."):
+                 prog=None, msg="Processing...", doc_id=None):
     global PAYLOAD
     if prog is not None and prog < 0:
         msg = "[ERROR]" + msg
-    cancel = TaskService.do_cancel(task_id)
+    if doc_id:
+        cancel = TASK_EVENTS.is_canceled(doc_id)
+    else:
+        cancel = TaskService.do_cancel(task_id)
     if cancel:
         msg += " [Canceled]"
         prog = -1
@@ -95,21 +107,29 @@ def set_progress(task_id, from_page=0, to_page=-1,
         d["progress"] = prog
     try:
         TaskService.update_progress(task_id, d)
+        if doc_id:
+            TASK_EVENTS.progress(doc_id)
     except Exception as e:
         cron_logger.error("set_progress:({}), {}".format(task_id, str(e)))
 
     close_connection()
     if cancel:
+        if PIPELINE is not None:
+            # Other tasks share this process, so just let the pipeline drop it.
+            CANCELED_TASKS.add(task_id)
+            return
         if PAYLOAD:
             PAYLOAD.ack()
             PAYLOAD = None
         os._exit(0)
 
 
-def collect():
+def collect(recover=True):
     global CONSUMEER_NAME, PAYLOAD
     try:
-        PAYLOAD = REDIS_CONN.get_unacked_for(CONSUMEER_NAME, SVR_QUEUE_NAME, "rag_flow_svr_task_broker")
+        PAYLOAD = None
+        if recover:
+            PAYLOAD = REDIS_CONN.get_unacked_for(CONSUMEER_NAME, SVR_QUEUE_NAME, "rag_flow_svr_task_broker")
         if not PAYLOAD:
             PAYLOAD = REDIS_CONN.queue_consumer(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMEER_NAME)
         if not PAYLOAD:
@@ -134,6 +154,7 @@ def collect():
     tasks = pd.DataFrame(tasks)
     if msg.get("type", "") == "raptor":
         tasks["task_type"] = "raptor"
+    tasks["incremental"] = bool(msg.get("incremental"))
     return tasks
 
 
@@ -141,18 +162,7 @@ def get_storage_binary(bucket, name):
     return STORAGE_IMPL.get(bucket, name)
 
 
-def build(row):
-    if row["size"] > DOC_MAXIMUM_SIZE:
-        set_progress(row["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
-                                             (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
-        return []
-
-    callback = partial(
-        set_progress,
-        row["id"],
-        row["from_page"],
-        row["to_page"])
-    chunker = FACTORY[row["parser_id"].lower()]
+def fetch(row, callback):
     try:
         st = timer()
         bucket, name = File2DocumentService.get_storage_address(doc_id=row["doc_id"])
@@ -173,10 +183,33 @@ def build(row):
         traceback.print_exc()
         return
 
+    return binary
+
+
+def build(row, binary=None):
+    if row["size"] > DOC_MAXIMUM_SIZE:
+        set_progress(row["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
+                                             (int(DOC_MAXIMUM_SIZE / 1024 / 1024)), doc_id=row["doc_id"])
+        return []
+
+    callback = partial(
+        set_progress,
+        row["id"],
+        row["from_page"],
+        row["to_page"],
+        doc_id=row["doc_id"])
+    chunker = FACTORY[row["parser_id"].lower()]
+    st = timer()
+    if binary is None:
+        binary = fetch(row, callback)
+        if binary is None:
+            return
+
     try:
         cks = chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
                             to_page=row["to_page"], lang=row["language"], callback=callback,
-                            kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
+                            kb_id=row["kb_id"], doc_id=row["doc_id"], parser_config=row["parser_config"],
+                            tenant_id=row["tenant_id"])
         cron_logger.info(
             "Chunking({}) {}/{}".format(timer() - st, row["location"], row["name"]))
     except Exception as e:
@@ -187,7 +220,13 @@ def build(row):
         traceback.print_exc()
         return
 
-    return chuks2docs(row["kb_id"],row["doc_id"],cks,row["name"])
+    docs = chuks2docs(row["kb_id"],row["doc_id"],cks,row["name"])
+    # Lets an incremental re-parse tell which task of the document owns a chunk,
+    # and whether it was embedded by the knowledge base's current model.
+    for d in docs:
+        d["from_page_int"] = int(row["from_page"])
+        d["embd_kwd"] = row["embd_id"]
+    return docs
 
 def chuks2docs(kb_id,doc_id,cks,name=""):
     docs = []
@@ -239,6 +278,7 @@ def embedding(docs, mdl, parser_config={}, callback=None):
     tts, cnts = [rmSpace(d["title_tks"]) for d in docs if d.get("title_tks")], [
         re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", d["content_with_weight"]) for d in docs]
     tk_count = 0
+    weights = [max(1, num_tokens_from_string(c)) for c in cnts]
     if len(tts) == len(cnts):
         tts_ = np.array([])
         for i in range(0, len(tts), batch_size):
@@ -267,9 +307,14 @@ def embedding(docs, mdl, parser_config={}, callback=None):
              cnts) if len(tts) == len(cnts) else cnts
 
     assert len(vects) == len(docs)
+    # Each chunk keeps its share of the tokens, so an incremental re-parse can count the chunks it reuses.
+    total, acc, counted = sum(weights), 0, 0
     for i, d in enumerate(docs):
         v = vects[i].tolist()
         d["q_%d_vec" % len(v)] = v
+        acc += weights[i]
+        d["token_num_int"] = round(tk_count * acc / total) - counted
+        counted += d["token_num_int"]
     return tk_count
 
 
@@ -314,13 +359,80 @@ def run_raptor(row, chat_mdl, embd_mdl, callback=None):
     return res, tk_count
 
 
+def diff_chunks(row, cks):
+    """
+    Incremental re-parse: compare freshly built chunks with those already
+    indexed for this task's page range. Returns the chunks still to embed and
+    index, the number and the tokens of the unchanged ones, and a query
+    matching the indexed chunks this task no longer produces (None if there
+    are none). An indexed chunk is only reused if it was embedded by the
+    knowledge base's current model and records its tokens; the others are
+    embedded again.
+    """
+    last = max([t.from_page for t in TaskService.query(doc_id=row["doc_id"])] + [row["from_page"]]) == row["from_page"]
+    if last:
+        scope = Q("range", from_page_int={"gte": row["from_page"]})
+    else:
+        scope = Q("range", from_page_int={"gte": row["from_page"], "lt": row["to_page"]})
+    if row["from_page"] == 0:
+        # Chunks indexed before from_page_int was recorded.
+        scope = scope | ~Q("exists", field="from_page_int")
+
+    existing = retrievaler.chunk_ids(row["doc_id"], row["tenant_id"], scope, fields=["embd_kwd", "token_num_int"])
+    ids = set([c["_id"] for c in cks])
+    reusable = set([i for i in ids & set(existing.keys())
+                    if existing[i].get("embd_kwd") == row["embd_id"] and existing[i].get("token_num_int") is not None])
+    stale = list(set(existing.keys()) - ids)
+    cron_logger.info("Incremental({}): {} to embed, {} unchanged, {} stale chunks".format(
+        row["name"], len(ids - reusable), len(reusable), len(stale)))
+    return [c for c in cks if c["_id"] not in reusable], len(reusable), \
+        sum([existing[i]["token_num_int"] for i in reusable]), \
+        (Q("ids", values=stale) & scope) if stale else None
+
+
+def index(r, cks, tk_count, callback, unchanged=0, stale=None, unchanged_tokens=0):
+    init_kb(r)
+    chunk_count = len(set([c["_id"] for c in cks])) + unchanged
+    st = timer()
+    es_r = ELASTICSEARCH.bulk_index(cks, search.index_name(r["tenant_id"]),
+                                    callback=lambda done, total: callback(prog=0.8 + 0.1 * done / total, msg=""))
+    RETRIEVAL_CACHE.bump(r["kb_id"])
+
+    cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
+    if es_r:
+        callback(-1, f"Insert chunk error, detail info please check ragflow-logs/api/cron_logger.log. Please also check ES status!")
+        ELASTICSEARCH.deleteByQuery(
+            Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        RETRIEVAL_CACHE.bump(r["kb_id"])
+        cron_logger.error(str(es_r))
+    else:
+        if TaskService.do_cancel(r["id"]):
+            ELASTICSEARCH.deleteByQuery(
+                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+            RETRIEVAL_CACHE.bump(r["kb_id"])
+            return
+        if stale is not None:
+            ELASTICSEARCH.deleteByQuery(stale, idxnm=search.index_name(r["tenant_id"]))
+            RETRIEVAL_CACHE.bump(r["kb_id"])
+        if r["parser_id"].lower() == ParserType.KG.value and r["parser_config"].get("graph_incremental"):
+            # The graph entries the merge of the document replaced, now that the new ones are indexed.
+            retire(r["tenant_id"], r["kb_id"], r["doc_id"])
+        callback(1., "Done!")
+        DocumentService.increment_chunk_num(
+            r["doc_id"], r["kb_id"], tk_count + unchanged_tokens, chunk_count, 0)
+        cron_logger.info(
+            "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
+                r["id"], tk_count, len(cks), timer() - st))
+
+
 def main():
     rows = collect()
     if len(rows) == 0:
         return
 
     for _, r in rows.iterrows():
-        callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+        callback = partial(set_progress, r["id"], r["from_page"], r["to_page"], doc_id=r["doc_id"])
+        unchanged, unchanged_tokens, stale = 0, 0, None
         try:
             embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
         except Exception as e:
@@ -345,6 +457,8 @@ def main():
             if not cks:
                 callback(1., "No chunk! Done!")
                 continue
+            if r.get("incremental"):
+                cks, unchanged, unchanged_tokens, stale = diff_chunks(r, cks)
             # TODO: exception handler
             ## set_progress(r["did"], -1, "ERROR: ")
             callback(
@@ -360,33 +474,119 @@ def main():
             cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
             callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
 
-        init_kb(r)
-        chunk_count = len(set([c["_id"] for c in cks]))
-        st = timer()
-        es_r = ""
-        es_bulk_size = 4
-        for b in range(0, len(cks), es_bulk_size):
-            es_r = ELASTICSEARCH.bulk(cks[b:b + es_bulk_size], search.index_name(r["tenant_id"]))
-            if b % 128 == 0:
-                callback(prog=0.8 + 0.1 * (b + 1) / len(cks), msg="")
-
-        cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
-        if es_r:
-            callback(-1, f"Insert chunk error, detail info please check ragflow-logs/api/cron_logger.log. Please also check ES status!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-            cron_logger.error(str(es_r))
-        else:
-            if TaskService.do_cancel(r["id"]):
-                ELASTICSEARCH.deleteByQuery(
-                    Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-                continue
-            callback(1., "Done!")
-            DocumentService.increment_chunk_num(
-                r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
-            cron_logger.info(
-                "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
-                    r["id"], tk_count, len(cks), timer() - st))
+        index(r, cks, tk_count, callback, unchanged, stale, unchanged_tokens)
+
+
+def _pipe_download(ctx):
+    r, callback = ctx["row"], ctx["callback"]
+    if r["id"] in CANCELED_TASKS:
+        return
+    try:
+        ctx["embd_mdl"] = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+    except Exception as e:
+        callback(-1, msg=str(e))
+        cron_logger.error(str(e))
+        return
+    if r.get("task_type", "") == "raptor" or r["size"] > DOC_MAXIMUM_SIZE:
+        return ctx
+
+    ctx["binary"] = fetch(r, callback)
+    if ctx["binary"] is None:
+        return
+    return ctx
+
+
+def _pipe_parse(ctx):
+    r, callback = ctx["row"], ctx["callback"]
+    if r["id"] in CANCELED_TASKS:
+        return
+    if r.get("task_type", "") == "raptor":
+        try:
+            chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
+            ctx["cks"], ctx["tk_count"] = run_raptor(r, chat_mdl, ctx["embd_mdl"], callback)
+        except Exception as e:
+            callback(-1, msg=str(e))
+            cron_logger.error(str(e))
+            return
+        return ctx
+
+    st = timer()
+    cks = build(r, ctx.pop("binary", None))
+    cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
+    if cks is None:
+        return
+    if not cks:
+        callback(1., "No chunk! Done!")
+        return
+    if r.get("incremental"):
+        cks, ctx["unchanged"], ctx["unchanged_tokens"], ctx["stale"] = diff_chunks(r, cks)
+    callback(msg="Finished slicing files(%d). Start to embedding the content." % len(cks))
+    ctx["cks"] = cks
+    return ctx
+
+
+def _pipe_embed(ctx):
+    r, callback = ctx["row"], ctx["callback"]
+    if r["id"] in CANCELED_TASKS:
+        return
+    if r.get("task_type", "") == "raptor":
+        return ctx
+
+    st = timer()
+    try:
+        ctx["tk_count"] = embedding(ctx["cks"], ctx["embd_mdl"], r["parser_config"], callback)
+    except Exception as e:
+        callback(-1, "Embedding error:{}".format(str(e)))
+        cron_logger.error(e)
+        ctx["tk_count"] = 0
+    cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
+    callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
+    return ctx
+
+
+def _pipe_index(ctx):
+    r = ctx["row"]
+    if r["id"] in CANCELED_TASKS:
+        return
+    index(r, ctx["cks"], ctx["tk_count"], ctx["callback"], ctx.get("unchanged", 0), ctx.get("stale"),
+          ctx.get("unchanged_tokens", 0))
+    return ctx
+
+
+def _pipe_exit(ctx):
+    CANCELED_TASKS.discard(ctx["row"]["id"])
+    if ctx["payload"]:
+        ctx["payload"].ack()
+    close_connection()
+
+
+def pipeline_main():
+    global PAYLOAD, PIPELINE
+    # Messages left unacked by a previous run are replayed serially first:
+    # once the pipeline holds several in flight, `collect` would hand them out again.
+    while REDIS_CONN.get_unacked_for(CONSUMEER_NAME, SVR_QUEUE_NAME, "rag_flow_svr_task_broker"):
+        main()
+        if PAYLOAD:
+            PAYLOAD.ack()
+            PAYLOAD = None
+
+    PIPELINE = Pipeline([
+        Stage("download", _pipe_download, PIPELINE_DOWNLOAD_WORKERS),
+        Stage("parse", _pipe_parse, PIPELINE_PARSE_WORKERS),
+        Stage("embed", _pipe_embed, PIPELINE_EMBED_WORKERS),
+        Stage("index", _pipe_index, PIPELINE_INDEX_WORKERS),
+    ], queue_size=PIPELINE_QUEUE_SIZE, on_exit=_pipe_exit).start()
+
+    while True:
+        rows = collect(recover=False)
+        payload, PAYLOAD = PAYLOAD, None
+        if len(rows) == 0:
+            if payload:
+                payload.ack()
+            continue
+        for _, r in rows.iterrows():
+            PIPELINE.put({"row": r, "payload": payload,
+                          "callback": partial(set_progress, r["id"], r["from_page"], r["to_page"], doc_id=r["doc_id"])})
 
 
 def report_status():
@@ -400,6 +600,9 @@ def report_status():
             obj[CONSUMEER_NAME].append(timer())
             obj[CONSUMEER_NAME] = obj[CONSUMEER_NAME][-60:]
             REDIS_CONN.set_obj("TASKEXE", obj, 60*2)
+            if PIPELINE is not None:
+                cron_logger.info("Pipeline stats: {}".format(json.dumps(PIPELINE.stats())))
+            cron_logger.info("Embedding cache stats: {}".format(json.dumps(EMBEDDING_CACHE.stats())))
         except Exception as e:
             print("[Exception]:", str(e))
         time.sleep(30)
@@ -414,6 +617,9 @@ if __name__ == "__main__":
     exe = ThreadPoolExecutor(max_workers=1)
     exe.submit(report_status)
 
+    if TASK_EXECUTOR_PIPELINE:
+        pipeline_main()
+
     while True:
         main()
         if PAYLOAD:
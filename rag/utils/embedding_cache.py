@@ -0,0 +1,128 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import base64
+import hashlib
+import re
+import threading
+
+import numpy as np
+from cachetools import LRUCache
+
+from rag import settings
+from rag.utils.redis_conn import REDIS_CONN
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache with an in-process LRU tier in front of
+    a Redis tier. Entries are keyed by (model id, encode kind, md5 of the
+    normalized text), so identical texts are embedded once across tasks,
+    RAPTOR, graph updates and citation matching.
+    """
+
+    def __init__(self, lru_size=settings.EMBEDDING_CACHE_LRU_SIZE, ttl=settings.EMBEDDING_CACHE_TTL):
+        self.lru = LRUCache(maxsize=lru_size)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.lru_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def model_id(class_name, model_name, api_base=None, api_key=None):
+        """Identifies the vectors of a model served from `api_base` with `api_key`."""
+        endpoint = hashlib.md5("{}\n{}".format(api_base or "", api_key or "").encode("utf-8")).hexdigest()[:16]
+        return "{}/{}/{}".format(class_name, model_name, endpoint)
+
+    @staticmethod
+    def key(model_id, text, kind="doc"):
+        txt = re.sub(r"\s+", " ", text).strip()
+        return "embd:{}:{}:{}".format(model_id, kind, hashlib.md5(txt.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def _dumps(v):
+        v = np.asarray(v)
+        return v.dtype.str + ":" + base64.b64encode(v.tobytes()).decode("ascii")
+
+    @staticmethod
+    def _loads(s):
+        dt, b = s.split(":", 1)
+        return np.frombuffer(base64.b64decode(b), dtype=np.dtype(dt))
+
+    def get_many(self, keys):
+        res = [None] * len(keys)
+        with self.lock:
+            for i, k in enumerate(keys):
+                res[i] = self.lru.get(k)
+        lru_hits = len([v for v in res if v is not None])
+
+        missing = [i for i, v in enumerate(res) if v is None]
+        redis_hits = 0
+        if missing:
+            vals = REDIS_CONN.mget([keys[i] for i in missing]) or []
+            with self.lock:
+                for i, v in zip(missing, vals):
+                    if not v:
+                        continue
+                    try:
+                        res[i] = self._loads(v)
+                    except Exception:
+                        continue
+                    self.lru[keys[i]] = res[i]
+                    redis_hits += 1
+
+        with self.lock:
+            self.lru_hits += lru_hits
+            self.redis_hits += redis_hits
+            self.misses += len(keys) - lru_hits - redis_hits
+        return res
+
+    def set_many(self, keys, vectors):
+        with self.lock:
+            for k, v in zip(keys, vectors):
+                self.lru[k] = v
+        REDIS_CONN.mset({k: self._dumps(v) for k, v in zip(keys, vectors)}, self.ttl)
+
+    def encode(self, model_id, texts, encode_fn, kind="doc"):
+        """
+        Returns (vectors, used_tokens) like `encode_fn(texts)`, calling
+        `encode_fn` only for the texts not found in the cache.
+        """
+        keys = [self.key(model_id, t, kind) for t in texts]
+        vects = self.get_many(keys)
+
+        todo = {}
+        for i, v in enumerate(vects):
+            if v is None and keys[i] not in todo:
+                todo[keys[i]] = texts[i]
+        used_tokens = 0
+        if todo:
+            vts, used_tokens = encode_fn(list(todo.values()))
+            vts = [np.asarray(v) for v in vts]
+            self.set_many(list(todo.keys()), vts)
+            fresh = dict(zip(todo.keys(), vts))
+            vects = [fresh[keys[i]] if v is None else v for i, v in enumerate(vects)]
+
+        return np.array(vects), used_tokens
+
+    def stats(self):
+        with self.lock:
+            total = self.lru_hits + self.redis_hits + self.misses
+            return {"lru_hits": self.lru_hits, "redis_hits": self.redis_hits, "misses": self.misses,
+                    "hit_rate": (self.lru_hits + self.redis_hits) / total if total else 0.}
+
+
+EMBEDDING_CACHE = EmbeddingCache()
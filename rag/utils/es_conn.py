@@ -2,10 +2,13 @@ import re
 import json
 import time
 import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import elasticsearch
 from elastic_transport import ConnectionTimeout
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
 from elasticsearch_dsl import UpdateByQuery, Search, Index
 from rag.settings import es_logger
 from rag import settings
@@ -18,6 +21,7 @@ es_logger.info("Elasticsearch version: "+str(elasticsearch.__version__))
 class ESConnection:
     def __init__(self):
         self.info = {}
+        self.conn_lock = threading.Lock()
         self.conn()
         self.idxnm = settings.ES.get("index_name", "")
         if not self.es.ping():
@@ -149,6 +153,97 @@ class ESConnection:
 
         return res
 
+    @staticmethod
+    def _approx_size(d):
+        # Serializing just to measure would double the cost of indexing,
+        # so vectors are counted at ~20 bytes per float.
+        n = 0
+        for k, v in d.items():
+            n += len(k) + 6
+            if isinstance(v, (list, tuple)) and v and isinstance(v[0], float):
+                n += 20 * len(v)
+            else:
+                n += len(str(v))
+        return n
+
+    def _bulk_batch(self, docs, idx_nm, op_type):
+        failed, pending = [], docs
+        i, conn_errors = 0, 0
+        while i < settings.ES_BULK_RETRIES:
+            acts = []
+            for d in pending:
+                acts.append({op_type: {"_id": d["id"] if "id" in d else d["_id"], "_index": idx_nm}})
+                acts.append({k: v for k, v in d.items() if k not in ["id", "_id"]})
+            try:
+                if elasticsearch.__version__[0] < 8:
+                    r = self.es.bulk(index=idx_nm, body=acts, refresh=False, timeout="600s")
+                else:
+                    r = self.es.bulk(index=idx_nm, operations=acts, refresh=False, timeout="600s")
+            except Exception as e:
+                es_logger.warning("Fail to bulk: " + str(e))
+                # As in `bulk`: the whole batch is resent, after a pause on
+                # timeouts or on a new connection otherwise.
+                conn_errors += 1
+                if conn_errors >= 100:
+                    break
+                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
+                    time.sleep(3)
+                else:
+                    with self.conn_lock:
+                        self.conn()
+                continue
+
+            if not r["errors"]:
+                return failed
+            retry = []
+            for d, it in zip(pending, r["items"]):
+                it = it[op_type]
+                if "error" not in it:
+                    continue
+                # Only rejected/unavailable items are worth resending; mapping errors are final.
+                if it.get("status") in [429, 502, 503, 504]:
+                    retry.append(d)
+                else:
+                    failed.append(str(it["_id"]) + ":" + str(it["error"]))
+            if not retry:
+                return failed
+            pending = retry
+            time.sleep(min(2 ** i, 30))
+            i += 1
+
+        for d in pending:
+            failed.append(str(d["id"] if "id" in d else d["_id"]) + ": bulk retries exhausted")
+        return failed
+
+    def bulk_index(self, df, idx_nm=None, op_type="index", callback=None):
+        """
+        Index fresh documents in batches sized by payload bytes, with several
+        bulks in flight at once. Unlike `bulk`, documents are written with plain
+        `index`/`create` ops and are not copied, and only failed items are retried.
+        `callback(done, total)` is called as batches complete.
+        Returns the list of failed items, empty on success.
+        """
+        idx_nm = idx_nm if idx_nm else self.idxnm
+        batches, batch, size = [], [], 0
+        for d in df:
+            sz = self._approx_size(d)
+            if batch and size + sz > settings.ES_BULK_MAX_BYTES:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(d)
+            size += sz
+        if batch:
+            batches.append(batch)
+
+        res = []
+        with ThreadPoolExecutor(max_workers=max(1, settings.ES_BULK_CONCURRENCY)) as exe:
+            futures = [exe.submit(self._bulk_batch, b, idx_nm, op_type) for b in batches]
+            for i, f in enumerate(as_completed(futures)):
+                res.extend(f.result())
+                if callback:
+                    callback(i + 1, len(batches))
+        return res
+
     def bulk4script(self, df):
         ids, acts = {}, []
         for d in df:
@@ -281,6 +376,12 @@ class ESConnection:
         es_logger.error("ES search timeout for 3 times!")
         raise Exception("ES search timeout.")
 
+    def scan(self, query, idxnm=None, src=False, pagesize=1000):
+        """Iterate over every hit of `query`, unlike `search` which is bounded by `size`."""
+        for hit in scan(self.es, query={"query": Search().query(query).to_dict()["query"]},
+                        index=idxnm if idxnm else self.idxnm, size=pagesize, _source=src):
+            yield hit
+
     def updateByQuery(self, q, d):
         ubq = UpdateByQuery(index=self.idxnm).using(self.es).query(q)
         scripts = ""
@@ -0,0 +1,119 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import queue
+import threading
+import traceback
+from timeit import default_timer as timer
+
+from rag.settings import cron_logger
+
+
+class Stage:
+    """
+    One step of a `Pipeline`. `func(item)` returns the item handed to the
+    next stage, or None to drop it (the stage is expected to have reported
+    the failure itself).
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.processed = 0
+        self.elapsed = 0.
+        self._lock = threading.Lock()
+
+    def run(self, item):
+        st = timer()
+        try:
+            return self.func(item)
+        finally:
+            with self._lock:
+                self.processed += 1
+                self.elapsed += timer() - st
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, each stage served by its own pool of
+    worker threads. `put` blocks while the first queue is full, so upstream
+    producers are throttled by the slowest stage.
+    `on_exit(item)` is called exactly once for every item leaving the
+    pipeline, whether it made it through the last stage or was dropped.
+    """
+
+    def __init__(self, stages, queue_size=4, on_exit=None):
+        assert stages, "Pipeline needs at least one stage."
+        self.stages = stages
+        self.on_exit = on_exit
+        self.queues = [queue.Queue(maxsize=max(1, int(queue_size))) for _ in stages]
+        self.threads = []
+        self._inflight = 0
+        self._idle = threading.Condition()
+
+    def start(self):
+        for i, stg in enumerate(self.stages):
+            for j in range(stg.workers):
+                t = threading.Thread(target=self._work, args=(i,),
+                                     name="{}_{}".format(stg.name, j), daemon=True)
+                t.start()
+                self.threads.append(t)
+        return self
+
+    def put(self, item):
+        with self._idle:
+            self._inflight += 1
+        self.queues[0].put(item)
+
+    def join(self):
+        """Block until every item put so far has left the pipeline."""
+        with self._idle:
+            while self._inflight > 0:
+                self._idle.wait()
+
+    def stats(self):
+        return {stg.name: {"processed": stg.processed,
+                           "elapsed": round(stg.elapsed, 2),
+                           "queued": self.queues[i].qsize()}
+                for i, stg in enumerate(self.stages)}
+
+    def _exit(self, item):
+        try:
+            if self.on_exit:
+                self.on_exit(item)
+        except Exception as e:
+            cron_logger.error("Pipeline on_exit: " + str(e))
+            traceback.print_exc()
+        with self._idle:
+            self._inflight -= 1
+            self._idle.notify_all()
+
+    def _work(self, i):
+        stg = self.stages[i]
+        while True:
+            item = self.queues[i].get()
+            try:
+                res = stg.run(item)
+            except Exception as e:
+                cron_logger.error("Pipeline stage [{}]: {}".format(stg.name, str(e)))
+                traceback.print_exc()
+                res = None
+
+            if res is None or i == len(self.stages) - 1:
+                self._exit(item if res is None else res)
+            else:
+                self.queues[i + 1].put(res)
+            self.queues[i].task_done()
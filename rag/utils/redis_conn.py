@@ -90,6 +90,35 @@ class RedisDB:
             self.__open__()
         return False
 
+    def incr(self, k):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.incr(k)
+        except Exception as e:
+            logging.warning("[EXCEPTION]incr" + str(k) + "||" + str(e))
+            self.__open__()
+
+    def mget(self, keys):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("[EXCEPTION]mget" + str(len(keys)) + "||" + str(e))
+            self.__open__()
+
+    def mset(self, kvs, exp=3600):
+        if not self.REDIS: return False
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k, v in kvs.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]mset" + str(len(kvs)) + "||" + str(e))
+            self.__open__()
+        return False
+
     def transaction(self, key, value, exp=3600):
         try:
             pipeline = self.REDIS.pipeline(transaction=True)
@@ -0,0 +1,131 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import base64
+import hashlib
+import json
+import re
+import threading
+from copy import deepcopy
+
+import numpy as np
+from cachetools import TTLCache
+
+from rag import settings
+from rag.utils.redis_conn import REDIS_CONN
+
+
+def model_id(mdl):
+    if mdl is None:
+        return
+    m = getattr(mdl, "mdl", mdl)
+    return "{}/{}".format(m.__class__.__name__, getattr(m, "model_name", getattr(mdl, "llm_name", "")))
+
+
+class RetrievalCache:
+    """
+    Caches `Dealer.retrieval` results in an in-process TTL tier in front of a
+    Redis tier. Keys embed the version counter of every knowledge base
+    searched, and `bump` is called on every index write, so entries of a
+    changed knowledge base are never read again and just expire.
+    """
+
+    def __init__(self, lru_size=settings.RETRIEVAL_CACHE_LRU_SIZE, ttl=settings.RETRIEVAL_CACHE_TTL):
+        self.lru = TTLCache(maxsize=lru_size, ttl=ttl)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _kb_ids(kb_ids):
+        return [kb_ids] if isinstance(kb_ids, str) else list(kb_ids or [])
+
+    def bump(self, kb_ids):
+        for kb_id in set(self._kb_ids(kb_ids)):
+            REDIS_CONN.incr("kb_ver:" + kb_id)
+            REDIS_CONN.set("kb_ver_settle:" + kb_id, "1", settings.RETRIEVAL_CACHE_SETTLE)
+
+    def key(self, kb_ids, question, **params):
+        """
+        Returns (key, cacheable). The key is None when the knowledge base
+        versions can't be read; results are not cacheable while a knowledge
+        base was written to in the last few seconds.
+        """
+        kb_ids = sorted(set(self._kb_ids(kb_ids)))
+        if not kb_ids:
+            return None, False
+        vals = REDIS_CONN.mget(["kb_ver:" + k for k in kb_ids] + ["kb_ver_settle:" + k for k in kb_ids])
+        if vals is None:
+            return None, False
+        params["question"] = re.sub(r"\s+", " ", question).strip()
+        params["kb_ids"] = {k: v or "0" for k, v in zip(kb_ids, vals)}
+        if params.get("doc_ids"):
+            params["doc_ids"] = sorted(params["doc_ids"])
+        txt = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+        return "retrieval:" + hashlib.md5(txt.encode("utf-8")).hexdigest(), not any(vals[len(kb_ids):])
+
+    @staticmethod
+    def _dumps(ranks):
+        ranks = dict(ranks)
+        ranks["chunks"] = [dict(c) for c in ranks["chunks"]]
+        for c in ranks["chunks"]:
+            if "vector" in c:
+                v = np.asarray(c["vector"], dtype=np.float32)
+                c["vector"] = base64.b64encode(v.tobytes()).decode("ascii")
+        return json.dumps(ranks, ensure_ascii=False,
+                          default=lambda o: o.tolist() if isinstance(o, (np.ndarray, np.generic)) else str(o))
+
+    @staticmethod
+    def _loads(s):
+        ranks = json.loads(s)
+        for c in ranks["chunks"]:
+            if "vector" in c:
+                c["vector"] = np.frombuffer(base64.b64decode(c["vector"]), dtype=np.float32)
+        return ranks
+
+    def get(self, key):
+        with self.lock:
+            ranks = self.lru.get(key)
+        if ranks is None:
+            s = REDIS_CONN.get(key)
+            if s:
+                try:
+                    ranks = self._loads(s)
+                    with self.lock:
+                        self.lru[key] = ranks
+                except Exception:
+                    ranks = None
+        with self.lock:
+            if ranks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        # Callers strip and reorder what they get back.
+        return deepcopy(ranks)
+
+    def set(self, key, ranks):
+        with self.lock:
+            self.lru[key] = deepcopy(ranks)
+        REDIS_CONN.set(key, self._dumps(ranks), self.ttl)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.}
+
+
+RETRIEVAL_CACHE = RetrievalCache()
@@ -0,0 +1,171 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+from cachetools import TTLCache
+
+from rag import settings
+from rag.utils.redis_conn import REDIS_CONN
+
+
+class TaskEvents:
+    """
+    Events between the API server and the task executors, so neither polls
+    the database for them.
+
+    Cancellations are published on a Redis channel and kept as
+    `task_cancel:<doc id>` keys for executors which subscribe later; every
+    executor holds the canceled documents in memory and answers
+    `is_canceled` without a round trip. Task progress is announced on a
+    Redis stream read by a consumer group, so each announcement reaches one
+    aggregator, which recomputes the progress of the announced documents
+    only. Without Redis both go through process memory.
+    """
+
+    CANCEL_CHANNEL = "task_events:cancel"
+    PROGRESS_STREAM = "task_events:progress"
+    PROGRESS_GROUP = "task_events_aggregator"
+
+    def __init__(self, shared=True, cancel_ttl=settings.TASK_CANCEL_TTL):
+        self.shared = shared
+        self.cancel_ttl = cancel_ttl
+        self.canceled = TTLCache(maxsize=100000, ttl=cancel_ttl)
+        self.progressed = queue.Queue()
+        self.lock = threading.Lock()
+        self.subscribed = threading.Event()
+        self.pid = None
+        self.consumer = f"{socket.gethostname()}_{os.getpid()}"
+
+    def _redis(self):
+        if self.shared and REDIS_CONN.is_alive():
+            return REDIS_CONN.REDIS
+
+    def _set(self, doc_id, canceled):
+        with self.lock:
+            if canceled:
+                self.canceled[doc_id] = True
+            else:
+                self.canceled.pop(doc_id, None)
+
+    def _publish(self, doc_id, canceled):
+        self._set(doc_id, canceled)
+        r = self._redis()
+        if r is None:
+            return
+        try:
+            if canceled:
+                r.set(f"task_cancel:{doc_id}", "1", self.cancel_ttl)
+            else:
+                r.delete(f"task_cancel:{doc_id}")
+            r.publish(self.CANCEL_CHANNEL, json.dumps({"doc_id": doc_id, "canceled": canceled}))
+        except Exception as e:
+            logging.warning(f"task_events: can't publish the cancellation of {doc_id}: {e}")
+
+    def cancel(self, doc_id):
+        """Stops the running tasks of the document at their next progress report."""
+        self._publish(doc_id, True)
+
+    def resume(self, doc_id):
+        """Lets new tasks of a canceled document run."""
+        self._publish(doc_id, False)
+
+    def is_canceled(self, doc_id):
+        self._subscribe()
+        with self.lock:
+            return doc_id in self.canceled
+
+    def _subscribe(self):
+        if self.pid == os.getpid() or self._redis() is None:
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.subscribed.clear()
+            threading.Thread(target=self._listen, daemon=True).start()
+        # Cancellations published before the subscription are read from their keys.
+        self.subscribed.wait(5)
+
+    def _listen(self):
+        while True:
+            try:
+                r = self._redis()
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CANCEL_CHANNEL)
+                canceled = TTLCache(maxsize=self.canceled.maxsize, ttl=self.cancel_ttl)
+                for k in r.scan_iter("task_cancel:*"):
+                    canceled[k[len("task_cancel:"):]] = True
+                with self.lock:
+                    self.canceled = canceled
+                self.subscribed.set()
+                for m in pubsub.listen():
+                    e = json.loads(m["data"])
+                    self._set(e["doc_id"], e["canceled"])
+            except Exception as e:
+                logging.warning(f"task_events: cancel subscription lost: {e}")
+                time.sleep(1)
+
+    def progress(self, doc_id):
+        """Announces that tasks of the document progressed."""
+        r = self._redis()
+        if r is not None:
+            try:
+                r.xadd(self.PROGRESS_STREAM, {"doc_id": doc_id},
+                       maxlen=settings.PROGRESS_STREAM_MAX_LEN, approximate=True)
+                return
+            except Exception as e:
+                logging.warning(f"task_events: can't announce the progress of {doc_id}: {e}")
+        self.progressed.put(doc_id)
+
+    def progressed_docs(self, timeout=settings.PROGRESS_BATCH_INTERVAL):
+        """The documents announced within `timeout` seconds."""
+        doc_ids = set()
+        deadline = time.time() + timeout
+        r = self._redis()
+        if r is not None:
+            try:
+                try:
+                    r.xgroup_create(self.PROGRESS_STREAM, self.PROGRESS_GROUP, id="$", mkstream=True)
+                except Exception as e:
+                    if "BUSYGROUP" not in str(e):
+                        raise
+                while True:
+                    block = int((deadline - time.time()) * 1000)
+                    if block <= 0:
+                        break
+                    msgs = r.xreadgroup(self.PROGRESS_GROUP, self.consumer, {self.PROGRESS_STREAM: ">"},
+                                        count=1000, block=block)
+                    for _, elements in msgs or []:
+                        if elements:
+                            r.xack(self.PROGRESS_STREAM, self.PROGRESS_GROUP, *[i for i, _ in elements])
+                        doc_ids.update(e["doc_id"] for _, e in elements)
+            except Exception as e:
+                logging.warning(f"task_events: can't read progress: {e}")
+        while True:
+            try:
+                doc_ids.add(self.progressed.get(timeout=max(0., deadline - time.time())))
+            except queue.Empty:
+                break
+        return doc_ids
+
+
+TASK_EVENTS = TaskEvents()
@@ -0,0 +1,157 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from rag import settings
+from rag.utils.redis_conn import REDIS_CONN
+
+
+class UsageAccumulator:
+    """
+    Token usage counted off the request path. Calls add their tokens to
+    per-(tenant, model type, model name) counters, kept in a Redis hash so
+    they survive a crash of the process (or in process memory when Redis is
+    unavailable). A background thread hands the summed counters to `flush_fn`
+    every `interval` seconds, or once `max_pending` calls are buffered.
+
+    Counters are moved to a claim key before being flushed and deleted only
+    after `flush_fn` returned, so usage is applied at least once: claims left
+    behind by a failed flush or a dead process are flushed again once older
+    than `stale`. Claims are listed in a sorted set scored by claim time, so
+    finding the stale ones doesn't scan the keyspace.
+    """
+
+    def __init__(self, flush_fn, interval=settings.USAGE_FLUSH_INTERVAL, max_pending=settings.USAGE_FLUSH_SIZE,
+                 stale=settings.USAGE_FLUSH_STALE, prefix="llm_usage", shared=True):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_pending = max_pending
+        self.stale = stale
+        self.prefix = prefix
+        self.shared = shared
+        self.pending = defaultdict(int)
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        atexit.register(self._flush_at_exit)
+
+    def _redis(self):
+        if self.shared and REDIS_CONN.is_alive():
+            return REDIS_CONN.REDIS
+
+    def add(self, tenant_id, llm_type, used_tokens, llm_name=None):
+        if not used_tokens:
+            return
+        key = (tenant_id, str(llm_type), llm_name or "")
+        r = self._redis()
+        buffered = False
+        if r is not None:
+            try:
+                r.hincrby(f"{self.prefix}:pending", json.dumps(key), int(used_tokens))
+                buffered = True
+            except Exception as e:
+                logging.warning(f"token usage buffered in memory, Redis failed: {e}")
+        with self.lock:
+            if not buffered:
+                self.pending[key] += int(used_tokens)
+            self.calls += 1
+            full = self.calls >= self.max_pending
+        self._start()
+        if full:
+            self.wakeup.set()
+
+    def _start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception(f"token usage flush failed: {e}")
+
+    def flush(self):
+        """Applies everything buffered so far; raises if `flush_fn` fails, keeping the usage for a retry."""
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, defaultdict(int)
+                self.calls = 0
+            if pending:
+                try:
+                    self.flush_fn(dict(pending))
+                except Exception:
+                    with self.lock:
+                        for k, v in pending.items():
+                            self.pending[k] += v
+                    raise
+            r = self._redis()
+            if r is None:
+                return
+            for claim in self._stale_claims(r) + [self._claim(r)]:
+                if not claim:
+                    continue
+                usage = {tuple(json.loads(k)): int(v) for k, v in r.hgetall(claim).items()}
+                if usage:
+                    self.flush_fn(usage)
+                r.delete(claim)
+                r.zrem(f"{self.prefix}:claims", claim)
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logging.warning(f"token usage not flushed at exit, kept for a later flush: {e}")
+
+    def _claim(self, r, key=None):
+        """Moves the counters to a new claim key, listed by claim time in `<prefix>:claims`."""
+        claim = f"{self.prefix}:flushing:{uuid.uuid4().hex}"
+        # Listed before the rename, so a process dying in between leaves an empty claim, not a lost one.
+        r.zadd(f"{self.prefix}:claims", {claim: time.time()})
+        try:
+            r.rename(key or f"{self.prefix}:pending", claim)
+        except Exception:
+            # Nothing pending, or claimed by another process in the meantime.
+            r.zrem(f"{self.prefix}:claims", claim)
+            return
+        if key:
+            r.zrem(f"{self.prefix}:claims", key)
+        return claim
+
+    def _stale_claims(self, r):
+        claims = []
+        for key in r.zrangebyscore(f"{self.prefix}:claims", 0, time.time() - self.stale):
+            if r.exists(key):
+                claims.append(self._claim(r, key))
+            else:
+                r.zrem(f"{self.prefix}:claims", key)
+        return claims
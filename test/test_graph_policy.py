@@ -0,0 +1,140 @@
+import re
+
+import networkx as nx
+import pytest
+from lark import Lark, Transformer, Token, v_args
+
+from graphrag.policy.grammar import grammar
+from graphrag.policy.graph_transformer import GraphIndex, RuleTree, parse_rules
+
+
+@v_args(inline=True)
+class NetWorkGraphTree(Transformer):
+    """Scans every node for every term, as the rule engine did before GraphIndex."""
+
+    def __init__(self, graph: nx.Graph):
+        self.graph = graph
+
+    def start(self, exp):
+        return exp
+
+    def exp(self, *args):
+        return any(args)
+
+    def and_exp(self, *args):
+        return all(args)
+
+    def not_exp(self, exp):
+        return not exp
+
+    def term(self, exp):
+        return exp
+
+    def term_eq(self, entity_type: Token, attr_or_value: Token, value: Token = None):
+        attr = (attr_or_value[1:] if value else "id").strip("'")
+        value = (value or attr_or_value).strip("'")
+        return all([self.graph_query(entity_type, attr, v, "=") for v in value.split(",")])
+
+    item_eq = term_eq
+
+    def graph_query(self, entity_type, attr, value, op="="):
+        entity_type = str(entity_type).strip("'")
+        attr = str(attr).strip("'")
+        value = str(value).strip("'")
+        for node, attr_dict in self.graph.nodes(data=True):
+            if not attr_dict.get("entity_type") == entity_type:
+                continue
+            v = node if attr == "id" else attr_dict.get(attr)
+            match op:
+                case "=" if v == value:
+                    return True
+                case "~" if value in v:
+                    return True
+                case "=~" if re.match(value, v):
+                    return True
+        return False
+
+    def item_contains(self, entity_type: Token, attr_or_value: Token, value: Token = None):
+        attr = attr_or_value[1:] if value else "id"
+        return self.graph_query(entity_type, attr, value or attr_or_value, "~")
+
+    def item_regexp(self, entity_type: Token, attr_or_value: Token, value: Token = None):
+        attr = attr_or_value[1:] if value else "id"
+        return self.graph_query(entity_type, attr, value or attr_or_value, "=~")
+
+
+RULES = [
+    "症状='流鼻涕'",
+    "症状=发烧",
+    "症状='流鼻涕,发烧'",
+    "症状='流鼻涕,咳嗽'",
+    "疾病=肠胃炎",
+    "疾病=肺炎",
+    "药品=阿托品 and 疾病=肠胃炎",
+    "药品=阿托品 and 疾病=肺炎",
+    "药品=芬必得 or 疾病=肺炎",
+    "症状=发烧 and (药品=阿托品 or 药品=芬必得)",
+    "not 药品=敌敌畏",
+    "not 药品=阿托品",
+    "药品~托",
+    "药品~敌",
+    "症状~'鼻'",
+    "症状=~'发.*'",
+    "症状=~'.*烧'",
+    "药品=~'芬'",
+    "药品.description='解痉药'",
+    "药品.description~'痉'",
+    "药品.description=~'解'",
+    "药品.description=~'痉'",
+    "疾病.source_id~chunk1",
+    "疾病.source_id~chunk9",
+    "疾病.source_id=chunk1",
+    "疾病.communities~c2",
+    "疾病.communities~c7",
+    "疾病.rank=3",
+    "症状.description~'发热' and 疾病.source_id~chunk2",
+    "not 疾病.source_id~chunk9",
+]
+
+
+@pytest.fixture
+def graph():
+    graph = nx.Graph()
+    graph.add_node("流鼻涕", entity_type="症状", description="鼻腔分泌物增多")
+    graph.add_node("发烧", entity_type="症状", description="发热")
+    graph.add_node("肠胃炎", entity_type="疾病", description="胃肠道炎症", rank=3,
+                   source_id=["chunk1", "chunk2"], communities=["c1", "c2"])
+    graph.add_node("犬瘟热", entity_type="疾病", description="病毒病", rank=1,
+                   source_id=["chunk3"], communities=["c3"])
+    graph.add_node("阿托品", entity_type="药品", description="解痉药")
+    graph.add_node("芬必得", entity_type="药品", description="止痛药")
+    graph.add_edge("流鼻涕", "犬瘟热")
+    graph.add_edge("肠胃炎", "阿托品")
+    return graph
+
+
+def test_parity(graph):
+    old = Lark(grammar, parser="lalr", transformer=NetWorkGraphTree(graph)).parse
+    new = RuleTree(GraphIndex(graph).query)
+    trees = parse_rules(RULES)
+    assert set(trees) == set(RULES)
+    results = {rule: new.transform(trees[rule]) for rule in RULES}
+    assert results == {rule: old(rule) for rule in RULES}
+    assert any(results.values()) and not all(results.values())
+
+
+def test_unquoted_values(graph):
+    # The old evaluator read `a=b,c` as attribute `b` of `a`; every listed value must exist.
+    new = RuleTree(GraphIndex(graph).query)
+    trees = parse_rules(["症状=流鼻涕,发烧", "症状=流鼻涕,咳嗽"])
+    assert new.transform(trees["症状=流鼻涕,发烧"])
+    assert not new.transform(trees["症状=流鼻涕,咳嗽"])
+
+
+def test_unhashable_values(graph):
+    idx = GraphIndex(graph)
+    assert idx.query("疾病", "communities", "c2", "~")
+    assert not idx.query("疾病", "communities", "c2", "=")
+    assert idx.query("疾病", "source_id", "chunk3", "~")
+    assert not idx.query("疾病", "source_id", "chunk", "~")
+    assert idx.query("疾病", "rank", 3, "=")
@@ -0,0 +1,108 @@
+import random
+
+import networkx as nx
+import pytest
+
+from graphrag import graph_store
+from graphrag.graph_store import GraphStore, diff, snapshot
+from rag import settings
+
+
+class MemoryStorage:
+    """The STORAGE_IMPL calls of the graph store, in a dict."""
+
+    def __init__(self):
+        self.objs = {}
+
+    def put(self, bucket, fnm, binary):
+        self.objs[(bucket, fnm)] = binary
+
+    def get(self, bucket, fnm):
+        return self.objs.get((bucket, fnm))
+
+    def obj_exist(self, bucket, fnm):
+        return (bucket, fnm) in self.objs
+
+    def rm(self, bucket, fnm):
+        self.objs.pop((bucket, fnm), None)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = MemoryStorage()
+    monkeypatch.setattr(graph_store, "STORAGE_IMPL", storage)
+    return storage
+
+
+def random_graph(n=200, m=600, seed=0):
+    rnd = random.Random(seed)
+    graph = nx.Graph()
+    for i in range(n):
+        graph.add_node(f"ENTITY {i}", description=f"entity {i}", rank=rnd.randint(0, 10),
+                       source_id=[f"chunk{rnd.randint(0, 20)}"])
+    for _ in range(m):
+        u, v = rnd.sample(list(graph.nodes), 2)
+        graph.add_edge(u, v, weight=rnd.random(), description=f"{u} - {v}")
+    return graph
+
+
+def edit(graph, seed):
+    rnd = random.Random(seed)
+    nodes = list(graph.nodes)
+    graph.remove_node(rnd.choice(nodes))
+    nodes = list(graph.nodes)
+    graph.add_node(f"NEW {seed}", description="new", rank=1)
+    graph.add_edge(f"NEW {seed}", rnd.choice(nodes), weight=1., description="new edge")
+    n = rnd.choice(nodes)
+    graph.nodes[n]["description"] += " edited"
+    u, v = rnd.choice(list(graph.edges))
+    graph[u][v]["weight"] = 2.
+    u, v = rnd.choice(list(graph.edges))
+    graph.remove_edge(u, v)
+
+
+def assert_same(a, b):
+    assert dict(a.nodes(data=True)) == dict(b.nodes(data=True))
+    assert {frozenset((u, v)): d for u, v, d in a.edges(data=True)} == \
+        {frozenset((u, v)): d for u, v, d in b.edges(data=True)}
+
+
+def test_round_trip(storage, monkeypatch):
+    monkeypatch.setattr(settings, "GRAPH_STORE_MAX_DELTAS", 4)
+    graph = random_graph()
+    store = GraphStore("kb", "doc", shards=8)
+    store.save(graph, base_ts=1.)
+    assert_same(GraphStore("kb", "doc").load(), graph)
+
+    for seed in range(10):
+        with store.lock():
+            before = snapshot(graph)
+            edit(graph, seed)
+            store.apply(diff(before, graph))
+        assert_same(GraphStore("kb", "doc").load(), graph)
+
+    assert store.manifest()["version"] > 1
+    assert store.is_current(1.)
+    nodes = random.Random(1).sample(list(graph.nodes), 5)
+    sub = GraphStore("kb", "doc").load(nodes)
+    for n in nodes:
+        assert dict(sub.nodes[n]) == dict(graph.nodes[n])
+        assert set(sub[n]) == set(graph[n])
+
+
+def test_reader_of_replaced_version(storage):
+    store = GraphStore("kb", "doc", shards=4)
+    store.save(random_graph(seed=1))
+    reader = GraphStore("kb", "doc")
+    reader.manifest()
+    graph = random_graph(seed=2)
+    store.save(graph)
+    # The version the reader listed is kept for one more version.
+    assert_same(reader.load(), random_graph(seed=1))
+
+    reader = GraphStore("kb", "doc")
+    reader.manifest()
+    store.save(random_graph(seed=3))
+    store.save(random_graph(seed=4))
+    # Gone two versions later: the reader moves on to the current version.
+    assert_same(reader.load(), random_graph(seed=4))
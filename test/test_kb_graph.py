@@ -0,0 +1,131 @@
+import json
+
+import networkx as nx
+import pytest
+
+from graphrag import kb_graph
+from graphrag.kb_graph import put_doc, merge_aliases, retract_doc, add_retired, load_kb_graph, save_kb_graph
+
+
+class MemoryStorage:
+    """The STORAGE_IMPL calls of the knowledge base graph, in a dict."""
+
+    def __init__(self):
+        self.objs = {}
+
+    def put(self, bucket, fnm, binary):
+        self.objs[(bucket, fnm)] = binary
+
+    def get(self, bucket, fnm):
+        return self.objs.get((bucket, fnm))
+
+    def obj_exist(self, bucket, fnm):
+        return (bucket, fnm) in self.objs
+
+    def rm(self, bucket, fnm):
+        self.objs.pop((bucket, fnm), None)
+
+
+class RecordingES:
+    def __init__(self):
+        self.queries = []
+
+    def deleteByQuery(self, query, idxnm=""):
+        self.queries.append(query.to_dict())
+        return True
+
+    def bump(self, kb_id):
+        pass
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    storage, es = MemoryStorage(), RecordingES()
+    monkeypatch.setattr(kb_graph, "STORAGE_IMPL", storage)
+    monkeypatch.setattr(kb_graph, "ELASTICSEARCH", es)
+    monkeypatch.setattr(kb_graph, "RETRIEVAL_CACHE", es)
+    monkeypatch.setattr(kb_graph.REDIS_CONN, "REDIS", None)
+    return storage, es
+
+
+def doc_graph(entities, relations):
+    graph = nx.Graph()
+    for name, desc in entities.items():
+        graph.add_node(name, entity_type="person", description=desc, source_id="c", weight=1)
+    for (s, t), weight in relations.items():
+        graph.add_edge(s, t, description=f"{s} - {t}", source_id="c", weight=weight)
+    return graph
+
+
+def empty_kb():
+    return {"graph": nx.Graph(), "communities": {}, "docs": {}, "aliases": {}, "stale": []}
+
+
+def attrs(graph):
+    return ({n: (a["weight"], a["description"], a["rank"]) for n, a in graph.nodes(data=True)},
+            {tuple(sorted((s, t))): a["weight"] for s, t, a in graph.edges(data=True)})
+
+
+A = doc_graph({"ALICE": "alice from a", "BOB": "bob from a"}, {("ALICE", "BOB"): 2})
+B = doc_graph({"ALICE": "alice from b", "CAROL": "carol from b"}, {("ALICE", "CAROL"): 1})
+
+
+def test_reparse_replaces_the_contribution():
+    kb = empty_kb()
+    put_doc(kb, "a", A)
+    put_doc(kb, "b", B)
+    once = attrs(kb["graph"])
+    assert once[0]["ALICE"] == (2, "alice from a\nalice from b", 2)
+
+    put_doc(kb, "b", B)
+    assert attrs(kb["graph"]) == once
+
+
+def test_removing_a_document_leaves_the_others():
+    kb = empty_kb()
+    put_doc(kb, "a", A)
+    alone = attrs(kb["graph"])
+    put_doc(kb, "b", B)
+
+    touched, removed = put_doc(kb, "b", None)
+    assert touched == {"ALICE", "CAROL"}
+    assert removed == {"CAROL"}
+    assert attrs(kb["graph"]) == alone
+
+
+def test_aliases_fold_later_documents_into_the_kept_entity():
+    kb = empty_kb()
+    put_doc(kb, "a", A)
+    put_doc(kb, "b", doc_graph({"ALICE SMITH": "alice smith from b"}, {}))
+    assert merge_aliases(kb, {"ALICE SMITH": "ALICE"}) == {"ALICE SMITH"}
+    assert kb["graph"].nodes["ALICE"]["description"] == "alice from a\nalice smith from b"
+
+    put_doc(kb, "c", doc_graph({"ALICE SMITH": "alice smith from c", "DAVE": "dave"},
+                               {("ALICE SMITH", "DAVE"): 1}))
+    assert "ALICE SMITH" not in kb["graph"]
+    assert kb["graph"].has_edge("ALICE", "DAVE")
+
+    put_doc(kb, "b", None)
+    put_doc(kb, "c", None)
+    assert kb["graph"].nodes["ALICE"]["description"] == "alice from a"
+    assert set(kb["graph"].nodes) == {"ALICE", "BOB"}
+
+
+def test_retract_deletes_the_entries_left_without_document(backends):
+    storage, es = backends
+    kb = empty_kb()
+    put_doc(kb, "a", A)
+    put_doc(kb, "b", B)
+    save_kb_graph("kb", kb)
+    add_retired("kb", "b", ["pending"])
+
+    retract_doc("tenant", "kb", "b")
+    kb = load_kb_graph("kb")
+    assert set(kb["graph"].nodes) == {"ALICE", "BOB"}
+    assert kb["stale"] == ["ALICE"]
+    assert not storage.obj_exist("kb", "knowledge_graph.json.b.retired")
+    deleted = [i for q in es.queries for c in q["bool"]["must"] if "ids" in c for i in c["ids"]["values"]]
+    assert set(deleted) == {"pending", kb_graph.entity_chunk_id("kb", "CAROL")}
+
+    retract_doc("tenant", "kb", "b")
+    assert json.loads(storage.get("kb", "knowledge_graph.json"))["docs"].keys() == {"a"}
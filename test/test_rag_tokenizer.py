@@ -0,0 +1,101 @@
+import logging
+import time
+
+import pytest
+
+from rag import settings
+from rag.nlp import rag_tokenizer
+from rag.nlp.rag_tokenizer import RagTokenizer
+
+log = logging.getLogger(__name__)
+
+CORPUS = [
+    "哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈",
+    "公开征求意见稿提出，境外投资者可使用自有人民币或外汇投资。使用外汇投资的，可通过债券持有人在香港人民币业务清算行及香港地区经批准可进入境内银行间外汇市场进行交易的境外人民币业务参加行（以下统称香港结算行）办理外汇资金兑换。香港结算行由此所产生的头寸可到境内银行间外汇市场平盘。使用外汇投资的，在其投资的债券到期或卖出后，原则上应兑换回外汇。",
+    "多校划片就是一个小区对应多个小学初中，让买了学区房的家庭也不确定到底能上哪个学校。目的是通过这种方式为学区房降温，把就近入学落到实处。南京市长江大桥",
+    "实际上当时他们已经将业务中心偏移到安全部门和针对政府企业的部门 Scripts are compiled and cached aaaaaaaaa",
+    "虽然我不怎么玩",
+    "蓝月亮如何在外资夹击中生存,那是全宇宙最有意思的",
+    "涡轮增压发动机num最大功率,不像别的共享买车锁电子化的手段,我们接过来是否有意义,黄黄爱美食,不过，今天阿奇要讲到的这家农贸市场，说实话，还真蛮有特色的！不仅环境好，还打出了",
+    "这周日你去吗？这周日你有空吗？",
+    "Unity3D开发经验 测试开发工程师 c++双11双11 985 211 ",
+    "数据分析项目经理|数据分析挖掘|数据分析方向|商品数据分析|搜索数据分析 sql python hive tableau Cocos2d-",
+    "中华人民共和国国务院新闻办公室发表《新时代的中国绿色发展》白皮书",
+    "研究生命起源，南京市长江大桥，结婚的和尚未结婚的，乒乓球拍卖完了",
+]
+
+
+class DfsTokenizer(RagTokenizer):
+    """Segments by enumerating every path with dfs_, as the tokenizer did before the word lattice."""
+
+    def segment_(self, chars, topn=1):
+        tkslist = []
+        self.dfs_(chars, 0, [], tkslist)
+        return [tks for tks, _ in self.sortTks_(tkslist)[:topn]]
+
+
+@pytest.fixture(scope="module")
+def reference():
+    tknzr = DfsTokenizer()
+    tknzr.trie_ = rag_tokenizer.tokenizer.trie_
+    return tknzr
+
+
+def spans(max_len=10):
+    for line in CORPUS:
+        line = rag_tokenizer.tradi2simp(rag_tokenizer.strQ2B(line)).lower()
+        for s in range(len(line)):
+            for e in range(s + 1, min(len(line), s + max_len) + 1):
+                yield line[s:e]
+
+
+def test_segment_parity(reference):
+    cnt = 0
+    for span in spans():
+        assert rag_tokenizer.tokenizer.segment_(span, topn=2) == reference.segment_(span, topn=2), span
+        cnt += 1
+    log.info(f"{cnt} spans segmented identically")
+
+
+def test_tokenize_parity(reference):
+    for line in CORPUS:
+        tks = rag_tokenizer.tokenize(line)
+        assert tks == reference.tokenize(line), line
+        assert rag_tokenizer.fine_grained_tokenize(tks) == reference.fine_grained_tokenize(tks), line
+
+
+def test_tokenize_cache():
+    tknzr = RagTokenizer()
+    line = CORPUS[1]
+    tks = tknzr.tokenize(line)
+    assert ("tks", line) in tknzr.cache_
+    assert tknzr.tokenize(line) == tks
+    tknzr.clear_cache()
+    assert ("tks", line) not in tknzr.cache_
+    assert tknzr.tokenize(line) == tks
+
+
+def test_tokenize_batch(monkeypatch):
+    lines = CORPUS * 20
+    expected = [rag_tokenizer.tokenize(line) for line in lines]
+    assert rag_tokenizer.tokenize_batch(lines) == expected
+    monkeypatch.setattr(settings, "TOKENIZER_POOL_MIN_LINES", 1)
+    assert rag_tokenizer.tokenize_batch(lines, workers=2) == expected
+
+
+def test_throughput(reference):
+    """Tokens per second of the word lattice and of the dfs enumeration, on the corpus without caching."""
+    lines = [line for line in CORPUS for _ in range(5)]
+    res = {}
+    for name, tknzr in [("lattice", rag_tokenizer.tokenizer), ("dfs", reference)]:
+        tknzr.clear_cache()
+        st = time.time()
+        cnt = 0
+        for line in lines:
+            tknzr.clear_cache()
+            tks = tknzr.tokenize(line)
+            cnt += len(tknzr.fine_grained_tokenize(tks).split())
+        res[name] = cnt / (time.time() - st)
+        log.info(f"{name}: {res[name]:.0f} tokens/s")
+    log.info(f"speedup: {res['lattice'] / res['dfs']:.1f}x")
+    assert res["lattice"] > res["dfs"]
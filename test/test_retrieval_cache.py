@@ -0,0 +1,59 @@
+import time
+
+import fakeredis
+import numpy as np
+import pytest
+
+from rag import settings
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.retrieval_cache import RetrievalCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(REDIS_CONN, "REDIS", fakeredis.FakeStrictRedis(decode_responses=True))
+    monkeypatch.setattr(settings, "RETRIEVAL_CACHE_SETTLE", 1)
+    return RetrievalCache()
+
+
+def test_key(cache):
+    key, cacheable = cache.key(["kb1", "kb2"], "what  is\tragflow ", top=6, doc_ids=["b", "a"])
+    assert cacheable
+    assert cache.key(["kb2", "kb1", "kb1"], "what is ragflow", top=6, doc_ids=["a", "b"]) == (key, True)
+    assert cache.key(["kb1", "kb2"], "what is ragflow", top=8, doc_ids=["a", "b"])[0] != key
+    assert cache.key(["kb1"], "what is ragflow", top=6, doc_ids=["a", "b"])[0] != key
+    assert cache.key([], "what is ragflow") == (None, False)
+
+
+def test_bump_changes_key(cache):
+    key, _ = cache.key("kb1", "question")
+    other, _ = cache.key("kb2", "question")
+    cache.bump("kb1")
+    assert cache.key("kb1", "question")[0] != key
+    assert cache.key("kb2", "question")[0] == other
+
+
+def test_settle_window(cache):
+    cache.bump(["kb1"])
+    key, cacheable = cache.key(["kb1", "kb2"], "question")
+    assert not cacheable
+    time.sleep(settings.RETRIEVAL_CACHE_SETTLE + 0.2)
+    assert cache.key(["kb1", "kb2"], "question") == (key, True)
+
+
+def test_redis_tier(cache):
+    key, _ = cache.key("kb1", "question")
+    ranks = {"total": 1, "chunks": [{"chunk_id": "c1", "vector": np.arange(4, dtype=np.float32)}],
+             "doc_aggs": [{"doc_id": "d1", "count": 1}]}
+    cache.set(key, ranks)
+    cache.lru.clear()
+    got = RetrievalCache().get(key)
+    assert got["chunks"][0]["chunk_id"] == "c1"
+    assert np.array_equal(got["chunks"][0]["vector"], ranks["chunks"][0]["vector"])
+    assert got["doc_aggs"] == ranks["doc_aggs"]
+    assert cache.get("retrieval:missing") is None
+
+
+def test_redis_unavailable(cache, monkeypatch):
+    monkeypatch.setattr(REDIS_CONN, "REDIS", None)
+    assert cache.key("kb1", "question") == (None, False)
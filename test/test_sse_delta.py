@@ -0,0 +1,68 @@
+import json
+import logging
+
+from api.utils.api_utils import DeltaStream, stream_data
+
+log = logging.getLogger(__name__)
+
+
+def frame(data):
+    return "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": data}, ensure_ascii=False) + "\n\n"
+
+
+def chat_stream(tokens=2000, step=16, chunks=20):
+    """What dialog_service.chat yields: the answer so far every `step` tokens, then the answer with citations."""
+    words = ["token{} ".format(i) for i in range(tokens)]
+    for i in range(step, tokens + step, step):
+        yield {"answer": "".join(words[:i]), "reference": {}, "audio_binary": None}
+    reference = {"chunks": [{"chunk_id": str(i), "content_with_weight": "chunk content " * 50} for i in range(chunks)],
+                 "doc_aggs": [{"doc_id": "doc", "doc_name": "doc.pdf", "count": chunks}]}
+    yield {"answer": "".join(words) + " ##0$$", "reference": reference, "prompt": "the prompt"}
+
+
+def sse(stream_mode):
+    to_data = stream_data(stream_mode)
+    for ans in chat_stream():
+        ans["id"] = "message id"
+        yield frame(to_data(ans))
+    yield frame(True)
+
+
+def reconstruct(frames):
+    ans = {}
+    for f in frames:
+        data = json.loads(f[len("data:"):])["data"]
+        if data is True:
+            break
+        if "delta" in data:
+            ans["answer"] = ans.get("answer", "") + data.pop("delta")
+        ans.update(data)
+    return ans
+
+
+def test_full_is_unchanged():
+    assert list(sse("full")) == [frame(dict(ans, id="message id")) for ans in chat_stream()] + [frame(True)]
+
+
+def test_delta_reconstructs_full():
+    full = reconstruct(sse("full"))
+    delta = reconstruct(sse("delta"))
+    assert delta["answer"] == full["answer"]
+    assert delta["reference"] == full["reference"]
+    assert delta["prompt"] == full["prompt"]
+    assert delta["id"] == full["id"]
+
+
+def test_rewritten_answer_is_sent_whole():
+    to_data = DeltaStream()
+    assert to_data({"answer": "hello", "reference": {}}) == {"delta": "hello", "reference": {}}
+    assert to_data({"answer": "hello world", "reference": {}}) == {"delta": " world"}
+    assert to_data({"answer": "hello ##0$$ world", "reference": {"chunks": []}}) == \
+        {"answer": "hello ##0$$ world", "reference": {"chunks": []}}
+
+
+def test_bytes_sent():
+    full = sum(len(f.encode("utf-8")) for f in sse("full"))
+    delta = sum(len(f.encode("utf-8")) for f in sse("delta"))
+    log.info(f"full: {full} bytes, delta: {delta} bytes, {full / delta:.1f}x fewer")
+    assert delta * 10 < full
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+import uuid
+
+import fakeredis
+import pytest
+
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_events import TaskEvents
+
+log = logging.getLogger(__name__)
+
+MAX_CANCEL_LATENCY = 1.
+
+
+@pytest.fixture(params=["local", "redis"])
+def channel(request, monkeypatch):
+    """The events of the API server and of a task executor: one process without Redis, or two sharing one."""
+    if request.param == "local":
+        events = TaskEvents(shared=False)
+        return events, events
+    monkeypatch.setattr(REDIS_CONN, "REDIS", fakeredis.FakeStrictRedis(server=fakeredis.FakeServer(),
+                                                                       decode_responses=True))
+    return TaskEvents(), TaskEvents()
+
+
+def run_task(events, doc_id, progressed, interval=0.01):
+    """A running task, reporting progress every `interval` seconds until its document is canceled."""
+    while not events.is_canceled(doc_id):
+        events.progress(doc_id)
+        progressed.set()
+        time.sleep(interval)
+    return time.time()
+
+
+def test_cancel_latency(channel):
+    api, executor = channel
+    doc_id = uuid.uuid4().hex
+    progressed = threading.Event()
+    stopped = []
+    task = threading.Thread(target=lambda: stopped.append(run_task(executor, doc_id, progressed)))
+    task.start()
+    assert progressed.wait(5)
+    time.sleep(0.1)
+
+    canceled = time.time()
+    api.cancel(doc_id)
+    task.join(MAX_CANCEL_LATENCY * 5)
+    assert stopped, "the task was not canceled"
+    log.info(f"cancel reached the task in {(stopped[0] - canceled) * 1000:.1f}ms")
+    assert stopped[0] - canceled < MAX_CANCEL_LATENCY
+
+    api.resume(doc_id)
+    for _ in range(100):
+        if not executor.is_canceled(doc_id):
+            break
+        time.sleep(0.01)
+    assert not executor.is_canceled(doc_id)
+
+
+def test_cancel_before_subscription(channel):
+    api, _ = channel
+    doc_id = uuid.uuid4().hex
+    api.cancel(doc_id)
+    executor = TaskEvents(shared=api.shared) if api.shared else api
+    assert executor.is_canceled(doc_id)
+    api.resume(doc_id)
+
+
+def test_progress_batched(channel):
+    api, executor = channel
+    api.progressed_docs(timeout=0.1)
+    doc_ids = [uuid.uuid4().hex for _ in range(3)]
+    for _ in range(10):
+        for doc_id in doc_ids:
+            executor.progress(doc_id)
+    assert api.progressed_docs(timeout=0.5) == set(doc_ids)
+    assert api.progressed_docs(timeout=0.1) == set()
@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+from collections import defaultdict
+
+import fakeredis
+import pytest
+
+from rag.utils.token_usage import UsageAccumulator
+
+
+class Totals:
+    def __init__(self):
+        self.tokens = defaultdict(int)
+        self.batches = 0
+        self.fail = False
+
+    def __call__(self, usage):
+        if self.fail:
+            raise ConnectionError("database is down")
+        self.batches += 1
+        for k, v in usage.items():
+            self.tokens[k] += v
+
+
+@pytest.fixture(params=["memory", "redis"])
+def accumulator(request):
+    totals = Totals()
+    acc = UsageAccumulator(totals, interval=3600, max_pending=10 ** 9)
+    if request.param == "redis":
+        redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        acc._redis = lambda: redis
+    else:
+        acc.shared = False
+    return acc, totals
+
+
+def calls(n=5000):
+    rnd = random.Random(0)
+    for _ in range(n):
+        tenant = "tenant{}".format(rnd.randint(0, 9))
+        llm_type, llm_name = rnd.choice([("embedding", None), ("chat", "qwen-plus"), ("chat", None), ("rerank", None)])
+        yield tenant, llm_type, rnd.randint(0, 500), llm_name
+
+
+def test_totals_after_flush(accumulator):
+    acc, totals = accumulator
+    expected = defaultdict(int)
+    all_calls = list(calls())
+    for tenant, llm_type, used_tokens, llm_name in all_calls:
+        expected[(tenant, llm_type, llm_name or "")] += used_tokens
+    expected = {k: v for k, v in expected.items() if v}
+
+    threads = [threading.Thread(target=lambda part: [acc.add(*c) for c in part], args=(all_calls[i::8],))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    acc.flush()
+    assert dict(totals.tokens) == expected
+    assert totals.batches == 1
+
+    acc.flush()
+    assert dict(totals.tokens) == expected
+
+
+def test_failed_flush_is_retried(accumulator):
+    acc, totals = accumulator
+    acc.stale = 0
+    acc.add("tenant", "chat", 100, "qwen-plus")
+    totals.fail = True
+    with pytest.raises(ConnectionError):
+        acc.flush()
+    acc.add("tenant", "chat", 20, "qwen-plus")
+    totals.fail = False
+    time.sleep(0.01)
+    acc.flush()
+    assert dict(totals.tokens) == {("tenant", "chat", "qwen-plus"): 120}
+    if acc.shared:
+        assert not acc._redis().keys("llm_usage:*")
+
+
+def test_flushed_when_full():
+    totals = Totals()
+    acc = UsageAccumulator(totals, interval=3600, max_pending=10, shared=False)
+    for _ in range(10):
+        acc.add("tenant", "embedding", 1)
+    for _ in range(50):
+        if totals.tokens:
+            break
+        time.sleep(0.1)
+    assert dict(totals.tokens) == {("tenant", "embedding", ""): 10}